@@ -6,25 +6,9 @@ relies on the scraping provided by other modules.
 """
 
 import sys
-from scrapers import AnnotationKind
+from tags import NO_TYPE
 from violation import AssignmentViolation
 
-def split_type( usr, fun_types ):
-    """
-    Split the type of a function into its direct and indirect constituents
-    """
-
-    return (
-            set( [ name
-                   for ( kind, name )
-                   in fun_types.get( usr, set() )
-                   if kind == AnnotationKind.DIRECT ] ),
-            set( [ name 
-                   for ( kind, name )
-                   in fun_types.get( usr, set() )
-                   if kind == AnnotationKind.INDIRECT ] ) )
-
-
 def check_assignments( assignments, fun_types ):
     """
     Check all the assignments in the given list of assignments.  Takes in
@@ -34,15 +18,15 @@ def check_assignments( assignments, fun_types ):
     assignments that do not follow the conventions given.
     """
     for lvalue, rvalue, cursor in assignments:
-        lvalue_direct_type, lvalue_indirect_type = split_type(
-                lvalue, fun_types )
-        rvalue_direct_type, rvalue_indirect_type = split_type(
-                rvalue, fun_types )
+        lvalue_direct_type, lvalue_indirect_type = fun_types.get(
+                lvalue, NO_TYPE )
+        rvalue_direct_type, rvalue_indirect_type = fun_types.get(
+                rvalue, NO_TYPE )
 
         # direct types must match
         # right indirect type must be subset of left indirect type
         if ( lvalue_direct_type != rvalue_direct_type or
-             not rvalue_indirect_type.issubset( lvalue_indirect_type ) ):
+             rvalue_indirect_type & ~lvalue_indirect_type ):
             yield AssignmentViolation( lvalue, rvalue, cursor )
 
 
@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
 
 import clang.cindex
-from clang.cindex import CursorKind, TranslationUnit
+from clang.cindex import CursorKind, TranslationUnit, TypeKind
 from collections import defaultdict 
 import pdb
 import sys
 
-def get_translation_unit( fname, cmd_args ):
-    index = clang.cindex.Index.create()
-    options = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
-
+def get_clang_args( cmd_args ):
+    """
+    Build the clang argument vector from funqual's command line options
+    """
     args = [
             '-x', cmd_args.language,
             '-std=' + cmd_args.standard,
@@ -24,6 +24,26 @@ def get_translation_unit( fname, cmd_args ):
         for flag in cmd_args.clang_flags.split( ' ' ):
             args.append( flag )
 
+    return args
+
+
+def get_translation_unit( fname, cmd_args, args=None, index=None,
+                          editing=False ):
+    """
+    Parse |fname|.  Unless the clang arguments are given explicitly in
+    |args|, they are built from the command line options.  A long lived
+    caller may pass its own clang |index|.  With |editing|, clang keeps a
+    precompiled preamble so that reparse_translation_unit is cheap.
+    """
+    if index is None:
+        index = clang.cindex.Index.create()
+    options = TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+    if editing:
+        options |= TranslationUnit.PARSE_PRECOMPILED_PREAMBLE
+
+    if args is None:
+        args = get_clang_args( cmd_args )
+
     print( fname )
     try:
         tu = index.parse( fname, options=options, args=args )
@@ -33,6 +53,29 @@ def get_translation_unit( fname, cmd_args ):
             print( "Clang arguments: \n\t{}".format( '\n\t'.join( args ) ) )
         tu = None
 
+    print_diagnostics( fname, tu, cmd_args, args )
+
+    return tu
+
+
+def reparse_translation_unit( fname, tu, cmd_args, args ):
+    """
+    Bring |tu| up to date with the files on disk.  Returns False if clang
+    could not reparse it.
+    """
+    print( fname )
+    try:
+        tu.reparse()
+    except Exception:
+        print( "\nFailed to reparse {}".format( fname ) )
+        return False
+
+    print_diagnostics( fname, tu, cmd_args, args )
+
+    return True
+
+
+def print_diagnostics( fname, tu, cmd_args, args ):
     if tu is not None and tu.diagnostics:
         print( "\nParsing errors for {}".format( fname ) )
         for diag in tu.diagnostics:
@@ -40,8 +83,6 @@ def get_translation_unit( fname, cmd_args ):
         if cmd_args.verbose:
             print( "Clang arguments: {}".format( ' '.join( args ) ) )
 
-    return tu
-
 
 def dump_ast( node, output_func, depth=0 ):
     """
@@ -65,28 +106,112 @@ def dump_ast( node, output_func, depth=0 ):
     for child in node.get_children():
         dump_ast( child, output_func, depth + 2 )
 
-def get_human_name( node ):
+class SourceLocation( object ):
     """
-    Given a declaration, find its fully qualified name (with class and
-    namespaces and compilation unit) and make it human readable
+    Plain copy of the parts of a clang source location that funqual reports.
+    Unlike a clang cursor, this does not keep its translation unit alive and
+    can be pickled.
     """
-    node = node.referenced
+    def __init__( self, filename, line, column ):
+        self.file = filename
+        self.line = line
+        self.column = column
+
+    def __eq__( self, other ):
+        return ( isinstance( other, SourceLocation ) and
+                 ( self.file, self.line, self.column ) ==
+                 ( other.file, other.line, other.column ) )
 
-    res = "{0} ({1},{2})".format(
-            node.displayname,
-            node.location.line,
-            node.location.column )
+    def __hash__( self ):
+        return hash( ( self.file, self.line, self.column ) )
 
-    node = node.semantic_parent
-    while node:
-        if node.kind == CursorKind.UNEXPOSED_DECL:
-            res = "(#include)" + "::" + res
+
+class LocationRecord( object ):
+    """
+    Lightweight stand in for a declaration cursor.  Records everything that
+    is needed to report the declaration to the user: where it is, its
+    display name, and the qualified name of its semantic parent.
+    """
+    def __init__( self, displayname, location, parent_name ):
+        self.displayname = displayname
+        self.location = location
+        self.parent_name = parent_name
+
+    @classmethod
+    def from_cursor( cls, node, parent_names=None ):
+        """
+        Record the declaration |node|.  |parent_names| is passed on to
+        get_qualified_parent_name.
+        """
+        location = node.location
+        if location.file:
+            filename = location.file.name
         else:
-            res = str(node.displayname) + "::" + res
+            filename = None
 
-        node = node.semantic_parent
+        return cls( node.displayname,
+                    SourceLocation( filename,
+                                    location.line,
+                                    location.column ),
+                    get_qualified_parent_name( node, parent_names ) )
 
-    return res
+    def human_name( self ):
+        res = "{0} ({1},{2})".format(
+                self.displayname,
+                self.location.line,
+                self.location.column )
+
+        if self.parent_name is not None:
+            res = self.parent_name + "::" + res
+
+        return res
+
+    def __eq__( self, other ):
+        return ( isinstance( other, LocationRecord ) and
+                 ( self.displayname, self.location, self.parent_name ) ==
+                 ( other.displayname, other.location, other.parent_name ) )
+
+    def __hash__( self ):
+        return hash( ( self.displayname, self.location, self.parent_name ) )
+
+
+def get_qualified_parent_name( node, memo=None ):
+    """
+    Given a declaration, find the fully qualified name of its semantic
+    parent (with class and namespaces and compilation unit).  Declarations
+    share most of their parents, so a dictionary may be given in |memo| to
+    remember the names of parents across calls.
+    """
+    parent = node.semantic_parent
+    if parent is None:
+        return None
+    if memo is not None and parent in memo:
+        return memo[ parent ]
+
+    if parent.kind == CursorKind.UNEXPOSED_DECL:
+        name = "(#include)"
+    else:
+        name = str( parent.displayname )
+
+    above = get_qualified_parent_name( parent, memo )
+    if above is not None:
+        name = above + "::" + name
+
+    if memo is not None:
+        memo[ parent ] = name
+
+    return name
+
+
+def get_human_name( node ):
+    """
+    Given a declaration, find its fully qualified name (with class and
+    namespaces and compilation unit) and make it human readable
+    """
+    if isinstance( node, LocationRecord ):
+        return node.human_name()
+
+    return LocationRecord.from_cursor( node.referenced ).human_name()
 
 def get_qualifiers( node ):
     """
@@ -107,5 +232,17 @@ def get_qualifiers( node ):
 def is_function_pointer( cursor ):
     return '(*)' in cursor.type.spelling
 
+FUNCTION_TYPE_KINDS = ( TypeKind.FUNCTIONPROTO, TypeKind.FUNCTIONNOPROTO )
+
+def has_function_pointer_type( cursor ):
+    """
+    Check the type of |cursor| (seen through typedefs) is a pointer to a
+    function.  Unlike is_function_pointer, this never builds a spelling.
+    """
+    canonical = cursor.type.get_canonical()
+    if canonical.kind != TypeKind.POINTER:
+        return False
+    return canonical.get_pointee().kind in FUNCTION_TYPE_KINDS
+
 if __name__ == '__main__':
     dump_ast(get_translation_unit(sys.argv[1]).cursor, print)
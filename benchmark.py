@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for funqual.  Generates synthetic C++ projects of configurable
+size and shape, runs every phase of funqual over them and records how long
+each phase took and how much memory the run needed.  Results are written as
+JSON so that runs from two commits can be compared.
+
+    benchmark.py generate DIR [--preset NAME] [shape options]
+    benchmark.py run [--preset NAME ...] [-o results.json] [--repeat N]
+    benchmark.py compare base.json new.json [--threshold 0.10]
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import resource
+import tempfile
+import contextlib
+import platform
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+import rules
+import parse
+import compile_db
+import instrument
+
+# Bump whenever the layout of the results file changes
+RESULTS_VERSION = 2
+
+# The phases every benchmark reports, in the order they run
+PHASES = [ 'parse', 'scrape', 'merge', 'augment', 'rule_check',
+           'assignment_check', 'override_check' ]
+
+# Shapes of generated projects.  Every parameter can also be given on the
+# command line, see add_shape_options.
+PRESETS = {
+    'small': {
+        'functions': 200,
+        'translation_units': 4,
+        'shared_headers': 2,
+        'fan_out': 3,
+        'scc_density': 0.1,
+        'hierarchies': 4,
+        'hierarchy_depth': 3,
+        'hierarchy_width': 2,
+        'funptr_assignments': 20,
+        'annotation_density': 0.2,
+        'seed': 1,
+    },
+    'medium': {
+        'functions': 2000,
+        'translation_units': 16,
+        'shared_headers': 4,
+        'fan_out': 4,
+        'scc_density': 0.1,
+        'hierarchies': 16,
+        'hierarchy_depth': 4,
+        'hierarchy_width': 3,
+        'funptr_assignments': 200,
+        'annotation_density': 0.2,
+        'seed': 1,
+    },
+    'large': {
+        'functions': 10000,
+        'translation_units': 32,
+        'shared_headers': 8,
+        'fan_out': 5,
+        'scc_density': 0.1,
+        'hierarchies': 64,
+        'hierarchy_depth': 5,
+        'hierarchy_width': 3,
+        'funptr_assignments': 1000,
+        'annotation_density': 0.2,
+        'seed': 1,
+    },
+}
+
+TAGS = [ 'realtime', 'blocking' ]
+
+FUNQUAL_H = """#pragma once
+
+#define QTAG(TAG) __attribute__((annotate("funqual::" #TAG)))
+#define QTAG_IND(TAG) __attribute__((annotate("funqual_indirect::" #TAG)))
+
+void sleep_ms();
+"""
+
+RULES = """tag c:@F@sleep_ms# blocking
+rule restrict_indirect_call realtime blocking
+"""
+
+
+def qtag( tag ):
+    return " QTAG({})".format( tag ) if tag else ""
+
+
+def generate_project( outdir, shape ):
+    """
+    Write a synthetic C++ project with the given |shape| (see PRESETS) to
+    |outdir|.  Every translation unit includes every shared header.
+    Functions call |fan_out| functions further down the list, except that
+    a |scc_density| fraction of them are grouped into recursive cycles.
+    Returns the list of translation units and the path of the rules file.
+    """
+    rng = random.Random( shape[ 'seed' ] )
+    functions = shape[ 'functions' ]
+    units = shape[ 'translation_units' ]
+    headers = shape[ 'shared_headers' ]
+
+    def random_tag():
+        if rng.random() < shape[ 'annotation_density' ]:
+            return rng.choice( TAGS )
+        return None
+
+    calls = [ [] for _ in range( functions ) ]
+    for func in range( functions - 1 ):
+        calls[ func ] = [ rng.randrange( func + 1, functions )
+                          for _ in range( shape[ 'fan_out' ] ) ]
+
+    # Close cycles of 2 to 5 functions to create strongly connected parts
+    in_cycles = rng.sample( range( functions ),
+                            int( functions * shape[ 'scc_density' ] ) )
+    while len( in_cycles ) > 1:
+        size = min( rng.randint( 2, 5 ), len( in_cycles ) )
+        cycle, in_cycles = in_cycles[ :size ], in_cycles[ size: ]
+        for index, func in enumerate( cycle ):
+            calls[ func ].append( cycle[ ( index + 1 ) % len( cycle ) ] )
+
+    # Class hierarchies, as lists of levels of ( class, base ) pairs
+    hierarchies = []
+    for hierarchy in range( shape[ 'hierarchies' ] ):
+        levels = [ [ ( "H{}_0_0".format( hierarchy ), None ) ] ]
+        for depth in range( 1, shape[ 'hierarchy_depth' ] ):
+            levels.append( [
+                ( "H{}_{}_{}".format( hierarchy, depth, index ),
+                  rng.choice( levels[ -1 ] )[ 0 ] )
+                for index in range( shape[ 'hierarchy_width' ] ) ] )
+        hierarchies.append( levels )
+
+    header_text = [ [ '#pragma once\n\n#include "funqual.h"\n\n' ]
+                    for _ in range( headers ) ]
+    unit_text = [ [ "".join( [ '#include "shared_{}.h"\n'.format( header )
+                               for header in range( headers ) ] ) + "\n" ]
+                  for _ in range( units ) ]
+
+    for func in range( functions ):
+        header_text[ func % headers ].append(
+                "void f_{}(){};\n".format( func, qtag( random_tag() ) ) )
+
+    for hierarchy, levels in enumerate( hierarchies ):
+        text = header_text[ hierarchy % headers ]
+        text.append( "\n" )
+        for level in levels:
+            for cls, base in level:
+                text.append(
+                        "class {}{} {{\npublic:\n"
+                        "    virtual void run(){};\n}};\n".format(
+                            cls, " : public " + base if base else "",
+                            qtag( random_tag() ) ) )
+                unit_text[ rng.randrange( units ) ].append(
+                        "void {}::run() {{\n    f_{}();\n}}\n\n".format(
+                            cls, rng.randrange( functions ) ) )
+        text.append( "H{0}_0_0 &instance_{0}();\n".format( hierarchy ) )
+
+    funptrs = [ 0 ] * functions
+    for _ in range( shape[ 'funptr_assignments' ] ):
+        funptrs[ rng.randrange( functions ) ] += 1
+
+    for func in range( functions ):
+        body = [ "    f_{}();\n".format( callee ) for callee in calls[ func ] ]
+
+        if hierarchies and rng.random() < 0.1:
+            body.append( "    instance_{}().run();\n".format(
+                rng.randrange( len( hierarchies ) ) ) )
+        if rng.random() < 0.05:
+            body.append( "    sleep_ms();\n" )
+
+        for index in range( funptrs[ func ] ):
+            body.append(
+                    "    void{} (*fp_{})() = f_{};\n"
+                    "    fp_{} = f_{};\n"
+                    "    fp_{}();\n".format(
+                        qtag( random_tag() ), index,
+                        rng.randrange( functions ),
+                        index, rng.randrange( functions ), index ) )
+
+        unit_text[ func % units ].append(
+                "void f_{}() {{\n{}}}\n\n".format( func, "".join( body ) ) )
+
+    os.makedirs( outdir, exist_ok=True )
+
+    def write( fname, text ):
+        with open( os.path.join( outdir, fname ), 'w' ) as f:
+            f.write( text )
+
+    write( 'funqual.h', FUNQUAL_H )
+    write( 'rules.qtag', RULES )
+    for header, text in enumerate( header_text ):
+        write( "shared_{}.h".format( header ), "".join( text ) )
+    for unit, text in enumerate( unit_text ):
+        write( "tu_{}.cpp".format( unit ), "".join( text ) )
+
+    return ( [ os.path.join( outdir, "tu_{}.cpp".format( unit ) )
+               for unit in range( units ) ],
+             os.path.join( outdir, 'rules.qtag' ) )
+
+
+def run_phases( files, tags_file, jobs=1 ):
+    """
+    Run every phase of funqual over |files| and return a dictionary of
+    the seconds spent in each phase (see PHASES) along with a few counts
+    describing the program.  The timings are the totals of the spans
+    recorded by instrument, so with several |jobs| parse and scrape are
+    summed over all workers.
+    """
+    options, _ = parse.build_option_parser().parse_args(
+            [ '-t', tags_file, '-j', str( jobs ) ] )
+    ext_types, type_rules = rules.parse_rules_file( tags_file )
+
+    instrument.reset()
+
+    summaries = list( parse.summarize_files(
+        compile_db.jobs_from_files( files, options ), options ) )
+    model = parse.build_program_model( summaries, ext_types, options )
+    _, _, violations = parse.check_program_model( model, type_rules, options )
+    for _ in violations:
+        pass
+
+    totals = instrument.recorder.totals()
+    timings = dict( [ ( phase, totals.get( phase, 0.0 ) )
+                      for phase in PHASES ] )
+
+    counts = {}
+    for span in instrument.recorder.spans:
+        if span.name.endswith( '_check' ):
+            phase = span.name.replace( 'check', 'violations' )
+            counts[ phase ] = counts.get( phase, 0 ) + span.args.get( 'items', 0 )
+
+    counters = instrument.recorder.counters
+    counts[ 'functions' ] = counters[ 'functions' ]
+    counts[ 'calls' ] = counters[ 'edges' ]
+    counts[ 'translation_units' ] = len( summaries )
+
+    return timings, counts
+
+
+def run_case( shape, jobs, connection ):
+    """
+    Child process entry point.  Generate a project, benchmark it and send
+    the results back through |connection|.  Each case runs in its own
+    process so that its peak memory can be measured.
+    """
+    workdir = tempfile.mkdtemp( prefix='funqual-bench-' )
+    try:
+        files, tags_file = generate_project( workdir, shape )
+
+        # funqual prints every file name and parse error on stdout
+        with open( os.devnull, 'w' ) as devnull:
+            with contextlib.redirect_stdout( devnull ):
+                timings, counts = run_phases( files, tags_file, jobs )
+
+        connection.send( {
+            'shape': shape,
+            'jobs': jobs,
+            'phases': timings,
+            'total': sum( timings.values() ),
+            'counts': counts,
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF ).ru_maxrss,
+            'peak_worker_rss_kb': resource.getrusage(
+                resource.RUSAGE_CHILDREN ).ru_maxrss,
+        } )
+    finally:
+        shutil.rmtree( workdir )
+
+
+def benchmark( shape, jobs=1 ):
+    """
+    Benchmark one project shape in a fresh process
+    """
+    context = multiprocessing.get_context( 'spawn' )
+    receiver, sender = context.Pipe( duplex=False )
+    process = context.Process( target=run_case,
+                               args=( shape, jobs, sender ) )
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def best_of( results ):
+    """
+    Combine repeated runs of one benchmark by keeping the fastest time of
+    every phase and the smallest peak memory, which are the least noisy
+    """
+    best = dict( results[ 0 ] )
+    best[ 'phases' ] = dict( [
+        ( phase, min( [ result[ 'phases' ][ phase ]
+                        for result in results ] ) )
+        for phase in PHASES ] )
+    best[ 'total' ] = min( [ result[ 'total' ] for result in results ] )
+    for key in [ 'peak_rss_kb', 'peak_worker_rss_kb' ]:
+        best[ key ] = min( [ result[ key ] for result in results ] )
+    best[ 'repeat' ] = len( results )
+    return best
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+                [ 'git', 'rev-parse', 'HEAD' ],
+                cwd=os.path.dirname( os.path.abspath( __file__ ) ),
+                stderr=subprocess.DEVNULL ).decode().strip()
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+
+def compare( base, new, threshold, min_seconds=0.01 ):
+    """
+    Compare two results files.  A phase (or the peak memory) of a case
+    regresses if it grew by more than |threshold| (a fraction) and, for
+    times, by more than |min_seconds|.  Returns a list of ( case, metric,
+    base value, new value ) regressions.
+    """
+    regressions = []
+
+    for case, new_result in sorted( new[ 'cases' ].items() ):
+        base_result = base[ 'cases' ].get( case )
+        if base_result is None:
+            continue
+
+        metrics = [ ( phase, base_result[ 'phases' ][ phase ],
+                      new_result[ 'phases' ][ phase ], min_seconds )
+                    for phase in PHASES ]
+        metrics.append( ( 'total', base_result[ 'total' ],
+                          new_result[ 'total' ], min_seconds ) )
+        metrics.append( ( 'peak_rss_kb', base_result[ 'peak_rss_kb' ],
+                          new_result[ 'peak_rss_kb' ], 0 ) )
+
+        for metric, before, after, noise in metrics:
+            if after > before * ( 1 + threshold ) and after - before > noise:
+                regressions.append( ( case, metric, before, after ) )
+
+    return regressions
+
+
+def add_shape_options( parser ):
+    for name, value in sorted( PRESETS[ 'small' ].items() ):
+        parser.add_option( "--" + name.replace( '_', '-' ), dest=name,
+                           type="float" if isinstance( value, float )
+                                        else "int",
+                           help="Override {} of the preset".format( name ),
+                           default=None )
+
+
+def get_shape( preset, options ):
+    shape = dict( PRESETS[ preset ] )
+    for name in shape:
+        if getattr( options, name ) is not None:
+            shape[ name ] = getattr( options, name )
+    return shape
+
+
+def main():
+    parser = OptionParser( usage=(
+        "%prog generate DIR | run | compare BASE NEW [options]" ) )
+
+    parser.add_option( "--preset", dest="presets", action="append",
+                       help=( "Project shape to use: "
+                              + ", ".join( sorted( PRESETS ) )
+                              + ".  May be given more than once for run.  "
+                              + "Defaults to small." ),
+                       metavar="NAME", default=None )
+
+    parser.add_option( "-o", "--output", dest="output",
+                       help="Write the results of run to FILE",
+                       metavar="FILE", default=None )
+
+    parser.add_option( "--repeat", dest="repeat", type="int",
+                       help="Run every benchmark N times and keep the best",
+                       metavar="N", default=1 )
+
+    parser.add_option( "-j", "--jobs", dest="jobs", type="int",
+                       help="Parse with N worker processes",
+                       metavar="N", default=1 )
+
+    parser.add_option( "--threshold", dest="threshold", type="float",
+                       help=( "With compare, the fraction by which a phase "
+                              + "may grow before it counts as a regression" ),
+                       metavar="FRACTION", default=0.10 )
+
+    add_shape_options( parser )
+
+    ( options, args ) = parser.parse_args()
+    presets = options.presets or [ 'small' ]
+
+    if not args:
+        parser.print_help( sys.stderr )
+        sys.exit( 1 )
+
+    if args[ 0 ] == 'generate' and len( args ) == 2:
+        files, tags_file = generate_project(
+                args[ 1 ], get_shape( presets[ 0 ], options ) )
+        print( "Wrote {} translation units and {}".format(
+            len( files ), tags_file ) )
+
+    elif args[ 0 ] == 'run':
+        results = {
+            'version': RESULTS_VERSION,
+            'commit': current_commit(),
+            'python': platform.python_version(),
+            'cases': {},
+        }
+        for preset in presets:
+            result = best_of( [
+                benchmark( get_shape( preset, options ), options.jobs )
+                for _ in range( options.repeat ) ] )
+            results[ 'cases' ][ preset ] = result
+
+            print( "{}: {:0.3f} seconds, {} KB peak".format(
+                preset, result[ 'total' ], result[ 'peak_rss_kb' ] ) )
+            for phase in PHASES:
+                print( "\t{:<18} {:0.5f} seconds".format(
+                    phase, result[ 'phases' ][ phase ] ) )
+
+        if options.output:
+            with open( options.output, 'w' ) as f:
+                json.dump( results, f, indent=2, sort_keys=True )
+
+    elif args[ 0 ] == 'compare' and len( args ) == 3:
+        with open( args[ 1 ] ) as f:
+            base = json.load( f )
+        with open( args[ 2 ] ) as f:
+            new = json.load( f )
+
+        regressions = compare( base, new, options.threshold )
+        for case, metric, before, after in regressions:
+            print( "{} {}: {:0.5g} -> {:0.5g} ({:+0.1f}%)".format(
+                case, metric, before, after,
+                100.0 * ( after - before ) / before if before else 100.0 ) )
+
+        if regressions:
+            sys.exit( 1 )
+        print( "No regressions over {:0.0f}%".format(
+            100 * options.threshold ) )
+
+    else:
+        parser.print_help( sys.stderr )
+        sys.exit( 1 )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
-from clang.cindex import CursorKind, TranslationUnit
+from clang.cindex import CursorKind
+from scrapers import run_scrapers
 from collections import defaultdict
+from array import array
+
+# What calls() returns for a function that calls nothing
+NO_CALLS = frozenset()
 
 class CallTree():
     """
@@ -10,7 +15,7 @@ class CallTree():
     may contain cycles.
     """
     def __init__( self ):
-        self.tree = defaultdict( lambda: set() )
+        self.tree = defaultdict( set )
 
     def add( self, caller, callee ):
         self.tree[ caller ].add( callee )
@@ -22,7 +27,7 @@ class CallTree():
         return list( self.tree.keys() )
 
     def calls( self, caller ):
-        return self.tree[ caller ]
+        return self.tree.get( caller, NO_CALLS )
 
     def augment_with_overrides( self, overrides ):
         """
@@ -36,6 +41,204 @@ class CallTree():
     def size( self ):
         return sum( [ len( val ) for val in self.tree.values() ] )
 
+    def reaching( self, targets ):
+        """
+        Return the set of functions from which one of |targets| can be
+        reached (including |targets| themselves)
+        """
+        callers = defaultdict( set )
+        for caller, callees in self.tree.items():
+            for callee in callees:
+                callers[ callee ].add( caller )
+
+        result = set( targets )
+        queue = list( result )
+        while queue:
+            for caller in callers.get( queue.pop(), () ):
+                if caller not in result:
+                    result.add( caller )
+                    queue.append( caller )
+
+        return result
+
+    def freeze( self ):
+        """
+        Return a compact, read only copy of this call tree
+        """
+        return FrozenCallTree( self )
+
+
+class FrozenCallTree():
+    """
+    Compact call tree built once all the translation units are merged.
+    Every USR is interned to an integer once and the edges are stored in
+    compressed sparse row form: the callees of function |i| are
+    targets[ offsets[ i ] : offsets[ i + 1 ] ].  A reverse edge index is kept
+    in the same form so the callers of a function can be found as well.
+
+    Answers the same questions as CallTree through USRs (calls, functions,
+    size) and through integer ids (callees_of, callers_of).
+    """
+    def __init__( self, call_tree ):
+        self.usrs = []
+        self.ids = {}
+
+        callers = call_tree.functions()
+        for caller in callers:
+            self.intern( caller )
+
+        adjacency = []
+        for caller in callers:
+            adjacency.append( [
+                self.intern( callee )
+                for callee
+                in sorted( call_tree.calls( caller ) ) ] )
+
+        self._build( adjacency )
+
+    def intern( self, usr ):
+        """
+        Return the integer id of |usr|, assigning one if needed
+        """
+        idx = self.ids.get( usr )
+        if idx is None:
+            idx = len( self.usrs )
+            self.ids[ usr ] = idx
+            self.usrs.append( usr )
+        return idx
+
+    def _build( self, adjacency ):
+        """
+        Build the forward and reverse edge arrays.  |adjacency| lists the
+        callee ids of each caller id; ids past its end have no callees.
+        """
+        count = len( self.usrs )
+
+        self.offsets = array( 'i', [ 0 ] )
+        self.targets = array( 'i' )
+        for idx in range( count ):
+            if idx < len( adjacency ):
+                self.targets.extend( adjacency[ idx ] )
+            self.offsets.append( len( self.targets ) )
+
+        # Bucket the edges by callee for the reverse index.  Callers are
+        # visited in order, so each bucket comes out sorted.
+        buckets = [ None ] * count
+        for caller in range( count ):
+            for callee in self.targets[ self.offsets[ caller ] :
+                                        self.offsets[ caller + 1 ] ]:
+                bucket = buckets[ callee ]
+                if bucket is None:
+                    bucket = buckets[ callee ] = array( 'i' )
+                bucket.append( caller )
+
+        self.rev_offsets = array( 'i', [ 0 ] )
+        self.rev_targets = array( 'i' )
+        for bucket in buckets:
+            if bucket is not None:
+                self.rev_targets.extend( bucket )
+            self.rev_offsets.append( len( self.rev_targets ) )
+
+    def index( self, usr ):
+        """
+        Return the integer id of |usr| or None if it is not in the tree
+        """
+        return self.ids.get( usr )
+
+    def callees_of( self, idx ):
+        return self.targets[ self.offsets[ idx ] : self.offsets[ idx + 1 ] ]
+
+    def callers_of( self, idx ):
+        return self.rev_targets[
+                self.rev_offsets[ idx ] : self.rev_offsets[ idx + 1 ] ]
+
+    def functions( self ):
+        return [ self.usrs[ idx ]
+                 for idx in range( len( self.usrs ) )
+                 if self.offsets[ idx ] != self.offsets[ idx + 1 ] ]
+
+    def calls( self, caller ):
+        idx = self.ids.get( caller )
+        if idx is None:
+            return NO_CALLS
+        return [ self.usrs[ callee ] for callee in self.callees_of( idx ) ]
+
+    def callers( self, callee ):
+        idx = self.ids.get( callee )
+        if idx is None:
+            return NO_CALLS
+        return [ self.usrs[ caller ] for caller in self.callers_of( idx ) ]
+
+    def augment_with_overrides( self, overrides ):
+        """
+        Calls to a parent method also imply a call to every method that
+        overrides it.  |overrides| maps methods to all their overriders
+        (a ClassHierarchy, usually).  Rather than looking at every edge,
+        each overridden method hands its overriders to all of its callers
+        at once through the reverse index.  The arrays are rebuilt once
+        with all the new edges.
+        """
+        # Methods interned below have no callers yet
+        count = len( self.usrs )
+
+        added = defaultdict( list )
+        for method in overrides.keys():
+            idx = self.ids.get( method )
+            if idx is None or idx >= count:
+                continue
+            callers = self.callers_of( idx )
+            if not callers:
+                continue
+
+            overriders = frozenset( [ self.intern( overrider )
+                                      for overrider in overrides[ method ] ] )
+            for caller in callers:
+                added[ caller ].append( overriders )
+
+        if not added:
+            return
+
+        adjacency = []
+        for caller in range( count ):
+            if caller in added:
+                adjacency.append( array( 'i', sorted(
+                    set( self.callees_of( caller ) ).union(
+                        *added[ caller ] ) ) ) )
+            else:
+                adjacency.append( self.callees_of( caller ) )
+
+        self._build( adjacency )
+
+    def size( self ):
+        return len( self.targets )
+
+    def reaching( self, targets ):
+        """
+        Return the set of functions from which one of |targets| can be
+        reached (including |targets| themselves).  A single traversal of
+        the reverse edge index, so linear in the size of the tree.
+        """
+        marked = bytearray( len( self.usrs ) )
+        queue = []
+        for usr in targets:
+            idx = self.ids.get( usr )
+            if idx is not None and not marked[ idx ]:
+                marked[ idx ] = 1
+                queue.append( idx )
+
+        while queue:
+            for caller in self.callers_of( queue.pop() ):
+                if not marked[ caller ]:
+                    marked[ caller ] = 1
+                    queue.append( caller )
+
+        result = set( targets )
+        result.update( [ self.usrs[ idx ]
+                         for idx in range( len( self.usrs ) )
+                         if marked[ idx ] ] )
+        return result
+
+
 def merge_call_trees( subtrees ):
     """
     Union two call trees into a single merged call tree
@@ -48,46 +251,35 @@ def merge_call_trees( subtrees ):
 
     return result
 
-def build_call_tree( translation_unit ):
+class CallTreeScraper:
     """
-    Build a call tree for the given translation unit.  This is a wrapper
-    function around _rec_build_call_tree which mutates the in-parameter
-    in place.
+    Scrapes the call tree of a translation unit.  Every call is attributed
+    to the function, method, constructor or destructor that encloses it, or
+    to `_start` for calls outside of any function.
     """
-    result = CallTree()
+    kinds = [ CursorKind.CALL_EXPR ]
 
-    _rec_build_call_tree(
-        translation_unit.cursor,
-        translation_unit,
-        result,
-    )
+    def __init__( self ):
+        self.call_tree = CallTree()
+
+    def scrape( self, trav, context ):
+        func = trav.referenced
+        if func:
+            self.call_tree.add( context.caller_usr(), func.get_usr() )
+
+    def get( self ):
+        return self.call_tree
 
-    return result
 
-def _rec_build_call_tree( node, caller, call_tree ):
+def build_call_tree( translation_unit ):
     """
-    Build a call tree by recursively visiting all the nodes in a given
-    context.  This function mutates |call_tree| in place.
+    Build a call tree for the given translation unit.  This is a wrapper
+    around CallTreeScraper for when no other scrapers need to run.
     """
-    if ( node.kind in [
-            CursorKind.FUNCTION_DECL,
-            CursorKind.CXX_METHOD,
-            CursorKind.CONSTRUCTOR,
-            CursorKind.DESTRUCTOR ] ):
-        caller = node
-    elif ( node.kind == CursorKind.CALL_EXPR ):
-        if node.referenced:
-            func = node.referenced
-
-            if type( caller ) == TranslationUnit:
-                caller_str = '_start'
-            else:
-                caller_str = caller.get_usr()
-
-            call_tree.add( caller_str, func.get_usr() )
+    scraper = CallTreeScraper()
+    run_scrapers( translation_unit.cursor, [ scraper ] )
 
-    for c in node.get_children():
-        _rec_build_call_tree( c, caller, call_tree )
+    return scraper.get()
 
 if __name__ == '__main__':
     from ast_helpers import get_translation_unit
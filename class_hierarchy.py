@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+The class hierarchy of a program, as far as virtual methods go.  Scrapers
+only record which methods a method directly overrides.  The transitive
+overriders of a method are worked out here, once per method, and shared by
+every method above it in the hierarchy.
+"""
+
+from collections import defaultdict
+
+# What overriders() returns for a method nobody overrides
+NO_OVERRIDERS = frozenset()
+
+
+class ClassHierarchy( object ):
+    """
+    Built from a mapping of each method to the methods that directly
+    override it.  Acts as a read only mapping of each overridden method to
+    all of its (transitive) overriders, the same shape the override map
+    scraped out of clang used to have.  The transitive overriders of a
+    method are computed the first time they are asked for and memoized.
+    """
+    def __init__( self, direct ):
+        self.direct = dict( [ ( method, frozenset( overriders ) )
+                              for method, overriders in direct.items()
+                              if overriders ] )
+        self.memo = {}
+
+    def overriders( self, method ):
+        """
+        Return every method that overrides |method|, directly or not
+        """
+        result = self.memo.get( method )
+        if result is not None:
+            return result
+        if method not in self.direct:
+            return NO_OVERRIDERS
+
+        # Post-order walk down the hierarchy so that each method's
+        # overriders are built from the memoized sets of its children.
+        # |entered| keeps a cycle (which a valid program can't have) from
+        # looping forever.
+        entered = set()
+        stack = [ ( method, False ) ]
+        while stack:
+            curr, expanded = stack.pop()
+            if curr in self.memo:
+                continue
+
+            children = self.direct.get( curr, NO_OVERRIDERS )
+            if expanded:
+                result = set( children )
+                for child in children:
+                    result |= self.memo.get( child, NO_OVERRIDERS )
+                self.memo[ curr ] = frozenset( result )
+                continue
+
+            if curr in entered:
+                continue
+            entered.add( curr )
+            stack.append( ( curr, True ) )
+            for child in children:
+                if child in self.direct and child not in entered:
+                    stack.append( ( child, False ) )
+
+        return self.memo[ method ]
+
+    def keys( self ):
+        return self.direct.keys()
+
+    def items( self ):
+        return [ ( method, self.overriders( method ) )
+                 for method in self.direct ]
+
+    def get( self, method, default=NO_OVERRIDERS ):
+        if method not in self.direct:
+            return default
+        return self.overriders( method )
+
+    def __getitem__( self, method ):
+        return self.overriders( method )
+
+    def __contains__( self, method ):
+        return method in self.direct
+
+    def __iter__( self ):
+        return iter( self.direct )
+
+    def __len__( self ):
+        return len( self.direct )
+
+    def closure( self ):
+        """
+        Return a plain mapping of every overridden method to all of its
+        overriders
+        """
+        result = defaultdict( set )
+        for method, overriders in self.items():
+            result[ method ] |= overriders
+        return result
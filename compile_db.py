@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Reads a clang compilation database (compile_commands.json) and turns it into
+a list of CompileJobs.  A CompileJob is a single file along with the exact
+clang arguments that file should be parsed with.
+"""
+
+import os
+import json
+import shlex
+import fnmatch
+from ast_helpers import get_clang_args
+
+# Compiler arguments that are meaningless (or harmful) when handing a
+# command to libclang.  The value is the number of following arguments that
+# belong to the flag.
+IGNORED_ARGS = {
+    '-c': 0,
+    '-o': 1,
+    '-MF': 1,
+    '-MT': 1,
+    '-MQ': 1,
+    '-MD': 0,
+    '-MMD': 0,
+    '-M': 0,
+    '-MM': 0,
+}
+
+
+class CompileJob( object ):
+    """
+    A file to be parsed along with the clang arguments to parse it with
+    """
+    def __init__( self, fname, args ):
+        self.fname = fname
+        self.args = args
+
+    def key( self ):
+        return ( self.fname, tuple( self.args ) )
+
+    def __repr__( self ):
+        return "CompileJob({!r}, {!r})".format( self.fname, self.args )
+
+
+def jobs_from_files( files, options ):
+    """
+    Build the jobs for files named on the command line.  They all share the
+    arguments built from -x, -std, -I and -f.
+    """
+    args = get_clang_args( options )
+    return [ CompileJob( fname, args ) for fname in files ]
+
+
+def get_entry_args( entry ):
+    """
+    Given an entry of a compilation database, return the arguments that
+    should be passed to libclang.  The compiler itself, the source file and
+    output related flags are dropped.
+    """
+    if 'arguments' in entry:
+        command = list( entry[ 'arguments' ] )
+    else:
+        command = shlex.split( entry[ 'command' ] )
+
+    args = [ '-working-directory', entry[ 'directory' ] ]
+    fname = os.path.normpath( os.path.join(
+        entry[ 'directory' ], entry[ 'file' ] ) )
+
+    skip = 0
+    for arg in command[ 1: ]:
+        if skip:
+            skip -= 1
+        elif arg in IGNORED_ARGS:
+            skip = IGNORED_ARGS[ arg ]
+        elif arg.startswith( '-o' ) and len( arg ) > 2:
+            continue
+        elif os.path.normpath( os.path.join(
+                entry[ 'directory' ], arg ) ) == fname:
+            continue
+        else:
+            args.append( arg )
+
+    return args
+
+
+def matches_any( fname, patterns ):
+    """
+    Check whether |fname| (either as an absolute path or relative to the
+    current directory) matches one of the glob |patterns|
+    """
+    relname = os.path.relpath( fname )
+    for pattern in patterns:
+        if ( fnmatch.fnmatch( fname, pattern ) or
+             fnmatch.fnmatch( relname, pattern ) ):
+            return True
+
+    return False
+
+
+def load_compile_commands( build_dir, files=None, patterns=None ):
+    """
+    Read |build_dir|/compile_commands.json and return a list of CompileJobs.
+    If |files| is given, only entries for those files are kept.  If
+    |patterns| is given, only entries whose file matches one of the globs
+    are kept.  Entries with identical files and arguments are only
+    returned once.
+    """
+    with open( os.path.join( build_dir, 'compile_commands.json' ) ) as f:
+        entries = json.load( f )
+
+    if files:
+        files = set( [ os.path.abspath( fname ) for fname in files ] )
+
+    jobs = []
+    seen = set()
+
+    for entry in entries:
+        fname = os.path.normpath( os.path.join(
+            entry[ 'directory' ], entry[ 'file' ] ) )
+
+        if files and fname not in files:
+            continue
+        if patterns and not matches_any( fname, patterns ):
+            continue
+
+        job = CompileJob( fname, get_entry_args( entry ) )
+        if job.key() in seen:
+            continue
+
+        seen.add( job.key() )
+        jobs.append( job )
+
+    return jobs
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+Lightweight instrumentation.  Code marks the phases it goes through with
+nested spans and bumps named counters:
+
+    with instrument.span( 'parse', file=fname ):
+        ...
+    instrument.count( 'cursors_visited', traversal.visited )
+
+Everything is recorded into a module level Recorder.  Worker processes hand
+their events back to the parent with take() and merge().  A run can be
+exported as JSON (spans and counters) or in the Chrome trace event format,
+which chrome://tracing and Perfetto can load.
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+from collections import defaultdict
+
+
+class Span( object ):
+    """
+    A named interval of time.  |start| is a wall clock time in seconds so
+    that spans from different processes line up; |duration| is in seconds.
+    """
+    def __init__( self, name, start, duration, depth, args, pid, tid ):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.depth = depth
+        self.args = args
+        self.pid = pid
+        self.tid = tid
+
+    def to_dict( self ):
+        return {
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'depth': self.depth,
+            'args': self.args,
+            'pid': self.pid,
+            'tid': self.tid,
+        }
+
+
+class Recorder( object ):
+    def __init__( self ):
+        self.spans = []
+        self.counters = defaultdict( int )
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def span( self, name, **args ):
+        """
+        Record the time spent in the body of the with statement.  The
+        body may add to |args| through the yielded dictionary.
+        """
+        start = time.time()
+        self.depth += 1
+        try:
+            yield args
+        finally:
+            self.depth -= 1
+            self.spans.append( Span( name, start, time.time() - start,
+                                     self.depth, args, os.getpid(),
+                                     threading.get_ident() ) )
+
+    def timed( self, name, iterable, **args ):
+        """
+        Iterate over |iterable|, recording a span for only the time spent
+        producing items (not the time the consumer spends on them).  The
+        number of items is recorded as the `items` argument.
+        """
+        start = time.time()
+        duration = 0.0
+        items = 0
+        iterator = iter( iterable )
+
+        while True:
+            before = time.time()
+            try:
+                item = next( iterator )
+            except StopIteration:
+                duration += time.time() - before
+                break
+            duration += time.time() - before
+            items += 1
+            yield item
+
+        args[ 'items' ] = items
+        self.spans.append( Span( name, start, duration, self.depth, args,
+                                 os.getpid(), threading.get_ident() ) )
+
+    def count( self, name, value=1 ):
+        self.counters[ name ] += value
+
+    def take( self ):
+        """
+        Return everything recorded so far and start over.  Used by worker
+        processes to send their events to the parent.
+        """
+        events = ( self.spans, dict( self.counters ) )
+        self.spans = []
+        self.counters = defaultdict( int )
+        return events
+
+    def merge( self, events ):
+        """
+        Add the events returned by take() in another process
+        """
+        spans, counters = events
+        self.spans += spans
+        for name, value in counters.items():
+            self.counters[ name ] += value
+
+    def totals( self ):
+        """
+        Total time spent in the spans of each name
+        """
+        totals = defaultdict( float )
+        for span in self.spans:
+            totals[ span.name ] += span.duration
+        return dict( totals )
+
+    def to_json( self ):
+        return {
+            'spans': [ span.to_dict() for span in self.spans ],
+            'counters': dict( self.counters ),
+            'totals': self.totals(),
+        }
+
+    def to_chrome_trace( self ):
+        """
+        Chrome trace events: one complete ("X") event per span and one
+        counter ("C") event per counter at the end of the run
+        """
+        events = []
+        end = 0
+        for span in self.spans:
+            ts = int( span.start * 1e6 )
+            dur = int( span.duration * 1e6 )
+            end = max( end, ts + dur )
+            events.append( {
+                'name': span.name,
+                'cat': 'funqual',
+                'ph': 'X',
+                'ts': ts,
+                'dur': dur,
+                'pid': span.pid,
+                'tid': span.tid,
+                'args': span.args,
+            } )
+
+        for name, value in sorted( self.counters.items() ):
+            events.append( {
+                'name': name,
+                'cat': 'funqual',
+                'ph': 'C',
+                'ts': end,
+                'pid': os.getpid(),
+                'args': { name: value },
+            } )
+
+        return { 'traceEvents': events, 'displayTimeUnit': 'ms' }
+
+    def report( self, slowest=5 ):
+        """
+        Human readable summary: time per span name, the slowest spans of
+        names that occur more than once, and every counter
+        """
+        lines = []
+        counts = defaultdict( int )
+        for span in self.spans:
+            counts[ span.name ] += 1
+
+        for name, total in sorted( self.totals().items(),
+                                   key=lambda item: -item[ 1 ] ):
+            lines.append( "{:<28} {:0.5f} seconds ({} spans)".format(
+                name, total, counts[ name ] ) )
+
+        for name in sorted( counts ):
+            if counts[ name ] < 2:
+                continue
+            spans = sorted( [ span for span in self.spans
+                              if span.name == name ],
+                            key=lambda span: -span.duration )
+            lines.append( "slowest {}:".format( name ) )
+            for span in spans[ :slowest ]:
+                lines.append( "\t{:0.5f} seconds {}".format(
+                    span.duration, ", ".join( [
+                        "{}={}".format( key, value )
+                        for key, value in sorted( span.args.items() ) ] ) ) )
+
+        for name, value in sorted( self.counters.items() ):
+            lines.append( "{:<28} {}".format( name, value ) )
+
+        return "\n".join( lines )
+
+
+recorder = Recorder()
+
+
+def span( name, **args ):
+    return recorder.span( name, **args )
+
+
+def timed( name, iterable, **args ):
+    return recorder.timed( name, iterable, **args )
+
+
+def count( name, value=1 ):
+    recorder.count( name, value )
+
+
+def take():
+    return recorder.take()
+
+
+def merge( events ):
+    recorder.merge( events )
+
+
+def reset():
+    recorder.take()
+
+
+def write_json( fname ):
+    with open( fname, 'w' ) as f:
+        json.dump( recorder.to_json(), f, indent=1, sort_keys=True )
+
+
+def write_chrome_trace( fname ):
+    with open( fname, 'w' ) as f:
+        json.dump( recorder.to_chrome_trace(), f )
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+Writers for the violations funqual finds.  Violations are produced lazily,
+so every writer writes (and flushes) each violation as soon as it is handed
+one instead of collecting them first.  That lets other programs consume the
+output while funqual is still checking.
+"""
+
+import os
+import json
+from violation import NameCache
+
+SARIF_SCHEMA = ( "https://raw.githubusercontent.com/oasis-tcs/sarif-spec/"
+                 "master/Schemata/sarif-schema-2.1.0.json" )
+
+
+class TextWriter( object ):
+    """
+    The human readable output funqual has always printed
+    """
+    def __init__( self, stream ):
+        self.stream = stream
+        self.names = None
+
+    def name_cache( self, func_cursors, fun_types ):
+        """
+        The NameCache shared by every violation written for the same
+        program
+        """
+        if self.names is None or not self.names.matches( func_cursors,
+                                                         fun_types ):
+            self.names = NameCache( func_cursors, fun_types )
+        return self.names
+
+    def begin( self ):
+        pass
+
+    def write( self, violation, func_cursors, fun_types ):
+        self.stream.write( violation.render_string(
+                func_cursors, fun_types,
+                self.name_cache( func_cursors, fun_types ) ) + "\n\n" )
+        self.stream.flush()
+
+    def end( self ):
+        pass
+
+
+class JsonLinesWriter( TextWriter ):
+    """
+    One JSON object per line per violation, see BaseViolation.to_dict
+    """
+    def write( self, violation, func_cursors, fun_types ):
+        self.stream.write( json.dumps(
+                violation.to_dict( func_cursors, fun_types,
+                                   self.name_cache( func_cursors,
+                                                    fun_types ) ),
+                sort_keys=True ) + "\n" )
+        self.stream.flush()
+
+
+def sarif_location( location, message=None ):
+    """
+    Turn a location from BaseViolation.to_dict into a SARIF location
+    """
+    result = {
+        'physicalLocation': {
+            'artifactLocation': {
+                'uri': sarif_uri( location[ 'file' ] ),
+            },
+            'region': {
+                'startLine': location[ 'line' ],
+                'startColumn': location[ 'column' ],
+            },
+        },
+    }
+
+    if message:
+        result[ 'message' ] = { 'text': message }
+
+    return result
+
+
+def sarif_uri( fname ):
+    """
+    SARIF wants URIs.  Relative paths are valid relative references.
+    """
+    if fname is None:
+        return ""
+    if os.path.isabs( fname ):
+        return "file://" + fname
+    return fname
+
+
+class SarifWriter( TextWriter ):
+    """
+    A SARIF 2.1.0 log with a single run.  The opening of the log is written
+    up front and each result is written as soon as it is found, so the log
+    is only valid JSON once end() has been called.
+    """
+    def __init__( self, stream ):
+        TextWriter.__init__( self, stream )
+        self.results = 0
+
+    def begin( self ):
+        self.stream.write(
+                '{{"$schema": {}, "version": "2.1.0", "runs": [{{'
+                '"tool": {{"driver": {{"name": "funqual"}}}}, '
+                '"results": [\n'.format( json.dumps( SARIF_SCHEMA ) ) )
+        self.stream.flush()
+
+    def write( self, violation, func_cursors, fun_types ):
+        details = violation.to_dict(
+                func_cursors, fun_types,
+                self.name_cache( func_cursors, fun_types ) )
+
+        result = {
+            'ruleId': details[ 'rule_id' ],
+            'level': 'error',
+            'message': { 'text': details[ 'message' ] },
+            'locations': [],
+            'properties': details,
+        }
+
+        if details[ 'location' ]:
+            result[ 'locations' ].append(
+                    sarif_location( details[ 'location' ] ) )
+
+        if details[ 'kind' ] == 'rule':
+            result[ 'codeFlows' ] = [ {
+                'threadFlows': [ {
+                    'locations': [
+                        { 'location': sarif_location(
+                            func[ 'location' ], func[ 'name' ] ) }
+                        for func in details[ 'path' ]
+                        if func[ 'location' ] ],
+                } ],
+            } ]
+
+        if self.results:
+            self.stream.write( ",\n" )
+        self.stream.write( json.dumps( result, sort_keys=True ) )
+        self.stream.flush()
+        self.results += 1
+
+    def end( self ):
+        self.stream.write( "\n]}]}\n" )
+        self.stream.flush()
+
+
+WRITERS = {
+    'text': TextWriter,
+    'jsonl': JsonLinesWriter,
+    'sarif': SarifWriter,
+}
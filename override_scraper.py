@@ -1,5 +1,6 @@
 from clang.cindex import CursorKind
 from collections import defaultdict
+from class_hierarchy import ClassHierarchy
 
 def merge( override_maps ):
     """
@@ -13,19 +14,23 @@ def merge( override_maps ):
 
     return result
 
-def get_overrides( tu ):
+def get_direct_overrides( tu ):
     """
-    Scrape a translation unit and generate a mapping of methods to the 
-    methods that override them
+    Scrape a translation unit and generate a mapping of methods to the
+    methods that directly override them
     """
     overrides = defaultdict( lambda: set() )
 
     for trav in tu.cursor.walk_preorder():
         if trav.kind == CursorKind.CXX_METHOD:
-            to_visit = list( trav.get_overridden_cursors() )
-            while to_visit:
-                overridden = to_visit.pop()
+            for overridden in trav.get_overridden_cursors():
                 overrides[ overridden.get_usr() ].add( trav.get_usr() )
-                to_visit += list( overridden.get_overridden_cursors() )
 
     return overrides
+
+def get_overrides( tu ):
+    """
+    Scrape a translation unit and generate a mapping of methods to the 
+    methods that override them
+    """
+    return ClassHierarchy( get_direct_overrides( tu ) ).closure()
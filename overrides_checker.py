@@ -6,8 +6,7 @@ consistency.  This module relies on the scraping provided by other modules.
 """
 
 import sys
-from scrapers import AnnotationKind
-from rules import direct_type
+from tags import NO_TYPE
 from violation import OverrideViolation
 
 def check_overrides( overrides, fun_types ):
@@ -15,12 +14,12 @@ def check_overrides( overrides, fun_types ):
     Check all the overrides for direct type consistency
     """
     for overridden_method in overrides.keys():
-        overridden_direct_type = direct_type(
-                fun_types.get( overridden_method, set() ) )
+        overridden_direct_type = fun_types.get(
+                overridden_method, NO_TYPE )[ 0 ]
 
         for overrider_method in overrides[ overridden_method ]:
-            overrider_direct_type = direct_type(
-                    fun_types.get( overrider_method, set() ) )
+            overrider_direct_type = fun_types.get(
+                    overrider_method, NO_TYPE )[ 0 ]
 
             if overridden_direct_type != overrider_direct_type:
                 yield OverrideViolation( overridden_method,
@@ -1,148 +1,247 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import logging
 import pdb
-import time
+import multiprocessing
+import contextlib
 from itertools import chain
 from pprint import pprint, pformat
 from collections import defaultdict
 from optparse import OptionParser
 import rules
 import scrapers
-import ast_helpers
-from call_tree import build_call_tree, merge_call_trees
+import summary
+import compile_db
+import watch
+import output
+import instrument
+import summary_file
+import query
+import pipeline
+from tags import TagTable, QualifiedTypes
+from summary_cache import SummaryCache
 from type_augmentor import augment_types
 from assignment_checker import check_assignments
 from overrides_checker import check_overrides
-from rule_checker import check_rules
+from rule_checker import check_rules, aggregate_rule_violations, PathCounter
 
 logging.basicConfig( filename="dbg_output", filemode="w", level=logging.DEBUG )
 
-def scrape_all_files( files, ext_types, options ):
-    call_subtrees = []
-    override_subtrees = []
-    cursor_subsets = []
-    func_type_subsets = []
-    funcptr_type_subsets = []
-    assignment_subsets = []
-
-    tu_time = 0.0
-    start_time = time.time()
-
-    for fname in files:
-        overrideScraper = scrapers.Overrides()
-        cursorScraper = scrapers.FunctionCursors()
-        funcTypeScraper = scrapers.FunctionQualifiers()
-        funPtrTypeScraper = scrapers.FunctionPointers()
-        assScraper = scrapers.FunPtrAssignments()
-
-        pre_tu_time = time.time()
-        target = ast_helpers.get_translation_unit( fname, options )
-
-        logging.info( "Translation unit: " + str( target.spelling ) )
-        #ast_helpers.dump_ast( target.cursor, lambda x: logging.debug(x) )
-
-        tu_time += time.time() - pre_tu_time
-
-        scrapers.run_scrapers( target.cursor, 
-                [ overrideScraper, cursorScraper,
-                  funcTypeScraper, funPtrTypeScraper,
-                  assScraper ] )
-
-        call_subtrees.append(
-                build_call_tree( target ) )
-        override_subtrees.append(
-                overrideScraper.get() )
-        cursor_subsets.append(
-                cursorScraper.get() )
-        func_type_subsets.append(
-                funcTypeScraper.get() )
-        funcptr_type_subsets.append(
-                funPtrTypeScraper.get() )
-        assignment_subsets.append(
-                assScraper.get() )
-
-    call_tree = merge_call_trees(
-            call_subtrees )
-    overrides = scrapers.Overrides.merge(
-            override_subtrees )
-    cursors = scrapers.FunctionCursors.merge(
-            cursor_subsets )
-    func_types = scrapers.FunctionQualifiers.merge(
-            func_type_subsets + [ ext_types ] )
-    funcptr_types = scrapers.FunctionPointers.merge(
-            funcptr_type_subsets )
-    assignments = scrapers.FunPtrAssignments.merge(
-            assignment_subsets )
-
-    call_tree.augment_with_overrides( overrides )
-
-    pre_augment_time = time.time()
-    aug_func_types = augment_types( call_tree, funcptr_types, func_types )
-    post_augment_time = time.time()
-
-    standard_funcs = set( [ key for key in func_types.keys() ] )
-
-    all_func_types = scrapers.merge_disjoint_dicts( 
-            [ aug_func_types, funcptr_types ] )
-
-    end_time = time.time()
-
-    if options.show_time:
-        print( "time to parse: {:0.5f} seconds".format( tu_time ) )
-        print( "time to scrape stuff: {:0.5f} seconds".format( 
-               end_time - start_time - tu_time ) )
-        print( "time to infer indirect type: {:0.5f} seconds".format(
-               post_augment_time - pre_augment_time ) )
+def summarize_files( jobs, options, cache=None ):
+    """
+    Parse and scrape the file of every CompileJob and yield one
+    TranslationUnitSummary per job, in the order given.  With -j, files are
+    parsed by a pool of worker processes.  Jobs with an up to date entry in
+    |cache| are not parsed at all.  The declarations of a header are only
+    scraped by the first translation unit (per process) that includes it.
+    """
+    # Every entry is loaded up front, so that the headers they carry are
+    # known before any file is parsed, and dropped as soon as it is yielded
+    cached = {}
+    if cache:
+        for index, job in enumerate( jobs ):
+            tu_summary = cache.get( job.fname, job.args )
+            if tu_summary is not None:
+                cached[ index ] = tu_summary
+
+    to_parse = [ job for index, job in enumerate( jobs )
+                 if index not in cached ]
+
+    seen_headers = cache.loaded_headers if cache else set()
+
+    pool = None
+    if options.jobs <= 1 or len( to_parse ) <= 1:
+        registry = summary.HeaderRegistry( seen_headers )
+        parsed = (
+            summary.scrape_translation_unit( job, options, registry )
+            for job in to_parse )
+    else:
+        pool = multiprocessing.Pool(
+                options.jobs, summary.init_worker, ( seen_headers, ) )
+        parsed = pool.imap(
+                summary.scrape_translation_unit_detached,
+                [ ( job, options ) for job in to_parse ] )
+
+    for index, job in enumerate( jobs ):
+        if index in cached:
+            yield cached.pop( index )
+            continue
+
+        tu_summary = next( parsed )
+        sys.stdout.write( tu_summary.output )
+        if tu_summary.trace:
+            instrument.merge( tu_summary.trace )
+            tu_summary.trace = None
+
+        if cache:
+            cache.put( job.fname, job.args, tu_summary )
+
+        yield tu_summary
+
+    if pool:
+        pool.close()
+        pool.join()
+
+def get_compile_jobs( files, options ):
+    """
+    Determine what to parse.  With -p, the jobs come from the compilation
+    database.  Otherwise every file on the command line is parsed with the
+    arguments given by -x, -std, -I and -f.
+    """
+    if options.compile_db:
+        return compile_db.load_compile_commands(
+                options.compile_db, files, options.file_filters )
+
+    return compile_db.jobs_from_files( files, options )
+
+def scrape_all_files( jobs, ext_types, options ):
+    cache = None
+    if options.cache_dir:
+        cache = SummaryCache( options.cache_dir )
+
+    # Each summary is folded into the program as soon as it is available
+    # and dropped right after
+    accumulator = summary.ProgramAccumulator()
+    for tu_summary in summarize_files( jobs, options, cache ):
+        if options.verbose:
+            print( "{}: {} cursors visited, {} dispatched to scrapers".format(
+                tu_summary.fname, tu_summary.cursors_visited,
+                tu_summary.cursors_dispatched ) )
+        with instrument.span( 'merge', file=tu_summary.fname ):
+            accumulator.add( tu_summary )
+
+    if cache:
+        instrument.count( 'cache_hits', cache.hits )
+        instrument.count( 'cache_misses', cache.misses )
+
+    return build_program_model( accumulator, ext_types, options )
+
+def build_program_model( summaries, ext_types, options, headers=None ):
+    """
+    Merge translation unit summaries into the whole-program model that the
+    checkers run against: a tuple of ( call_tree, all_func_types, cursors,
+    assignments, standard_funcs, overrides ).  |summaries| is a list of
+    summaries or a summary.ProgramAccumulator they were already added to.
+    """
+    with instrument.span( 'merge', translation_units=len( summaries ) ):
+        ( call_tree,
+          overrides,
+          cursors,
+          func_types,
+          funcptr_types,
+          assignments ) = summary.merge_summaries(
+                  summaries, ext_types, headers )
+
+        call_tree = call_tree.freeze()
+        edges = call_tree.size()
+        call_tree.augment_with_overrides( overrides )
+
+        tag_table = TagTable()
+        func_types = tag_table.encode( func_types )
+        funcptr_types = tag_table.encode( funcptr_types )
+
+    instrument.count( 'usrs', len( call_tree.usrs ) )
+    instrument.count( 'edges', call_tree.size() )
+    instrument.count( 'override_expansions', call_tree.size() - edges )
+
+    with instrument.span( 'augment' ):
+        aug_func_types = augment_types( call_tree, funcptr_types, func_types )
+
+        standard_funcs = set( [ key for key in func_types.keys() ] )
+
+        all_func_types = QualifiedTypes( tag_table,
+                scrapers.merge_disjoint_dicts(
+                    [ aug_func_types, funcptr_types ] ) )
+
+    instrument.count( 'functions', len( all_func_types ) )
+
+    if options.analysis_file:
+        with instrument.span( 'save_analysis' ):
+            query.write_analysis( options.analysis_file, call_tree,
+                                  all_func_types, cursors, overrides )
 
     return ( call_tree, all_func_types, cursors, assignments, standard_funcs,
              overrides )
 
+def get_violations_early( files, tagsfile, options, emit ):
+    """
+    get_violations, through the asynchronous pipeline: the violations that
+    are certain before every file is parsed are passed to |emit| along the
+    way (see pipeline)
+    """
+    ext_types, type_rules = rules.load_rules_file( tagsfile,
+                                                   options.cache_dir )
+    checker = pipeline.EarlyChecker( type_rules, ext_types )
+
+    # Qualified types are not final until every file is merged, so early
+    # violations are described without them
+    def on_summary( tu_summary ):
+        checker.add_summary( tu_summary )
+        for violation in checker.take():
+            emit( violation, checker.cursors, None )
+
+    cache = None
+    if options.cache_dir:
+        cache = SummaryCache( options.cache_dir )
+
+    accumulator = summary.ProgramAccumulator()
+    pipeline.summarize_files( get_compile_jobs( files, options ), options,
+                              accumulator, cache, on_summary )
+
+    model = build_program_model( accumulator, ext_types, options )
+    cursors, types, violations = check_program_model(
+            model, type_rules, options )
+    return cursors, types, checker.remaining( violations, options.max_paths )
+
 def get_violations( files, tagsfile, options ):
 
-    ext_types, type_rules = rules.parse_rules_file( tagsfile )
+    ext_types, type_rules = rules.load_rules_file( tagsfile,
+                                                   options.cache_dir )
+
+    model = scrape_all_files(
+            get_compile_jobs( files, options ), ext_types, options )
 
-    pre_file_parse = time.time()
+    return check_program_model( model, type_rules, options )
+
+def check_program_model( model, type_rules, options ):
+    """
+    Run every checker over the whole-program |model| built by
+    build_program_model.  Returns a tuple of ( cursors, all_func_types,
+    violations ).  Violations are produced lazily; the time spent producing
+    them is recorded as they are consumed.
+    """
     ( call_tree,
       all_func_types,
       cursors,
       assignments,
       standard_funcs,
-      overrides ) = scrape_all_files( files, ext_types, options )
-    post_file_parse = time.time()
+      overrides ) = model
 
     rule_violations = check_rules(
-            call_tree, all_func_types, type_rules, standard_funcs )
-    post_rule_checking = time.time()
-
-    assignment_violations = check_assignments(
-            assignments, all_func_types )
-    post_assignment_checking = time.time()
-
-    override_violations = check_overrides(
-            overrides, all_func_types )
-    post_overrides_checking = time.time()
-
-    if options.show_time:
-        print( "Time to parse files: {:0.3f} Seconds".format(
-            post_file_parse - pre_file_parse ) )
-        print( "Time to check graph rules: {:0.5f} Seconds".format(
-            post_rule_checking - post_file_parse ) )
-        print( "Time to check assignments: {:0.5f} Seconds".format(
-            post_assignment_checking - post_rule_checking ) )
-        print( "Time to check overrides: {:0.5f} Seconds".format(
-            post_overrides_checking - post_assignment_checking ) )
-        print( "Functions examined (includes libraries and ptrs): {}".format(
-            len( all_func_types ) ) )
-        print( "Calls examined: {}".format( call_tree.size() ) )
+            call_tree, all_func_types, type_rules, standard_funcs,
+            options.max_paths )
+    if options.aggregate:
+        rule_violations = aggregate_rule_violations(
+                rule_violations,
+                PathCounter( call_tree, all_func_types, standard_funcs ),
+                options.first_hops )
+
+    assignment_violations = instrument.timed(
+            'assignment_check',
+            check_assignments( assignments, all_func_types ) )
+
+    override_violations = instrument.timed(
+            'override_check',
+            check_overrides( overrides, all_func_types ) )
 
     return ( cursors, all_func_types,
              chain( assignment_violations,
                     rule_violations,
                     override_violations ) )
 
-def parse_args():
+def build_option_parser():
     parser = OptionParser()
 
     parser.add_option( "-t", "--tags-file", dest="tags_file",
@@ -170,33 +269,278 @@ def parse_args():
                               + "(for multiple flags, enclose in quotes)"),
                        metavar="FLAGS", default=None )
 
+    parser.add_option( "-p", "--build-path", dest="compile_db",
+                       help=( "Directory containing compile_commands.json.  "
+                              + "Each file is parsed with the arguments in "
+                              + "the compilation database.  If files are "
+                              + "also given, only those files are parsed." ),
+                       metavar="DIR", default=None )
+
+    parser.add_option( "--filter", dest="file_filters", action="append",
+                       help=( "With -p, only parse files matching this glob.  "
+                              + "May be given more than once." ),
+                       metavar="GLOB", default=None )
+
+    parser.add_option( "--max-paths-per-violation", dest="max_paths",
+                       type="int",
+                       help=( "Number of call paths to report for each "
+                              + "function that is indirectly called from a "
+                              + "restricted context (shortest first).  "
+                              + "0 reports every path." ),
+                       metavar="K", default=1 )
+
+    parser.add_option( "--aggregate", action="store_true", dest="aggregate",
+                       help=( "Report each restrict_indirect_call "
+                              + "violation once per root caller and "
+                              + "offending callee, with the number of "
+                              + "paths between them and the shortest one" ),
+                       default=False )
+
+    parser.add_option( "--first-hops", action="store_true",
+                       dest="first_hops",
+                       help=( "With --aggregate, also list the functions "
+                              + "the root caller calls first on those "
+                              + "paths" ),
+                       default=False )
+
     parser.add_option( "-v", action="store_true", dest="verbose",
                        help="Verbose mode makes more dbg output",
                        default=False )
 
+    parser.add_option( "-j", "--jobs", dest="jobs", type="int",
+                       help=( "Number of translation units to parse in "
+                              + "parallel" ),
+                       metavar="N", default=1 )
+
+    parser.add_option( "--cache-dir", dest="cache_dir",
+                       help=( "Directory in which to cache the scrape results "
+                              + "of each translation unit.  Unchanged "
+                              + "translation units are not parsed again." ),
+                       metavar="DIR", default=None )
+
+    parser.add_option( "--format", dest="format", type="choice",
+                       choices=sorted( output.WRITERS.keys() ),
+                       help=( "Output format for violations: text, jsonl "
+                              + "(one JSON object per line) or sarif.  "
+                              + "With jsonl and sarif, everything else "
+                              + "is printed to stderr." ),
+                       metavar="FORMAT", default="text" )
+
+    parser.add_option( "--early", action="store_true", dest="early",
+                       help=( "Parse in worker processes while merging "
+                              + "what has been parsed so far, and report "
+                              + "restrict_indirect_call violations as soon "
+                              + "as they are certain" ),
+                       default=False )
+
+    parser.add_option( "--watch", action="store_true", dest="watch",
+                       help=( "Keep running, reparse translation units as "
+                              + "their files change and print violations "
+                              + "that appear or are resolved" ),
+                       default=False )
+
+    parser.add_option( "--save-analysis", dest="analysis_file",
+                       help=( "Save the whole-program analysis to FILE "
+                              + "for funqual query" ),
+                       metavar="FILE", default=None )
+
     parser.add_option( "--time", action="store_true", dest="show_time",
                        help="Output execution time for different phases of prgm",
                        default=False )
 
+    parser.add_option( "--trace", dest="trace_file",
+                       help=( "Write the time spent in every phase, "
+                              + "translation unit and rule to FILE in the "
+                              + "Chrome trace event format (load it in "
+                              + "chrome://tracing or Perfetto)" ),
+                       metavar="FILE", default=None )
+
+    parser.add_option( "--metrics", dest="metrics_file",
+                       help=( "Write the time spent in every phase and the "
+                              + "counters collected to FILE as JSON" ),
+                       metavar="FILE", default=None )
+
+    return parser
+
+def parse_args():
+    parser = build_option_parser()
+
     ( options, files ) = parser.parse_args()
 
     if len( sys.argv ) == 1:
         parser.print_help( sys.stderr )
         sys.exit( 0 )
 
+    if options.early and options.aggregate:
+        parser.error( "--early can't be combined with --aggregate" )
+    if options.aggregate and options.max_paths != 1:
+        parser.error( "--aggregate counts every path itself and can't be "
+                      "combined with --max-paths-per-violation" )
+    if options.watch and options.format != 'text':
+        parser.error( "--watch prints the violations that appear or are "
+                      "resolved as text and can't be combined with "
+                      "--format" )
+
     return ( options, files )
 
+def write_violations( options, find_violations ):
+    """
+    Call |find_violations|, which returns a tuple of ( cursors,
+    all_func_types, violations ), and write the violations in the format
+    chosen with --format.  Then report the instrumentation asked for.
+    |find_violations| is passed a function taking ( violation, cursors,
+    all_func_types ) to write violations it finds along the way.
+    """
+    writer = output.WRITERS[ options.format ]( sys.stdout )
+
+    # Keep the machine readable output free of anything else
+    chatter = sys.stdout if options.format == 'text' else sys.stderr
+
+    with contextlib.redirect_stdout( chatter ):
+        writer.begin()
+        cursors, types, violations = find_violations( writer.write )
+
+        for violation in violations:
+            writer.write( violation, cursors, types )
+        writer.end()
+
+        if options.show_time:
+            print( instrument.recorder.report() )
+
+    if options.trace_file:
+        instrument.write_chrome_trace( options.trace_file )
+    if options.metrics_file:
+        instrument.write_json( options.metrics_file )
+
+def compile_main( argv ):
+    """
+    funqual compile: scrape translation units into summary files (see
+    summary_file) instead of checking them
+    """
+    parser = build_option_parser()
+    parser.set_usage( "%prog compile [options] FILE... [-o OUTPUT]" )
+
+    parser.add_option( "-o", dest="output_file",
+                       help=( "Write the summary to FILE.  Only allowed "
+                              + "with a single file; otherwise the summary "
+                              + "of foo.cpp is written to foo.fq" ),
+                       metavar="FILE", default=None )
+
+    parser.add_option( "--deps", action="store_true", dest="write_deps",
+                       help=( "Also write OUTPUT.d, a Makefile fragment "
+                              + "listing every file the summary depends on" ),
+                       default=False )
+
+    ( options, files ) = parser.parse_args( argv )
+
+    jobs = get_compile_jobs( files, options )
+    if not jobs:
+        parser.error( "no input files" )
+    if options.output_file and len( jobs ) > 1:
+        parser.error( "-o can only be used with a single file" )
+
+    output_files = []
+    sources = {}
+    for job in jobs:
+        output_file = options.output_file or (
+                os.path.splitext( os.path.basename( job.fname ) )[ 0 ]
+                + '.fq' )
+
+        # a/util.cpp and b/util.cpp would overwrite each other's summary
+        if output_file in sources:
+            parser.error( "{} and {} would both be written to {}; "
+                          "compile them one at a time with -o".format(
+                                  sources[ output_file ], job.fname,
+                                  output_file ) )
+        sources[ output_file ] = job.fname
+        output_files.append( output_file )
+
+    for job, output_file in zip( jobs, output_files ):
+        # A summary file has to carry every header it depends on
+        tu_summary = summary.scrape_translation_unit(
+                job, options, summary.HeaderRegistry() )
+
+        summary_file.write_summary( output_file, job, tu_summary )
+        if options.write_deps:
+            summary_file.write_dep_file( output_file + '.d', output_file,
+                                         job, tu_summary )
+
+def link_main( argv ):
+    """
+    funqual link: merge the summary files written by funqual compile and
+    check the whole program
+    """
+    parser = build_option_parser()
+    parser.set_usage( "%prog link [options] FILE.fq..." )
+
+    ( options, files ) = parser.parse_args( argv )
+
+    if not files:
+        parser.error( "no summary files" )
+
+    summaries = []
+    for fname in files:
+        try:
+            summaries.append( summary_file.read_summary( fname ) )
+        except ( OSError, ValueError ) as e:
+            parser.error( str( e ) )
+
+    def find_violations( emit ):
+        ext_types, type_rules = rules.load_rules_file( options.tags_file,
+                                                       options.cache_dir )
+        model = build_program_model( summaries, ext_types, options )
+        return check_program_model( model, type_rules, options )
+
+    write_violations( options, find_violations )
+
+def query_main( argv ):
+    """
+    funqual query: answer questions about an analysis saved with
+    --save-analysis (see query)
+    """
+    parser = OptionParser( usage=(
+            "%prog query ANALYSIS QUERY ARG...\n\n"
+            "Queries:\n"
+            "  callers FUNC, callees FUNC, overriders FUNC, tags FUNC,\n"
+            "  tagged TAG, reaches FUNC [TAG], why FUNC (FUNC | tag:TAG)" ) )
+
+    ( options, args ) = parser.parse_args( argv )
+    if len( args ) < 2:
+        parser.error( "expected an analysis file and a query" )
+
+    try:
+        analysis = query.read_analysis( args[ 0 ] )
+        lines = query.run_query( analysis, args[ 1 ], args[ 2 : ] )
+    except ( OSError, ValueError, query.QueryError ) as e:
+        parser.error( str( e ) )
+
+    for line in lines:
+        print( line )
+
+COMMANDS = {
+    'compile': compile_main,
+    'link': link_main,
+    'query': query_main,
+}
+
 def main():
+    if len( sys.argv ) > 1 and sys.argv[ 1 ] in COMMANDS:
+        COMMANDS[ sys.argv[ 1 ] ]( sys.argv[ 2: ] )
+        return
+
     options, files = parse_args()
 
-    cursors, types, violations = get_violations(
-            files, options.tags_file, options )
+    if options.watch:
+        watch.Watcher( get_compile_jobs( files, options ), options ).run()
+        return
+
+    if options.early:
+        write_violations( options, lambda emit: get_violations_early(
+                files, options.tags_file, options, emit ) )
+        return
 
-    for violation in violations:
-        print(
-                violation.render_string(
-                    cursors, types ) )
-        print()
+    write_violations( options, lambda emit: get_violations(
+            files, options.tags_file, options ) )
 
 if __name__ == '__main__':
     main()
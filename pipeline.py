@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+"""
+Asynchronous run of funqual (--early).  Translation units are parsed and
+scraped by a pool of worker processes driven from an asyncio event loop.
+Each summary is folded into a partial program (an EarlyChecker) as soon as
+it arrives, so the violations that are already certain are reported while
+the rest of the program is still being parsed.  Once every translation
+unit is in, the whole program is merged and checked as usual, and the
+violations that were reported early are not reported again.
+
+Only restrict_indirect_call violations are reported early.  Merging more
+translation units only ever adds calls and direct tags, so once a function
+tagged with the caller tag can reach a function directly tagged with the
+callee tag, the final check is bound to find that pair as well.  Every
+other check can be undone by a translation unit that has not arrived yet:
+a require_call violation or an override violation disappears when a later
+redeclaration adds the missing tag, and an indirect type is only known
+once the whole call tree is.  Those are left to the final check.
+"""
+
+import sys
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import summary
+import instrument
+from rules import RuleRestrictIndirectCall
+from violation import RuleViolation
+from scrapers import AnnotationKind
+from tag_patterns import ExternalTags
+
+
+class EarlyChecker( object ):
+    """
+    A partial program, built from the summaries merged so far: the calls
+    between functions, their direct tags and their records.  For the
+    callee tag of each restrict_indirect_call rule, it keeps every function
+    known to reach a function with that tag directly, along with the next
+    step on the way there.  Calls and tags are only ever added, so each
+    function is marked once and the marks are propagated up the callers
+    as they appear.
+    """
+    def __init__( self, type_rules, ext_types ):
+        self.rules = defaultdict( list )
+        for rule in type_rules:
+            if isinstance( rule, RuleRestrictIndirectCall ):
+                self.rules[ rule.callee_tag ].append( rule )
+
+        self.patterns = None
+        if isinstance( ext_types, ExternalTags ):
+            self.patterns = ext_types.patterns
+        self.calls = defaultdict( set )
+        self.callers = defaultdict( set )
+        self.tags = defaultdict( set )
+        self.cursors = {}
+        self.seen = set()
+
+        # callee tag -> function -> next step towards a tagged function
+        self.reach = dict( [ ( tag, {} ) for tag in self.rules ] )
+
+        # ( rule, caller, callee ) -> path of every violation reported early
+        self.emitted = {}
+        self.found = []
+
+        for usr, annotations in ext_types.items():
+            self.add_annotations( usr, annotations )
+
+    def add_summary( self, tu_summary ):
+        """
+        Fold |tu_summary| and the header summaries it carries into the
+        partial program
+        """
+        for part in list( tu_summary.headers.values() ) + [ tu_summary ]:
+            self.cursors.update( part.cursors )
+            for usr, annotations in part.func_types.items():
+                self.match_patterns( usr )
+                self.add_annotations( usr, annotations )
+            for usr, annotations in part.funcptr_types.items():
+                self.add_annotations( usr, annotations )
+            for caller, callees in part.call_tree.tree.items():
+                for callee in callees:
+                    self.add_call( caller, callee )
+
+    def add_annotations( self, usr, annotations ):
+        for kind, tag in annotations:
+            if kind == AnnotationKind.DIRECT:
+                self.add_tag( usr, tag )
+
+    def match_patterns( self, usr ):
+        """
+        Match the tag patterns of the rules file against a newly declared
+        function.  Functions that are only called so far, which may turn
+        out to be function pointers, are left to the final check.
+        """
+        if usr in self.seen:
+            return
+        self.seen.add( usr )
+        if self.patterns:
+            for tag in self.patterns.match( usr ):
+                self.add_tag( usr, tag )
+
+    def add_tag( self, usr, tag ):
+        if tag in self.tags[ usr ]:
+            return
+        self.tags[ usr ].add( tag )
+
+        # |usr| is now a function the callers of which reach |tag|
+        if tag in self.reach:
+            for caller in list( self.callers[ usr ] ):
+                self.mark( tag, caller, usr )
+
+        # |usr| may now be the caller of a rule
+        for callee_tag, reach in self.reach.items():
+            if usr in reach:
+                self.report( callee_tag, usr )
+
+    def add_call( self, caller, callee ):
+        if callee in self.calls[ caller ]:
+            return
+        self.calls[ caller ].add( callee )
+        self.callers[ callee ].add( caller )
+
+        for tag, reach in self.reach.items():
+            if tag in self.tags[ callee ] or callee in reach:
+                self.mark( tag, caller, callee )
+
+    def mark( self, tag, usr, step ):
+        """
+        Record that |usr| reaches a function tagged |tag| through |step|,
+        and so do all of its callers
+        """
+        reach = self.reach[ tag ]
+        if usr in reach:
+            return
+        reach[ usr ] = step
+
+        queue = [ usr ]
+        while queue:
+            curr = queue.pop()
+            self.report( tag, curr )
+            for caller in self.callers[ curr ]:
+                if caller not in reach:
+                    reach[ caller ] = curr
+                    queue.append( caller )
+
+    def report( self, tag, usr ):
+        """
+        Report the rules with callee tag |tag| that |usr| violates
+        """
+        for rule in self.rules[ tag ]:
+            if rule.caller_tag not in self.tags[ usr ]:
+                continue
+
+            path = [ usr, self.reach[ tag ][ usr ] ]
+            while tag not in self.tags[ path[ -1 ] ]:
+                path.append( self.reach[ tag ][ path[ -1 ] ] )
+
+            # The final check never reports a caller reaching itself, and
+            # can't render functions nobody has declared yet
+            key = ( str( rule ), usr, path[ -1 ] )
+            if ( path[ -1 ] == usr or key in self.emitted or
+                 any( [ func not in self.cursors for func in path ] ) ):
+                continue
+
+            self.emitted[ key ] = path
+            self.found.append( RuleViolation( rule, path ) )
+
+    def take( self ):
+        """
+        Return the violations found since the last call
+        """
+        found, self.found = self.found, []
+        return found
+
+    def remaining( self, violations, max_paths=1 ):
+        """
+        Yield the violations of the final check that were not reported
+        early.  The final check reports the same pairs of functions, each
+        with up to |max_paths| paths.  The path reported early takes the
+        place of the first (shortest) of them, or is one of them when every
+        path is reported.
+        """
+        replaced = set()
+        for violation in violations:
+            if isinstance( violation, RuleViolation ):
+                key = ( str( violation.rule ), violation.call_path[ 0 ],
+                        violation.call_path[ -1 ] )
+                if ( key in self.emitted and key not in replaced and
+                     ( max_paths or
+                       violation.call_path == self.emitted[ key ] ) ):
+                    replaced.add( key )
+                    continue
+            yield violation
+
+
+def summarize_files( jobs, options, accumulator, cache=None,
+                     on_summary=None ):
+    """
+    Like parse.summarize_files, except that the files are always parsed
+    by worker processes (at least one, so that parsing overlaps with
+    merging) and that |on_summary| is called with each summary as soon as
+    it is available.  Each summary is then folded into |accumulator|, a
+    summary.ProgramAccumulator, once every summary before it in |jobs| has
+    been, so that the program does not depend on which file is parsed
+    first.  Only the summaries that arrived ahead of their turn are kept.
+    """
+    asyncio.run( summarize_files_async( jobs, options, accumulator, cache,
+                                        on_summary ) )
+
+
+async def summarize_files_async( jobs, options, accumulator, cache=None,
+                                 on_summary=None ):
+    # Summaries waiting for the ones before them, by index in |jobs|
+    waiting = {}
+    next_index = 0
+
+    def arrived( index, tu_summary ):
+        nonlocal next_index
+        if on_summary:
+            on_summary( tu_summary )
+
+        waiting[ index ] = tu_summary
+        while next_index in waiting:
+            tu_summary = waiting.pop( next_index )
+            with instrument.span( 'merge', file=tu_summary.fname ):
+                accumulator.add( tu_summary )
+            next_index += 1
+
+    to_parse = []
+    for index, job in enumerate( jobs ):
+        tu_summary = cache.get( job.fname, job.args ) if cache else None
+        if tu_summary is None:
+            to_parse.append( index )
+        else:
+            arrived( index, tu_summary )
+    tu_summary = None
+
+    if not to_parse:
+        return
+
+    seen_headers = cache.loaded_headers if cache else set()
+    loop = asyncio.get_running_loop()
+
+    async def parse( executor, index ):
+        return index, await loop.run_in_executor(
+                executor, summary.scrape_translation_unit_detached,
+                ( jobs[ index ], options ) )
+
+    with ProcessPoolExecutor( max( 1, min( options.jobs, len( to_parse ) ) ),
+                              initializer=summary.init_worker,
+                              initargs=( seen_headers, ) ) as executor:
+        for parsed in asyncio.as_completed(
+                [ parse( executor, index ) for index in to_parse ] ):
+            index, tu_summary = await parsed
+
+            sys.stdout.write( tu_summary.output )
+            if tu_summary.trace:
+                instrument.merge( tu_summary.trace )
+                tu_summary.trace = None
+
+            if cache:
+                cache.put( jobs[ index ].fname, jobs[ index ].args,
+                           tu_summary )
+
+            arrived( index, tu_summary )
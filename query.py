@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+Questions about a whole-program analysis that has already been run.
+`--save-analysis FILE` writes the merged call tree (with overrides expanded),
+the augmented qualified types, the function records and the class hierarchy
+to FILE.  `funqual query FILE QUERY...` loads it back, builds its indexes
+once and answers:
+
+    callers FUNC        functions that call FUNC
+    callees FUNC        functions FUNC calls
+    overriders FUNC     methods that override FUNC
+    tags FUNC           the direct tags of FUNC and the tags it reaches
+    tagged TAG          functions directly tagged TAG
+    reaches FUNC [TAG]  functions that can reach FUNC (only those tagged TAG)
+    why FUNC TARGET     the shortest call path from FUNC to TARGET, which
+                        is a function or tag:TAG for any function tagged TAG
+
+FUNC is a USR or a qualified name: Bar, Foo::Bar or Foo::Bar(int).
+
+An analysis file starts with MAGIC and the format version (shared with the
+summary files, see summary_file), followed by the pickled analysis.
+"""
+
+import os
+import pickle
+from collections import defaultdict, deque
+from summary_file import VERSION
+from summary_cache import CACHE_VERSION
+from ast_helpers import get_human_name
+
+MAGIC = b'FQANALYS'
+
+# Prefix of a `why` target naming a tag rather than a function
+TAG_PREFIX = "tag:"
+
+
+class QueryError( Exception ):
+    pass
+
+
+def write_analysis( path, call_tree, func_types, cursors, overrides ):
+    """
+    Atomically write the whole-program analysis to |path|
+    """
+    tmp_path = "{}.{}.tmp".format( path, os.getpid() )
+    with open( tmp_path, 'wb' ) as f:
+        f.write( MAGIC )
+        f.write( VERSION.pack( CACHE_VERSION ) )
+        pickle.dump( ( call_tree, func_types, cursors, overrides ), f,
+                     pickle.HIGHEST_PROTOCOL )
+    os.replace( tmp_path, path )
+
+
+def read_analysis( path ):
+    """
+    Load the analysis written to |path| by write_analysis.  Raises
+    ValueError if |path| is not an analysis file or was written by another
+    version of funqual.
+    """
+    with open( path, 'rb' ) as f:
+        header = f.read( len( MAGIC ) + VERSION.size )
+        if ( len( header ) != len( MAGIC ) + VERSION.size or
+             not header.startswith( MAGIC ) ):
+            raise ValueError( "{}: not a funqual analysis file".format( path ) )
+
+        version, = VERSION.unpack_from( header, len( MAGIC ) )
+        if version != CACHE_VERSION:
+            raise ValueError(
+                    "{}: analysis file version {} (expected {}), "
+                    "save it again".format( path, version, CACHE_VERSION ) )
+
+        return Analysis( *pickle.load( f ) )
+
+
+def qualified_names( record ):
+    """
+    Every name |record| may be looked up by: its display name with and
+    without its parameters, qualified by any number of its parents
+    """
+    parts = []
+    if record.parent_name is not None:
+        parts = record.parent_name.split( "::" )
+
+    names = []
+    for displayname in set( [ record.displayname,
+                              record.displayname.split( "(" )[ 0 ] ] ):
+        for index in range( len( parts ) + 1 ):
+            names.append( "::".join( parts[ index : ] + [ displayname ] ) )
+    return names
+
+
+class Analysis( object ):
+    """
+    A saved whole-program analysis and the indexes used to query it
+    """
+    def __init__( self, call_tree, func_types, cursors, overrides ):
+        self.call_tree = call_tree
+        self.func_types = func_types
+        self.cursors = cursors
+        self.overrides = overrides
+
+        self.names = defaultdict( set )
+        for usr, record in cursors.items():
+            for name in qualified_names( record ):
+                self.names[ name ].add( usr )
+
+        self.tagged = defaultdict( set )
+        for usr, ( direct, _ ) in func_types.items():
+            for tag in func_types.table.names_of( direct ):
+                self.tagged[ tag ].add( usr )
+
+    def resolve( self, name ):
+        """
+        Return the USRs of the functions called |name|.  Raises QueryError
+        if there are none.
+        """
+        if ( name in self.cursors or name in self.func_types or
+             self.call_tree.index( name ) is not None ):
+            return [ name ]
+
+        usrs = self.names.get( name )
+        if not usrs:
+            raise QueryError( "no function called {}".format( name ) )
+        return sorted( usrs )
+
+    def human_name( self, usr ):
+        if usr in self.cursors:
+            return get_human_name( self.cursors[ usr ] )
+        return usr
+
+    def callers( self, usr ):
+        return sorted( self.call_tree.callers( usr ) )
+
+    def callees( self, usr ):
+        return sorted( self.call_tree.calls( usr ) )
+
+    def overriders( self, usr ):
+        return sorted( self.overrides.get( usr, () ) )
+
+    def tags( self, usr ):
+        """
+        Return the ( direct, reachable ) tags of |usr|.  The reachable
+        tags are the indirect type worked out by augment_types.
+        """
+        return ( sorted( self.func_types.direct_names( usr ) ),
+                 sorted( self.func_types.indirect_names( usr ) ) )
+
+    def functions_tagged( self, tag ):
+        return sorted( self.tagged.get( tag, () ) )
+
+    def reaching( self, usr, tag=None ):
+        """
+        Return the functions that can reach |usr|, or only those directly
+        tagged |tag|
+        """
+        result = self.call_tree.reaching( [ usr ] )
+        result.discard( usr )
+        if tag is not None:
+            result &= self.tagged.get( tag, set() )
+        return sorted( result )
+
+    def why( self, usr, targets ):
+        """
+        Return the shortest call path from |usr| to one of |targets|, or
+        None if there is none
+        """
+        call_tree = self.call_tree
+        start = call_tree.index( usr )
+        if start is None:
+            return None
+
+        goals = set( [ call_tree.index( target ) for target in targets ] )
+        parents = { start: None }
+        queue = deque( [ start ] )
+        while queue:
+            curr = queue.popleft()
+            if curr in goals and curr != start:
+                path = []
+                while curr is not None:
+                    path.append( call_tree.usrs[ curr ] )
+                    curr = parents[ curr ]
+                path.reverse()
+                return path
+
+            for callee in call_tree.callees_of( curr ):
+                if callee not in parents:
+                    parents[ callee ] = curr
+                    queue.append( callee )
+
+        return None
+
+
+def resolve_one( analysis, name ):
+    usrs = analysis.resolve( name )
+    if len( usrs ) > 1:
+        raise QueryError( "{} is ambiguous, use one of:\n  {}".format(
+                name, "\n  ".join( usrs ) ) )
+    return usrs[ 0 ]
+
+
+def run_query( analysis, query, args ):
+    """
+    Answer the query |query| with the arguments |args|.  Returns the lines
+    to print.  Raises QueryError if the query can't be answered.
+    """
+    def names( usrs ):
+        return [ analysis.human_name( usr ) for usr in usrs ]
+
+    def expect( count, optional=0 ):
+        if not count <= len( args ) <= count + optional:
+            raise QueryError( "{} takes {} argument(s)".format(
+                    query, count ) )
+
+    if query in [ 'callers', 'callees', 'overriders' ]:
+        expect( 1 )
+        return names( getattr( analysis, query )(
+                resolve_one( analysis, args[ 0 ] ) ) )
+
+    if query == 'tags':
+        expect( 1 )
+        direct, reachable = analysis.tags( resolve_one( analysis, args[ 0 ] ) )
+        return [ "direct: " + " ".join( direct ),
+                 "reaches: " + " ".join( reachable ) ]
+
+    if query == 'tagged':
+        expect( 1 )
+        return names( analysis.functions_tagged( args[ 0 ] ) )
+
+    if query == 'reaches':
+        expect( 1, 1 )
+        return names( analysis.reaching( resolve_one( analysis, args[ 0 ] ),
+                                         *args[ 1 : ] ) )
+
+    if query == 'why':
+        expect( 2 )
+        if args[ 1 ].startswith( TAG_PREFIX ):
+            targets = analysis.functions_tagged(
+                    args[ 1 ][ len( TAG_PREFIX ) : ] )
+        else:
+            targets = analysis.resolve( args[ 1 ] )
+
+        path = analysis.why( resolve_one( analysis, args[ 0 ] ), targets )
+        if path is None:
+            return []
+        return [ names( path )[ 0 ] ] + [ "  -calls: " + name
+                                          for name in names( path[ 1 : ] ) ]
+
+    raise QueryError( "unknown query {}".format( query ) )
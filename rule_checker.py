@@ -1,17 +1,188 @@
 #!/usr/bin/env python3
 
 import sys
-from violation import RuleViolation
+from collections import defaultdict
+import instrument
+from rules import RuleIndex, RuleRestrictIndirectCall
+from violation import RuleViolation, AggregatedRuleViolation
+from type_augmentor import condense
 
 
-def check_rules( call_tree, func_types, rules, standard_funcs ):
+def check_rules( call_tree, func_types, rules, standard_funcs, max_paths=1 ):
     """
     Given a program call tree, a mapping from function to its type, and
-    a set of rules, apply each rule and return all the rule violations
+    a set of rules, apply each rule and return all the rule violations.
+    |max_paths| limits the number of witness paths reported for each
+    violating pair of functions (0 for no limit).
+
+    The rules are evaluated through a RuleIndex, which finds the callers of
+    every rule in one pass over |func_types|.  The time spent building it
+    and the time spent on each rule are recorded as `rule_check` spans.
+    """
+    with instrument.span( 'rule_check', rule='index' ):
+        index = RuleIndex( rules, func_types )
+
+    for position, rule in enumerate( index.rules ):
+        yield from instrument.timed(
+                'rule_check',
+                index.check( position, call_tree, func_types,
+                             standard_funcs, max_paths ),
+                rule=str( rule ) )
+
+
+class LiveCallTree( object ):
+    """
+    The part of |call_tree| made of the functions in |live|
+    """
+    def __init__( self, call_tree, live ):
+        self.call_tree = call_tree
+        self.live = live
+
+    def calls( self, caller ):
+        return [ callee for callee in self.call_tree.calls( caller )
+                 if callee in self.live ]
+
+
+class PathCounter( object ):
+    """
+    Counts the call paths from a root caller to each offending function of
+    a restrict_indirect_call rule.  The functions that can reach an
+    offender (see RuleRestrictIndirectCall.prepare) are condensed into
+    their strongly connected components once per callee tag, and the paths
+    from a root are counted over that acyclic graph by one pass in
+    topological order.  Functions that call each other recursively count
+    as a single step, so each path is counted once however many times it
+    could go around a cycle.  Without recursion, this is the number of
+    paths --max-paths-per-violation 0 lists, without listing them.
+
+    The counts from the last root asked about are kept, since the
+    violations of one root come one after the other.
+    """
+    def __init__( self, call_tree, func_types, standard_funcs ):
+        self.call_tree = call_tree
+        self.func_types = func_types
+        self.standard_funcs = standard_funcs
+        self.graphs = {}
+        self.last = None
+        self.counts = None
+
+    def graph( self, rule ):
+        """
+        Return ( component_of, components, successors ) for the functions
+        that can reach an offender of |rule|.  Components are numbered
+        callees first, so every component calls into lower numbers only.
+        """
+        key = rule.callee_key()
+        if key not in self.graphs:
+            live = LiveCallTree( self.call_tree, rule.prepare(
+                    self.call_tree, self.func_types, self.standard_funcs ) )
+
+            component_of = {}
+            components = []
+            successors = []
+            for component in condense( live, live.live ):
+                component_id = len( components )
+                for member in component:
+                    component_of[ member ] = component_id
+
+                components.append( component )
+                successors.append( set( [
+                    component_of[ callee ]
+                    for member in component
+                    for callee in live.calls( member )
+                    if component_of[ callee ] != component_id ] ) )
+
+            self.graphs[ key ] = ( component_of, components, successors )
+        return self.graphs[ key ]
+
+    def count_from( self, rule, root, first_hops ):
+        """
+        Return ( paths, hops ): the number of paths from |root| to every
+        component it reaches and, with |first_hops|, the functions |root|
+        calls first on those paths
+        """
+        component_of, components, successors = self.graph( rule )
+        start = component_of[ root ]
+
+        reached = set( [ start ] )
+        to_visit = [ start ]
+        while to_visit:
+            for successor in successors[ to_visit.pop() ]:
+                if successor not in reached:
+                    reached.add( successor )
+                    to_visit.append( successor )
+
+        paths = dict.fromkeys( reached, 0 )
+        paths[ start ] = 1
+        for component in sorted( reached, reverse=True ):
+            for successor in successors[ component ]:
+                paths[ successor ] += paths[ component ]
+
+        hops = defaultdict( set )
+        if first_hops:
+            # The callees of |root| in its own component can go on through
+            # any other member of the component
+            for callee in self.call_tree.calls( root ):
+                if component_of.get( callee ) == start and callee != root:
+                    hops[ start ].add( callee )
+
+            for member in components[ start ]:
+                for callee in self.call_tree.calls( member ):
+                    component = component_of.get( callee, start )
+                    if component == start:
+                        continue
+                    if member == root:
+                        hops[ component ].add( callee )
+                    else:
+                        hops[ component ] |= hops[ start ]
+
+            for component in sorted( reached, reverse=True ):
+                if component != start:
+                    for successor in successors[ component ]:
+                        hops[ successor ] |= hops[ component ]
+
+        return paths, hops
+
+    def count( self, rule, root, offender, first_hops=False ):
+        """
+        Return the number of paths from |root| to |offender|, and the set
+        of the functions |root| calls first on them (or None without
+        |first_hops|)
+        """
+        key = ( rule.callee_key(), root, first_hops )
+        if self.last != key:
+            self.last = key
+            self.counts = self.count_from( rule, root, first_hops )
+
+        paths, hops = self.counts
+        component = self.graph( rule )[ 0 ][ offender ]
+        return ( paths[ component ],
+                 set( hops[ component ] ) if first_hops else None )
+
+
+def aggregate_rule_violations( violations, counter, first_hops=False ):
+    """
+    Replace each restrict_indirect_call violation in |violations| by an
+    AggregatedRuleViolation for the same rule, root caller and offending
+    callee, with the number of paths between them counted by |counter|, a
+    PathCounter.  The violations are expected to carry the shortest path
+    of each pair (--max-paths-per-violation 1), so every pair is yielded
+    once, as soon as it is found.  With |first_hops|, the functions the
+    root calls on the way to the callee are listed as well.  Any other
+    violation, including a require_call violation, which is a single call,
+    is passed through.
     """
-    for rule in rules:
-        yield from rule.check( call_tree, func_types, standard_funcs )
+    for violation in violations:
+        if ( not isinstance( violation, RuleViolation ) or
+             not isinstance( violation.rule, RuleRestrictIndirectCall ) ):
+            yield violation
+            continue
 
+        path = violation.call_path
+        path_count, hops = counter.count(
+                violation.rule, path[ 0 ], path[ -1 ], first_hops )
+        yield AggregatedRuleViolation( violation.rule, path, path_count,
+                                       hops )
 
 if __name__ == '__main__':
     import scrapers
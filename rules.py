@@ -1,14 +1,141 @@
-from collections import defaultdict 
+import os
+import pickle
+import hashlib
+from collections import defaultdict, deque
 from ast_helpers import get_human_name
 from violation import RuleViolation
 from scrapers import AnnotationKind
+from tags import NO_TYPE
+from tag_patterns import ExternalTags, TagPatterns, is_pattern
+from summary_cache import CACHE_VERSION
+
+# Bump whenever the same rules file is parsed differently
+RULES_VERSION = 2
 
 
 class Rule( object ):
-    def check( self, call_tree, func_tags, standard_funcs ):
+    """
+    A rule applies to every function directly tagged with |caller_tag|.
+    Subclasses implement paths_from(), which yields the call paths from
+    one such caller that violate the rule.  The paths only depend on the
+    kind of rule and its |callee_tag|, which lets RuleIndex share them
+    between rules, along with whatever prepare() computes.
+    """
+    def check( self, call_tree, func_tags, standard_funcs, max_paths=1 ):
+        return RuleIndex( [ self ], func_tags ).check(
+                0, call_tree, func_tags, standard_funcs, max_paths )
+
+    def callee_key( self ):
+        """
+        Rules with the same key find the same paths from the same caller
+        """
+        return ( type( self ), self.callee_tag )
+
+    def prepare( self, call_tree, func_tags, standard_funcs ):
+        """
+        Work done once for every rule with the same callee_key(), before
+        any caller is checked.  The result is handed to paths_from().
+        """
+        return None
+
+    def paths_from( self, caller, call_tree, func_tags, standard_funcs,
+                    max_paths, prepared=None ):
         raise NotImplementedError( "Child class should override this" )
 
 
+class RuleIndex( object ):
+    """
+    Evaluates a list of rules together.  The callers of every rule are
+    found in a single pass over |func_tags|: each function is dispatched
+    only to the rules whose caller tag bit it has.  Rules with the same
+    callee_key() share the callee side work: when a function is a caller
+    for several of them, the paths from it are searched once and reported
+    for each rule, and prepare() is only run once for all of them.
+    """
+    def __init__( self, rules, func_tags ):
+        self.rules = list( rules )
+        self.callers = [ [] for rule in self.rules ]
+
+        by_bit = defaultdict( list )
+        for index, rule in enumerate( self.rules ):
+            by_bit[ func_tags.table.bit( rule.caller_tag ) ].append( index )
+
+        mask = 0
+        for bit in by_bit:
+            mask |= bit
+
+        for func, ( direct, _ ) in func_tags.items():
+            hits = direct & mask
+            while hits:
+                bit = hits & -hits
+                hits ^= bit
+                for index in by_bit[ bit ]:
+                    self.callers[ index ].append( func )
+
+        # How many rules still have to report the paths from a caller.
+        # Only callers shared by rules with the same key are listed.
+        users = defaultdict( int )
+        for index, rule in enumerate( self.rules ):
+            for func in self.callers[ index ]:
+                users[ ( rule.callee_key(), func ) ] += 1
+
+        self.users = dict( [ ( key, count )
+                             for key, count in users.items()
+                             if count > 1 ] )
+        self.paths = {}
+
+        # What prepare() returned for each callee_key(), kept until every
+        # rule with that key has been checked
+        self.prepared = {}
+        self.pending = defaultdict( int )
+        for index, rule in enumerate( self.rules ):
+            if self.callers[ index ]:
+                self.pending[ rule.callee_key() ] += 1
+
+    def check( self, index, call_tree, func_tags, standard_funcs,
+               max_paths=1 ):
+        """
+        Yield the violations of the rule at |index|.  The paths shared
+        with other rules are kept until the last of them has used them.
+        """
+        rule = self.rules[ index ]
+        if not self.callers[ index ]:
+            return
+
+        if rule.callee_key() not in self.prepared:
+            self.prepared[ rule.callee_key() ] = rule.prepare(
+                    call_tree, func_tags, standard_funcs )
+        prepared = self.prepared[ rule.callee_key() ]
+
+        self.pending[ rule.callee_key() ] -= 1
+        if not self.pending[ rule.callee_key() ]:
+            del self.prepared[ rule.callee_key() ]
+
+        for caller in self.callers[ index ]:
+            key = ( rule.callee_key(), caller )
+            if key not in self.users:
+                for path in rule.paths_from( caller, call_tree, func_tags,
+                                             standard_funcs, max_paths,
+                                             prepared ):
+                    yield RuleViolation( rule, path )
+                continue
+
+            paths = self.paths.get( key )
+            if paths is None:
+                paths = list( rule.paths_from( caller, call_tree, func_tags,
+                                               standard_funcs, max_paths,
+                                               prepared ) )
+                self.paths[ key ] = paths
+
+            self.users[ key ] -= 1
+            if not self.users[ key ]:
+                del self.users[ key ]
+                del self.paths[ key ]
+
+            for path in paths:
+                yield RuleViolation( rule, path )
+
+
 class RuleRestrictIndirectCall( Rule ):
     def __init__( self, caller_tag, callee_tag, message="" ):
         self.caller_tag = caller_tag
@@ -24,43 +151,136 @@ class RuleRestrictIndirectCall( Rule ):
                     self.callee_tag,
                     self.caller_tag )
 
-    def check( self, call_tree, func_tags, standard_funcs ):
-        caller_funcs = set()
-        for caller_func, caller_tags in func_tags.items():
-            if self.caller_tag in direct_type( caller_tags ):
-                caller_funcs.add( caller_func )
+    def prepare( self, call_tree, func_tags, standard_funcs ):
+        """
+        One reverse traversal from every offending function marks the
+        functions that can reach one.  Only those are worth searching:
+        callers that are not marked cannot violate the rule at all.
+        """
+        callee_bit = func_tags.table.bit( self.callee_tag )
+
+        offenders = [ func for func in func_tags
+                      if self._is_offender( func, func_tags, standard_funcs,
+                                            callee_bit ) ]
+
+        return call_tree.reaching( offenders )
+
+    def paths_from( self, caller, call_tree, func_tags, standard_funcs,
+                    max_paths, prepared=None ):
+        """
+        Yield the paths from |caller| to functions with |callee_tag|.  For
+        each offending callee, up to |max_paths| witness paths are
+        reported, shortest first.  If |max_paths| is 0, every simple path
+        is reported.  |prepared| is the set of functions that can reach an
+        offender (see prepare()); the search never leaves it.
+        """
+        callee_bit = func_tags.table.bit( self.callee_tag )
+        if prepared is None:
+            prepared = self.prepare( call_tree, func_tags, standard_funcs )
+
+        if caller not in prepared:
+            return
 
-        for caller_func in caller_funcs:
-            for callee_func in call_tree.calls( caller_func ):
+        if max_paths:
+            yield from self._find_witnesses( caller, call_tree, func_tags,
+                                             standard_funcs, callee_bit,
+                                             max_paths, prepared )
+            return
+
+        for callee_func in call_tree.calls( caller ):
+            if callee_func in prepared:
                 yield from self._check_func( callee_func, call_tree,
-                                             func_tags,
-                                             [ caller_func ],
-                                             standard_funcs )
+                                             func_tags, [ caller ],
+                                             standard_funcs, callee_bit,
+                                             prepared )
 
-    def _check_func( self, curr, call_tree, func_tags,
-                     path, standard_funcs ):
-        if curr in standard_funcs:
-            # curr is a standard func and not a funcptr
-            # then we ignore indirect type
-            if self.callee_tag in direct_type( func_tags.get( curr, set() ) ):
-                yield RuleViolation( self,
-                                     path + [ curr ] )
-        else:
-            # curr is a funptr so we do look at indirect type
-            if ( self.callee_tag in direct_type( func_tags.get( curr, set() ) )
-                 or
-                 self.callee_tag in indirect_type(
-                     func_tags.get( curr, set() ) ) ):
-                yield RuleViolation( self,
-                                     path + [ curr ] )
+    def _is_offender( self, func, func_tags, standard_funcs, callee_bit ):
+        """
+        Check whether calling |func| counts as calling a |callee_tag|
+        function.  Indirect type is only considered for function pointers.
+        """
+        direct, indirect = func_tags.get( func, NO_TYPE )
+        if direct & callee_bit:
+            return True
+
+        return bool( indirect & callee_bit ) and func not in standard_funcs
+
+    def _find_witnesses( self, caller, call_tree, func_tags,
+                         standard_funcs, callee_bit, max_paths, live ):
+        """
+        Breadth first search from |caller| through the functions in
+        |live|.  Every function may be reached by at most |max_paths|
+        distinct paths, so each offending callee is reported with at most
+        |max_paths| of its shortest witness paths.  Paths are kept as
+        ( func, parent path ) links rather than copied lists.
+        """
+        visits = defaultdict( int )
+        queue = deque( [ ( callee, ( caller, None ) )
+                         for callee in call_tree.calls( caller )
+                         if callee in live ] )
+
+        while queue:
+            path = queue.popleft()
+            curr = path[ 0 ]
+
+            if visits[ curr ] >= max_paths:
+                continue
+            visits[ curr ] += 1
 
+            if self._is_offender( curr, func_tags, standard_funcs,
+                                  callee_bit ):
+                yield unlink_path( path )
+
+            for callee_func in call_tree.calls( curr ):
+                if ( callee_func == caller or
+                     callee_func not in live or
+                     visits[ callee_func ] >= max_paths ):
+                    continue
+                if max_paths > 1 and path_contains( path, callee_func ):
+                    continue
+                queue.append( ( callee_func, path ) )
+
+    def _check_func( self, curr, call_tree, func_tags,
+                     path, standard_funcs, callee_bit, live ):
+        """
+        Enumerate every simple path from the caller at the start of |path|
+        through the functions in |live|
+        """
+        if self._is_offender( curr, func_tags, standard_funcs, callee_bit ):
+            yield path + [ curr ]
 
         for callee_func in call_tree.calls( curr ):
-            if callee_func not in path:
+            if callee_func in live and callee_func not in path:
                 yield from self._check_func( callee_func, call_tree,
                                              func_tags,
                                              path + [ curr ],
-                                             standard_funcs )
+                                             standard_funcs, callee_bit,
+                                             live )
+
+
+def unlink_path( path ):
+    """
+    Turn a linked ( func, parent path ) path into a list, caller first
+    """
+    result = []
+    while path:
+        result.append( path[ 0 ] )
+        path = path[ 1 ]
+
+    result.reverse()
+    return result
+
+
+def path_contains( path, func ):
+    """
+    Check whether the linked ( func, parent path ) path visits |func|
+    """
+    while path:
+        if path[ 0 ] == func:
+            return True
+        path = path[ 1 ]
+
+    return False
 
 
 class RuleRequireCall( Rule ):
@@ -82,18 +302,13 @@ class RuleRequireCall( Rule ):
                     self.caller_tag,
                     self.callee_tag )
 
-    def check( self, call_tree, func_tags, standard_funcs ):
-        to_check = []
-        for func, tags in func_tags.items():
-            if self.caller_tag in direct_type( tags ):
-                to_check.append( func )
+    def paths_from( self, caller, call_tree, func_tags, standard_funcs,
+                    max_paths, prepared=None ):
+        callee_bit = func_tags.table.bit( self.callee_tag )
 
-        for caller_func in to_check:
-            for callee_func in call_tree.calls( caller_func ):
-                if ( self.callee_tag not in
-                     direct_type( func_tags[ callee_func ] ) ):
-                    yield RuleViolation( self,
-                                         [ caller_func, callee_func ] )
+        for callee_func in call_tree.calls( caller ):
+            if not func_tags.get( callee_func, NO_TYPE )[ 0 ] & callee_bit:
+                yield [ caller, callee_func ]
 
 
 def idx_or_default( arr, idx, default ):
@@ -110,17 +325,23 @@ def idx_or_default( arr, idx, default ):
 def parse_rules_file( filename ):
     """
     Given a rules file, parse out all the rule definitions and external
-    function taggings
+    function taggings.  The taggings are returned as ExternalTags: `tag`
+    lines whose USR is a pattern (see tag_patterns) are kept apart from
+    the exact ones.
     """
     tags = defaultdict(lambda: set())
+    patterns = TagPatterns()
     rules = []
 
     with open( filename, "r" ) as tagsFile:
         for line in tagsFile:
             line = line.split( " " )
             if line[ 0 ] == "tag":
-                tags[ line[ 1 ] ].add(
-                        (AnnotationKind.DIRECT, line[ 2 ].strip() ) )
+                if is_pattern( line[ 1 ] ):
+                    patterns.add( line[ 1 ], line[ 2 ].strip() )
+                else:
+                    tags[ line[ 1 ] ].add(
+                            (AnnotationKind.DIRECT, line[ 2 ].strip() ) )
             elif line[ 0 ] == "rule":
                 if line[ 1 ] == "restrict_indirect_call":
                     rules.append(
@@ -135,20 +356,36 @@ def parse_rules_file( filename ):
                 else:
                     print( "Could not interpret line: {0}".format( line ) )
 
-    return dict( tags ), rules
+    return ExternalTags( tags, patterns ), rules
 
 
-def direct_type( types ):
-    return set( [
-        name
-        for ( kind, name )
-        in types
-        if kind == AnnotationKind.DIRECT ] )
+def load_rules_file( filename, cache_dir=None ):
+    """
+    parse_rules_file( filename ), cached in |cache_dir| (if given) under
+    the hash of the contents of the rules file so that large rules files
+    are only parsed and compiled once
+    """
+    if not cache_dir:
+        return parse_rules_file( filename )
+
+    with open( filename, "rb" ) as tagsFile:
+        digest = hashlib.sha256( "{}.{}".format(
+                CACHE_VERSION, RULES_VERSION ).encode() + b'\0' )
+        digest.update( tagsFile.read() )
+
+    path = os.path.join( cache_dir, 'rules', digest.hexdigest() + '.fqr' )
+    try:
+        with open( path, 'rb' ) as f:
+            return pickle.load( f )
+    except ( OSError, EOFError, pickle.UnpicklingError ):
+        pass
+
+    result = parse_rules_file( filename )
 
+    os.makedirs( os.path.dirname( path ), exist_ok=True )
+    tmp_path = "{}.{}.tmp".format( path, os.getpid() )
+    with open( tmp_path, 'wb' ) as f:
+        pickle.dump( result, f, pickle.HIGHEST_PROTOCOL )
+    os.replace( tmp_path, path )
 
-def indirect_type( types ):
-    return set( [
-        name
-        for ( kind, name )
-        in types
-        if kind == AnnotationKind.INDIRECT ] )
+    return result
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import sys
-from clang.cindex import CursorKind
+from clang.cindex import CursorKind, SourceRange
 from ast_helpers import get_translation_unit, is_function_pointer
+from ast_helpers import has_function_pointer_type
+from ast_helpers import LocationRecord
 from collections import defaultdict
 
 class AnnotationKind:
@@ -62,15 +64,22 @@ def merge_overlapping_dicts( dicts ):
     result = {}
 
     for mapping in dicts:
-        for key, value in mapping.items():
-            if key in result and result[ key ] != value:
-                raise Exception(
-                        "Key `{}` maps to both `{}` and `{}`".format(
-                            key, value, result[ key ] ) )
-            result[ key ] = value
+        merge_overlapping_into( result, mapping )
 
     return result
 
+def merge_overlapping_into( result, mapping ):
+    """
+    Merge |mapping| into |result| in place.  Keys they share must map to
+    the same value.
+    """
+    for key, value in mapping.items():
+        if key in result and result[ key ] != value:
+            raise Exception(
+                    "Key `{}` maps to both `{}` and `{}`".format(
+                        key, value, result[ key ] ) )
+        result[ key ] = value
+
 
 def sloppy_merge_dicts( dicts ):
     """
@@ -84,27 +93,135 @@ def sloppy_merge_dicts( dicts ):
 
     return result
 
-def run_scrapers( tu, scrapers ):
-    for trav in tu.walk_preorder():
+# Cursor kinds that start a new caller context for the calls beneath them
+CALLER_KINDS = frozenset( [
+    CursorKind.FUNCTION_DECL,
+    CursorKind.CXX_METHOD,
+    CursorKind.CONSTRUCTOR,
+    CursorKind.DESTRUCTOR,
+] )
+
+
+class Traversal( object ):
+    """
+    A single preorder walk over a translation unit shared by all scrapers.
+    Every scraper lists the cursor kinds it cares about in |kinds| and its
+    scrape( trav, context ) method is only called for cursors of those
+    kinds.  The traversal is passed as |context| and memoizes the USR of
+    the current cursor and of the enclosing function so that scrapers do
+    not ask libclang for the same USR twice.  Scrapers keep LocationRecords
+    rather than cursors, so the translation unit can be disposed of as
+    soon as the traversal is done.
+    """
+    def __init__( self, scrapers ):
+        self.dispatch = {}
         for scraper in scrapers:
-            scraper.scrape( trav )
+            for kind in scraper.kinds:
+                self.dispatch.setdefault( kind, [] ).append( scraper )
+
+        self.visited = 0
+        self.dispatched = 0
+        self.parent_names = {}
+
+        self.kind = None
+        self._node = None
+        self._usr = None
+        self._caller = None
+        self._children = None
+
+    def usr( self ):
+        """
+        USR of the cursor currently being scraped
+        """
+        if self._usr is None:
+            self._usr = self._node.get_usr()
+        return self._usr
+
+    def children( self ):
+        """
+        Children of the cursor currently being scraped.  The traversal
+        needs them anyway, so they are only listed once.
+        """
+        return self._children
+
+    def record( self, node ):
+        """
+        LocationRecord of the declaration |node|.  The qualified names of
+        semantic parents are shared by every record made in this traversal.
+        """
+        return LocationRecord.from_cursor( node, self.parent_names )
+
+    def caller_usr( self ):
+        """
+        USR of the function enclosing the current cursor, or `_start` for
+        cursors outside of any function
+        """
+        if self._caller is None:
+            return '_start'
+        if self._caller[ 1 ] is None:
+            self._caller[ 1 ] = self._caller[ 0 ].get_usr()
+        return self._caller[ 1 ]
+
+    def run( self, root ):
+        stack = [ ( root, None ) ]
+
+        while stack:
+            node, caller = stack.pop()
+            kind = node.kind
+            self.visited += 1
+
+            if kind in CALLER_KINDS:
+                # [ cursor, memoized usr ] shared with every descendant
+                caller = [ node, None ]
+
+            children = list( node.get_children() )
+
+            scrapers = self.dispatch.get( kind )
+            if scrapers:
+                self.dispatched += 1
+                self.kind = kind
+                self._node = node
+                self._usr = None
+                self._caller = caller
+                self._children = children
+
+                for scraper in scrapers:
+                    scraper.scrape( node, self )
+
+                if caller is not None and caller[ 0 ] is node:
+                    caller[ 1 ] = self._usr
+
+            children.reverse()
+            stack.extend( [ ( child, caller ) for child in children ] )
+
+
+def run_scrapers( tu, scrapers ):
+    """
+    Run every scraper over the cursor |tu| in a single pass.  Returns the
+    Traversal so its counters can be inspected.
+    """
+    traversal = Traversal( scrapers )
+    traversal.run( tu )
+    return traversal
 
 class FunctionPointers:
+    kinds = [ CursorKind.VAR_DECL ]
+
     def __init__( self ):
         self.funptrs = {}
 
-    def scrape( self, trav ):
+    def scrape( self, trav, context ):
         """
         Given a node in a tu, scrape a mapping of function pointers to their
         qualified types
         """
-        if trav.kind == CursorKind.VAR_DECL:
-            self.funptrs[ trav.get_usr() ] = get_qualifiers( trav )
+        self.funptrs[ context.usr() ] = get_qualifiers( trav )
 
     def get( self ):
         return self.funptrs
 
     merge = merge_overlapping_dicts
+    merge_into = merge_overlapping_into
 
 
 class FunctionQualifiers():
@@ -112,33 +229,43 @@ class FunctionQualifiers():
     Contains helper methods for scraping the function qualifiers out of
     a set of translation units
     """
+    kinds = [ CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD ]
+
     def __init__( self ):
         self.func_tags = defaultdict( lambda: set() )
 
-    def scrape( self, trav ):
+    def scrape( self, trav, context ):
         """
         Given a node in a tu, scrape a mapping of function/methods to their
         qualified types (direct type only)
         """
+        full_name = context.usr()
+        qualifiers = get_qualifiers( trav )
 
-        if trav.kind in [ CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD ]:
-            full_name = trav.get_usr()
-            qualifiers = get_qualifiers( trav )
-
-            self.func_tags[ full_name ] |= qualifiers
+        self.func_tags[ full_name ] |= qualifiers
 
     def get( self ):
         return dict( self.func_tags )
 
     @staticmethod
     def merge( mappings ):
-        func_tags = defaultdict( lambda: set() )
+        func_tags = {}
 
         for mapping in mappings:
-            for symbol, qualifiers in mapping.items():
-                func_tags[ symbol ] |= qualifiers
+            FunctionQualifiers.merge_into( func_tags, mapping )
 
-        return dict( func_tags )
+        return func_tags
+
+    @staticmethod
+    def merge_into( func_tags, mapping ):
+        """
+        Merge the qualifiers in |mapping| into |func_tags| in place
+        """
+        for symbol, qualifiers in mapping.items():
+            if symbol in func_tags:
+                func_tags[ symbol ] |= qualifiers
+            else:
+                func_tags[ symbol ] = set( qualifiers )
 
 
 class FunctionCursors:
@@ -147,26 +274,26 @@ class FunctionCursors:
     set of translation units
     """
 
+    kinds = [ CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD,
+              CursorKind.VAR_DECL ]
+
     def __init__( self ):
         self.func_cursors = {}
 
-    def scrape( self, trav ):
+    def scrape( self, trav, context ):
         """
-        Given a node in a tu, scrape a mapping of function usr to the 
-        cannonical cursor (we need to be able to retrieve the cursor later
-        for error reporting)
+        Given a node in a tu, scrape a mapping of function usr to a record
+        of the cannonical cursor (we need to be able to report it later
+        for error reporting).  Every declaration of a function shares the
+        same canonical cursor so it is only recorded once.
         """
-        if trav.kind in [ CursorKind.FUNCTION_DECL, CursorKind.CXX_METHOD ]:
-            full_name = trav.get_usr()
-            cursor = trav.canonical
-
-            self.func_cursors[ full_name ] = cursor
-        if ( trav.kind in [ CursorKind.VAR_DECL ]
-             and is_function_pointer( trav ) ):
-            full_name = trav.get_usr()
-            cursor = trav.canonical
+        if ( context.kind == CursorKind.VAR_DECL and
+             not is_function_pointer( trav ) ):
+            return
 
-            self.func_cursors[ full_name ] = cursor
+        full_name = context.usr()
+        if full_name not in self.func_cursors:
+            self.func_cursors[ full_name ] = context.record( trav.canonical )
 
     def get( self ):
         return self.func_cursors
@@ -180,20 +307,19 @@ class Overrides:
     translation unit and merging together override mappings from
     multiple translation units.
     """
+    kinds = [ CursorKind.CXX_METHOD ]
+
     def __init__( self ):
-        self.overrides = defaultdict( lambda: set() )
+        self.overrides = defaultdict( set )
 
-    def scrape( self, trav ):
+    def scrape( self, trav, context ):
         """
         Scrape a translation unit and generate a mapping of methods to the 
-        methods that override them
+        methods that directly override them.  The transitive overriders
+        are worked out once for the whole program by a ClassHierarchy.
         """
-        if trav.kind == CursorKind.CXX_METHOD:
-            to_visit = list( trav.get_overridden_cursors() )
-            while to_visit:
-                overridden = to_visit.pop()
-                self.overrides[ overridden.get_usr() ].add( trav.get_usr() )
-                to_visit += list( overridden.get_overridden_cursors() )
+        for overridden in trav.get_overridden_cursors():
+            self.overrides[ overridden.get_usr() ].add( context.usr() )
 
     def get( self ):
         return self.overrides
@@ -206,69 +332,102 @@ class Overrides:
         result = defaultdict( lambda: set() )
 
         for override_map in override_maps:
-            for key, val in override_map.items():
-                result[ key ] |= val
+            Overrides.merge_into( result, override_map )
 
         return result
 
+    @staticmethod
+    def merge_into( result, override_map ):
+        """
+        Merge |override_map| into the defaultdict( set ) |result| in place
+        """
+        for key, val in override_map.items():
+            result[ key ] |= val
+
 
 class FunPtrAssignments:
     """
-    Scrapes the assignments of function pointers
+    Scrapes the assignments of function pointers, including the
+    initializers of function pointer variables
     """
     @classmethod
-    def get_operator( cls, binop_node ):
+    def is_assignment( cls, binop_node, lvalue, rvalue ):
         """
-        Cheap hack to get the binary operator out of a clang expression
-        because clang doesn't expose the binop interface to the python
-        api
+        Check whether the binary operator |binop_node| is a plain `=`.
+        Bindings that expose the operator kind are asked directly.
+        Otherwise only the tokens between the two operands are lexed; the
+        first of them is the operator.
         """
-        return [ x.spelling for x in binop_node.get_tokens() ][1]
-
+        operator = getattr( binop_node, 'binary_operator', None )
+        if operator is not None:
+            return operator.name == 'Assign'
 
-    @classmethod
-    def get_lvalue( cls, binop_node ):
-        "Cheap hack to get lvalue from binop expression"
-        return [ x for x in binop_node.get_children() ][ 0 ].referenced
-
-
-    @classmethod
-    def get_rvalue( cls, binop_node ):
-        "Cheap hack to get rvalue from binop expression"
-        return [ x for x in binop_node.get_children() ][ 1 ].referenced
+        for token in binop_node.translation_unit.get_tokens(
+                extent=SourceRange.from_locations(
+                    lvalue.extent.end, rvalue.extent.start ) ):
+            return token.spelling == '='
 
+        return False
 
     @classmethod
-    def is_lvalue_funptr( cls, binop_node ):
-        "Check whether the lvalue of this operation is a function pointer"
-
-        if '(*)' in cls.get_lvalue( binop_node ).type.spelling:
-            return True
-        else:
-            return False
+    def get_referenced( cls, expr ):
+        """
+        Return the declaration of the function (or function pointer) the
+        expression |expr| refers to, or None.  `&f` refers to `f` and
+        the result of a call is not the function being called.
+        """
+        if expr.kind == CursorKind.CALL_EXPR:
+            return None
+        if expr.kind == CursorKind.UNARY_OPERATOR:
+            operands = list( expr.get_children() )
+            if len( operands ) != 1:
+                return None
+            return cls.get_referenced( operands[ 0 ] )
+        return expr.referenced
 
+    kinds = [ CursorKind.BINARY_OPERATOR, CursorKind.VAR_DECL ]
 
     def __init__( self ):
         self.results = []
 
-    def scrape( self, trav ):
+    def scrape( self, trav, context ):
         """
         Scrape a single translation unit for all assignments into function
         pointers.  Grab usr so they can be typechecked.
         Return list of tuples in the following format:
-          ( lvalue usr, rvalue usr, cursor of assignment for error reporting )
+          ( lvalue usr, rvalue usr, record of assignment for error reporting )
+
+        Only expressions and variables of function pointer type are looked
+        at any further, which rules out almost every binary operator before
+        its children or tokens are needed.
         """
-        if ( trav.kind == CursorKind.BINARY_OPERATOR and
-             len( list( trav.get_children() ) ) == 2 ):
-            try:
-                if ( self.get_operator( trav ) == '=' and
-                     self.is_lvalue_funptr( trav ) ):
-                    self.results.append(
-                            ( self.get_lvalue( trav ).get_usr(),
-                              self.get_rvalue( trav ).get_usr(),
-                              trav.canonical ) )
-            except:
-                pass
+        if not has_function_pointer_type( trav ):
+            return
+
+        children = context.children()
+
+        if context.kind == CursorKind.VAR_DECL:
+            if not children or not children[ -1 ].kind.is_expression():
+                return
+            lvalue_usr = context.usr()
+            rvalue = self.get_referenced( children[ -1 ] )
+        else:
+            if len( children ) != 2:
+                return
+            lvalue, rvalue = children
+            if not self.is_assignment( trav, lvalue, rvalue ):
+                return
+            lvalue = lvalue.referenced
+            if lvalue is None:
+                return
+            lvalue_usr = lvalue.get_usr()
+            rvalue = self.get_referenced( rvalue )
+
+        if rvalue is None:
+            return
+
+        self.results.append(
+                ( lvalue_usr, rvalue.get_usr(), context.record( trav ) ) )
 
     def get( self ):
         return self.results
@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+
+"""
+Per translation unit summaries.  A summary holds everything that funqual
+scrapes out of a single translation unit: the call subtree, the qualifiers,
+the function pointer types, the overrides, the assignments and the cursors
+used for error reporting.  Summaries from several translation units are
+merged into the whole-program model that the checkers run against.
+"""
+
+import io
+import os
+import re
+import time
+import hashlib
+import logging
+import contextlib
+from itertools import chain
+from collections import defaultdict
+import scrapers
+import ast_helpers
+import instrument
+from clang.cindex import CursorKind
+from call_tree import CallTreeScraper, CallTree
+from class_hierarchy import ClassHierarchy
+from tag_patterns import expand_external_tags
+
+
+class TranslationUnitSummary( object ):
+    """
+    Everything scraped out of one translation unit.  |cursors| maps USRs to
+    LocationRecords and assignments carry LocationRecords too, so a summary
+    never references its translation unit.  It can be pickled, sent between
+    processes and kept long after the translation unit is gone.
+    """
+    def __init__( self, fname, call_tree, overrides, cursors, func_types,
+                  funcptr_types, assignments, includes=None,
+                  parse_time=0.0, output="", cursors_visited=0,
+                  cursors_dispatched=0, header_keys=None, headers=None,
+                  trace=None ):
+        self.fname = fname
+        self.call_tree = call_tree
+        self.overrides = overrides
+        self.cursors = cursors
+        self.func_types = func_types
+        self.funcptr_types = funcptr_types
+        self.assignments = assignments
+        self.includes = includes or []
+        self.parse_time = parse_time
+        self.output = output
+        self.cursors_visited = cursors_visited
+        self.cursors_dispatched = cursors_dispatched
+        self.header_keys = header_keys or []
+        self.headers = headers or {}
+        self.trace = trace
+
+
+class HeaderRegistry( object ):
+    """
+    Remembers which headers have already been scraped during a run so that
+    the declarations of a header shared by many translation units are only
+    scraped once.  A header is identified by its key, see header_keys().
+    """
+    def __init__( self, seen=() ):
+        self.seen = set( seen )
+        self.digests = {}
+        self.sources = {}
+        self.idents = {}
+
+    def source( self, fname ):
+        """
+        Return the contents of |fname|, or an empty string if it cannot be
+        read
+        """
+        if fname not in self.sources:
+            try:
+                with open( fname, 'rb' ) as f:
+                    self.sources[ fname ] = f.read()
+            except OSError:
+                self.sources[ fname ] = b''
+        return self.sources[ fname ]
+
+    def forget( self, fnames ):
+        """
+        Drop everything remembered about the contents of |fnames|, which
+        have changed on disk
+        """
+        for fname in fnames:
+            self.sources.pop( fname, None )
+            self.digests.pop( fname, None )
+            self.idents.pop( fname, None )
+
+    def identifiers( self, fname ):
+        """
+        Return the set of every identifier appearing in |fname|
+        """
+        if fname not in self.idents:
+            self.idents[ fname ] = set( [
+                ident.decode( 'latin-1' )
+                for ident
+                in set( IDENTIFIER_RE.findall( self.source( fname ) ) ) ] )
+        return self.idents[ fname ]
+
+    def file_digest( self, fname ):
+        if fname not in self.digests:
+            self.digests[ fname ] = hashlib.sha256(
+                    self.source( fname ) ).hexdigest()
+        return self.digests[ fname ]
+
+
+def cursor_file( cursor ):
+    """
+    Absolute path of the file |cursor| is located in, or None
+    """
+    location = cursor.location
+    if location.file is None:
+        return None
+    return os.path.abspath( location.file.name )
+
+
+# Anything that could name a macro
+IDENTIFIER_RE = re.compile( br'[A-Za-z_][A-Za-z_0-9]*' )
+
+
+def header_keys( tu, args, registry ):
+    """
+    Work out the key identifying the declarations of every header included
+    by |tu|: a hash of the clang arguments, of the path and contents of the
+    header and of every header it includes (transitively), and of the
+    relevant macro state.  Two translation units that agree on the key see
+    the same declarations in that header.
+
+    The relevant macro state of a header is the definition, at the point
+    where the header is first included, of every macro whose name appears
+    in the header or in any header it includes (and, transitively, in
+    those definitions).  Macros defined inside those headers come from
+    their contents, which are part of the key already.  Macros the headers
+    never mention cannot change their declarations, so translation units
+    that include a header in different orders still share it.  Headers
+    that are never reached through an #include (for example with -include)
+    see every macro in the translation unit.
+
+    Returns a function mapping the absolute path of a header to its key,
+    and the list of top level declarations of the translation unit.
+    """
+    # name -> [ ( position, cursor ) ] in the order they were defined
+    macros = {}
+    first_included = {}
+    # includer -> files it includes
+    included_by = defaultdict( set )
+    declarations = []
+    position = 0
+
+    for cursor in tu.cursor.get_children():
+        kind = cursor.kind
+        if kind == CursorKind.MACRO_DEFINITION:
+            macros.setdefault( cursor.spelling, [] ).append(
+                    ( position, cursor ) )
+            position += 1
+        elif kind == CursorKind.INCLUSION_DIRECTIVE:
+            try:
+                included = cursor.get_included_file()
+            except AssertionError:
+                # The bindings assert when the include was not found
+                continue
+            included = os.path.abspath( included.name )
+            first_included.setdefault( included, position )
+            included_by[ cursor_file( cursor ) ].add( included )
+        elif not kind.is_preprocessing():
+            declarations.append( cursor )
+
+    definitions = {}
+
+    def definition( cursor ):
+        """
+        Text of the macro definition |cursor|.  Builtin and command line
+        macros have no file, their values come from the arguments.
+        """
+        if cursor.hash not in definitions:
+            extent = cursor.extent
+            if extent.start.file is None:
+                definitions[ cursor.hash ] = b''
+            else:
+                definitions[ cursor.hash ] = registry.source(
+                        os.path.abspath( extent.start.file.name ) )[
+                        extent.start.offset:extent.end.offset ]
+        return definitions[ cursor.hash ]
+
+    def closure( fname ):
+        """
+        |fname| and every header it includes, directly or not
+        """
+        result = set( [ fname ] )
+        to_visit = [ fname ]
+        while to_visit:
+            for included in included_by.get( to_visit.pop(), () ):
+                if included not in result:
+                    result.add( included )
+                    to_visit.append( included )
+        return sorted( result )
+
+    def key( fname ):
+        point = first_included.get( fname, position )
+
+        digest = hashlib.sha256()
+        for arg in args:
+            digest.update( arg.encode() + b'\0' )
+
+        names = set()
+        for header in closure( fname ):
+            digest.update( header.encode() )
+            digest.update( b'\0' + registry.file_digest( header ).encode() )
+            digest.update( b'\0' )
+            names |= registry.identifiers( header )
+
+        relevant = {}
+        to_visit = list( names & macros.keys() )
+        while to_visit:
+            name = to_visit.pop()
+            if name in relevant:
+                continue
+
+            defined = [ cursor
+                        for defined_at, cursor in macros[ name ]
+                        if defined_at < point ]
+            if not defined:
+                relevant[ name ] = None
+                continue
+
+            relevant[ name ] = definition( defined[ -1 ] )
+            to_visit += [
+                ident.decode( 'latin-1' )
+                for ident in IDENTIFIER_RE.findall( relevant[ name ] )
+                if ident.decode( 'latin-1' ) in macros ]
+
+        for name, text in sorted( relevant.items() ):
+            if text is not None:
+                digest.update( b'\0' + name.encode() + b'=' + text )
+
+        return digest.hexdigest()
+
+    return key, declarations
+
+
+def make_scrapers():
+    """
+    Return a fresh list of every scraper, in the order summaries expect
+    """
+    return [ CallTreeScraper(),
+             scrapers.Overrides(),
+             scrapers.FunctionCursors(),
+             scrapers.FunctionQualifiers(),
+             scrapers.FunctionPointers(),
+             scrapers.FunPtrAssignments() ]
+
+
+def summarize_scrapers( fname, scraper_list, traversal, **kwargs ):
+    """
+    Build a TranslationUnitSummary from the scrapers built by
+    make_scrapers() once they have been run
+    """
+    return TranslationUnitSummary(
+            fname,
+            *[ scraper.get() for scraper in scraper_list ],
+            cursors_visited=traversal.visited,
+            cursors_dispatched=traversal.dispatched,
+            **kwargs )
+
+
+def scrape_translation_unit( job, options, registry=None ):
+    """
+    Parse the file of the CompileJob |job| and run all the scrapers over it.
+    Return the TranslationUnitSummary for it.  The translation unit is freed
+    as soon as it has been scraped.
+    """
+    pre_tu_time = time.time()
+    with instrument.span( 'parse', file=job.fname ):
+        target = ast_helpers.get_translation_unit(
+                job.fname, options, job.args )
+
+    parse_time = time.time() - pre_tu_time
+
+    return summarize_translation_unit( job, target, registry, parse_time )
+
+
+def summarize_translation_unit( job, target, registry=None, parse_time=0.0 ):
+    """
+    Run all the scrapers over |target|, the translation unit parsed for
+    the CompileJob |job|, and return its TranslationUnitSummary.
+
+    If a HeaderRegistry is given, top level declarations located in
+    headers are scraped into a separate summary per header, stored in the
+    |headers| of the result.  Headers the registry has already seen are
+    skipped altogether.  Either way the keys of every header the
+    translation unit depends on are listed in |header_keys|.  Everything
+    nested in a declaration of the main file (including headers included
+    inside a function or namespace) is scraped with the main file.
+
+    The time spent is recorded as a `scrape` span.
+    """
+    with instrument.span( 'scrape', file=job.fname ) as args:
+        tu_summary = run_scrapers( job, target, registry, parse_time )
+        args[ 'cursors_visited' ] = tu_summary.cursors_visited
+
+    instrument.count( 'cursors_visited', tu_summary.cursors_visited )
+    instrument.count( 'cursors_dispatched', tu_summary.cursors_dispatched )
+    return tu_summary
+
+
+def run_scrapers( job, target, registry, parse_time ):
+    """
+    The body of summarize_translation_unit
+    """
+    logging.info( "Translation unit: " + str( target.spelling ) )
+
+    includes = sorted( set( [
+        os.path.abspath( inclusion.include.name )
+        for inclusion
+        in target.get_includes() ] ) )
+
+    main_scrapers = make_scrapers()
+    traversal = scrapers.Traversal( main_scrapers )
+
+    if registry is None:
+        traversal.run( target.cursor )
+        logging.info( "Cursors visited: {}, dispatched: {}".format(
+            traversal.visited, traversal.dispatched ) )
+
+        return summarize_scrapers(
+                job.fname, main_scrapers, traversal,
+                includes=includes, parse_time=parse_time )
+
+    main_file = os.path.abspath( job.fname )
+    key_of, declarations = header_keys( target, job.args, registry )
+    keys = {}
+    header_scrapers = {}
+    skipped = 0
+
+    traversal.visited += 1
+    for cursor in declarations:
+        fname = cursor_file( cursor )
+        if fname is None or fname == main_file:
+            traversal.run( cursor )
+            continue
+
+        if fname not in keys:
+            keys[ fname ] = key_of( fname )
+            if keys[ fname ] not in registry.seen:
+                scraper_list = make_scrapers()
+                header_scrapers[ keys[ fname ] ] = (
+                        fname, scraper_list,
+                        scrapers.Traversal( scraper_list ) )
+
+        if keys[ fname ] in header_scrapers:
+            header_scrapers[ keys[ fname ] ][ 2 ].run( cursor )
+        else:
+            skipped += 1
+
+    headers = {}
+    for key, ( fname, scraper_list, header_traversal ) in (
+            header_scrapers.items() ):
+        registry.seen.add( key )
+        headers[ key ] = summarize_scrapers(
+                fname, scraper_list, header_traversal )
+        traversal.visited += header_traversal.visited
+        traversal.dispatched += header_traversal.dispatched
+
+    logging.info( "Cursors visited: {}, dispatched: {}, "
+                  "header declarations skipped: {}".format(
+                      traversal.visited, traversal.dispatched, skipped ) )
+    instrument.count( 'header_declarations_skipped', skipped )
+
+    return summarize_scrapers(
+            job.fname, main_scrapers, traversal,
+            includes=includes, parse_time=parse_time,
+            header_keys=sorted( set( keys.values() ) ),
+            headers=headers )
+
+
+# The HeaderRegistry of a worker process, set up by init_worker
+worker_registry = None
+
+
+def init_worker( seen ):
+    """
+    Worker process initializer.  |seen| holds the keys of the headers the
+    parent already has summaries for.
+    """
+    global worker_registry
+    worker_registry = HeaderRegistry( seen )
+
+
+def scrape_translation_unit_detached( work ):
+    """
+    Worker process entry point.  |work| is a tuple of ( job, options ).
+    Anything printed while parsing is captured into the summary so that
+    the parent can replay it in file order.  So are the instrumentation
+    events recorded while parsing.
+    """
+    job, options = work
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout( output ):
+        summary = scrape_translation_unit( job, options, worker_registry )
+
+    summary.output = output.getvalue()
+    summary.trace = instrument.take()
+    return summary
+
+
+def program_usrs( call_tree, cursors, variables=() ):
+    """
+    Yield every function USR the merged program knows about: each declared
+    function and each function calling or called by another, once each.
+    The USRs in |variables| (function pointers and other variables, which
+    are recorded and called too) are left out.
+    """
+    seen = set( variables )
+    for usr in cursors:
+        if usr not in seen:
+            seen.add( usr )
+            yield usr
+    for caller, callees in call_tree.tree.items():
+        for usr in chain( [ caller ], callees ):
+            if usr not in seen:
+                seen.add( usr )
+                yield usr
+
+
+class ProgramAccumulator( object ):
+    """
+    Folds translation unit summaries into the whole-program results one
+    at a time, in place, so that nothing of a summary but its assignments
+    has to be kept once it is added.  Call trees, overrides and qualifiers
+    are unions.  Two summaries giving a function pointer different types
+    is an error, raised as soon as the second one is added.  A function
+    declared by several summaries keeps the record of the first one.
+
+    The header summaries carried by the translation units are merged in as
+    well, right before the first translation unit that depends on them,
+    each one only once even if several translation units (parsed in
+    different processes) scraped it.  Header summaries kept apart from the
+    translation units that scraped them may be given in |headers|.
+    """
+    def __init__( self, headers=None ):
+        self.call_tree = CallTree()
+        self.overrides = defaultdict( set )
+        self.cursors = {}
+        self.func_types = {}
+        self.funcptr_types = {}
+        self.assignments = []
+
+        self.headers = dict( headers or {} )
+        self.merged_headers = set()
+        self.count = 0
+
+    def add( self, summary ):
+        """
+        Fold the translation unit |summary| into the program
+        """
+        for key, header in summary.headers.items():
+            if key not in self.merged_headers:
+                self.headers.setdefault( key, header )
+
+        for key in summary.header_keys:
+            if key in self.headers:
+                self.merge_part( self.headers.pop( key ) )
+                self.merged_headers.add( key )
+
+        self.merge_part( summary )
+        self.count += 1
+
+    def merge_part( self, part ):
+        for caller, callees in part.call_tree.tree.items():
+            self.call_tree.addAll( caller, callees )
+        scrapers.Overrides.merge_into( self.overrides, part.overrides )
+        scrapers.FunctionQualifiers.merge_into( self.func_types,
+                                                part.func_types )
+        scrapers.FunctionPointers.merge_into( self.funcptr_types,
+                                              part.funcptr_types )
+        for usr, record in part.cursors.items():
+            self.cursors.setdefault( usr, record )
+        self.assignments.extend( part.assignments )
+
+    def finish( self, ext_types ):
+        """
+        Add the external function types from the rules file (matching its
+        USR patterns against every function of the program) and return
+        a tuple of ( call_tree, overrides, cursors, func_types,
+        funcptr_types, assignments ), where |overrides| is a
+        ClassHierarchy.  The accumulator is emptied.
+        """
+        scrapers.FunctionQualifiers.merge_into(
+                self.func_types,
+                expand_external_tags(
+                    ext_types, program_usrs( self.call_tree, self.cursors,
+                                             self.funcptr_types ) ) )
+
+        result = ( self.call_tree, ClassHierarchy( self.overrides ),
+                   self.cursors, self.func_types, self.funcptr_types,
+                   self.assignments )
+
+        # Leave the results to the caller alone, so that the call tree
+        # can be freed as soon as it has been frozen
+        self.__init__()
+        return result
+
+    def __len__( self ):
+        return self.count
+
+
+def merge_summaries( summaries, ext_types, headers=None ):
+    """
+    Merge a list of translation unit summaries (plus the external function
+    types from the rules file, whose USR patterns are matched against every
+    function of the program) into whole-program results.  Returns a tuple
+    of ( call_tree, overrides, cursors, func_types, funcptr_types,
+    assignments ), where |overrides| is a ClassHierarchy.  See
+    ProgramAccumulator, which |summaries| may also be.
+    """
+    accumulator = summaries
+    if not isinstance( summaries, ProgramAccumulator ):
+        accumulator = ProgramAccumulator( headers )
+        for summary in summaries:
+            accumulator.add( summary )
+
+    return accumulator.finish( ext_types )
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""
+On-disk cache of translation unit summaries.  Users generally only change a
+few files between lintings, so the summary of every untouched translation
+unit is loaded from the cache instead of being parsed again.
+
+Each cache entry is identified by the file name and the clang arguments.
+The entry records every file the translation unit included when it was
+scraped, along with a hash of the contents of the main file, those
+includes, and the clang arguments.  An entry is only used when that hash
+still matches the files on disk.
+
+The summaries of shared headers are stored once, in headers/, named by the
+header key (see summary.header_keys) which already covers the contents of
+the header.  A translation unit entry is only used if every header it
+depends on can be loaded as well.
+"""
+
+import os
+import copy
+import pickle
+import hashlib
+
+# Bump whenever the layout of TranslationUnitSummary changes
+CACHE_VERSION = 6
+
+
+class SummaryCache( object ):
+    def __init__( self, cache_dir ):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.file_digests = {}
+        self.loaded_headers = set()
+
+        os.makedirs( os.path.join( cache_dir, 'headers' ), exist_ok=True )
+
+    def entry_path( self, fname, args ):
+        """
+        Return the path of the cache entry for |fname| parsed with |args|
+        """
+        digest = hashlib.sha256()
+        digest.update( os.path.abspath( fname ).encode() )
+        for arg in args:
+            digest.update( b'\0' + arg.encode() )
+
+        return os.path.join( self.cache_dir, digest.hexdigest() + '.fqc' )
+
+    def header_path( self, key ):
+        """
+        Return the path of the summary of the header with key |key|
+        """
+        return os.path.join( self.cache_dir, 'headers', key + '.fqh' )
+
+    def file_digest( self, fname ):
+        """
+        Hash the contents of |fname|.  Headers are shared by many
+        translation units so each file is only hashed once per run.
+        Files that cannot be read hash to "missing".
+        """
+        fname = os.path.abspath( fname )
+        if fname not in self.file_digests:
+            try:
+                with open( fname, 'rb' ) as f:
+                    self.file_digests[ fname ] = hashlib.sha256(
+                            f.read() ).hexdigest()
+            except OSError:
+                # clang may report includes that were never found on disk
+                self.file_digests[ fname ] = "missing"
+
+        return self.file_digests[ fname ]
+
+    def key( self, fname, deps, args ):
+        """
+        Hash the contents of the translation unit, every file it depends on
+        and the arguments it was parsed with
+        """
+        digest = hashlib.sha256()
+        digest.update( str( CACHE_VERSION ).encode() )
+        for arg in args:
+            digest.update( b'\0' + arg.encode() )
+        for dep in [ fname ] + deps:
+            digest.update( b'\0' + os.path.abspath( dep ).encode() )
+            digest.update( b'\0' + self.file_digest( dep ).encode() )
+
+        return digest.hexdigest()
+
+    def get( self, fname, args ):
+        """
+        Return the cached summary for |fname| or None if there is no entry
+        or if the entry is out of date
+        """
+        try:
+            with open( self.entry_path( fname, args ), 'rb' ) as f:
+                header = pickle.load( f )
+                if ( header[ 'version' ] == CACHE_VERSION and
+                     header[ 'key' ] == self.key(
+                         fname, header[ 'deps' ], args ) ):
+                    summary = pickle.load( f )
+                    summary.headers = self.get_headers( summary.header_keys )
+                    summary.parse_time = 0.0
+                    summary.output = ""
+                    summary.cursors_visited = 0
+                    summary.cursors_dispatched = 0
+                    self.hits += 1
+                    return summary
+        except ( OSError, EOFError, KeyError, pickle.UnpicklingError ):
+            pass
+
+        self.misses += 1
+        return None
+
+    def get_headers( self, keys ):
+        """
+        Load the summaries of the headers in |keys| that were not loaded
+        earlier in this run.  Raises OSError if any of them is missing.
+        """
+        headers = {}
+        for key in keys:
+            if key in self.loaded_headers:
+                continue
+            with open( self.header_path( key ), 'rb' ) as f:
+                version, header = pickle.load( f )
+            if version != CACHE_VERSION:
+                raise OSError( "stale header summary " + key )
+            headers[ key ] = header
+
+        self.loaded_headers.update( headers )
+        return headers
+
+    def write( self, path, *objects ):
+        """
+        Atomically write the pickled |objects| to |path|
+        """
+        tmp_path = "{}.{}.tmp".format( path, os.getpid() )
+        with open( tmp_path, 'wb' ) as f:
+            for obj in objects:
+                pickle.dump( obj, f, pickle.HIGHEST_PROTOCOL )
+        os.replace( tmp_path, path )
+
+    def put( self, fname, args, summary ):
+        """
+        Store the summary for |fname|, along with the summaries of
+        the headers it scraped
+        """
+        # A header scraped again replaces whatever was stored under its key
+        for key, header in summary.headers.items():
+            self.loaded_headers.add( key )
+            self.write( self.header_path( key ), ( CACHE_VERSION, header ) )
+
+        # The header summaries are stored on their own
+        summary = copy.copy( summary )
+        summary.headers = {}
+
+        header = {
+            'version': CACHE_VERSION,
+            'deps': summary.includes,
+            'key': self.key( fname, summary.includes, args ),
+        }
+
+        self.write( self.entry_path( fname, args ), header, summary )
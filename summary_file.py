@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+Summary object files.  `funqual compile` scrapes a single translation unit
+and writes its TranslationUnitSummary to a .fq file, the way a compiler
+writes an object file.  `funqual link` reads any number of them back,
+merges them and runs the checkers.  A build system can then scrape
+translation units in parallel with compilation and skip the ones whose .fq
+file is newer than their sources (see write_dep_file).
+
+A summary file starts with MAGIC and the format version as a 32 bit little
+endian integer, followed by a pickled dictionary describing the
+translation unit and the pickled summary itself.  The summary carries the
+summaries of every header it includes, so each file can be linked on its
+own.
+"""
+
+import os
+import struct
+import pickle
+from summary_cache import CACHE_VERSION
+
+MAGIC = b'FUNQUAL\0'
+VERSION = struct.Struct( '<I' )
+
+
+def write_summary( path, job, tu_summary ):
+    """
+    Atomically write |tu_summary|, scraped for the CompileJob |job|, to the
+    summary file |path|
+    """
+    info = {
+        'fname': job.fname,
+        'args': job.args,
+        'deps': tu_summary.includes,
+    }
+
+    tmp_path = "{}.{}.tmp".format( path, os.getpid() )
+    with open( tmp_path, 'wb' ) as f:
+        f.write( MAGIC )
+        f.write( VERSION.pack( CACHE_VERSION ) )
+        pickle.dump( info, f, pickle.HIGHEST_PROTOCOL )
+        pickle.dump( tu_summary, f, pickle.HIGHEST_PROTOCOL )
+    os.replace( tmp_path, path )
+
+
+def read_summary( path ):
+    """
+    Read the TranslationUnitSummary stored in the summary file |path|.
+    Raises ValueError if |path| is not a summary file or was written by
+    another version of funqual.
+    """
+    with open( path, 'rb' ) as f:
+        header = f.read( len( MAGIC ) + VERSION.size )
+        if ( len( header ) != len( MAGIC ) + VERSION.size or
+             not header.startswith( MAGIC ) ):
+            raise ValueError( "{}: not a funqual summary file".format( path ) )
+
+        version, = VERSION.unpack_from( header, len( MAGIC ) )
+        if version != CACHE_VERSION:
+            raise ValueError(
+                    "{}: summary file version {} (expected {}), "
+                    "compile it again".format( path, version, CACHE_VERSION ) )
+
+        pickle.load( f )
+        return pickle.load( f )
+
+
+def write_dep_file( path, target, job, tu_summary ):
+    """
+    Write a Makefile fragment making |target| depend on the main file of
+    |job| and every file it included, like the one `cc -MD -MP` writes.
+    Every include also gets an empty rule so that make doesn't fail once
+    a header is deleted.
+    """
+    deps = [ job.fname ] + tu_summary.includes
+    with open( path, 'w' ) as f:
+        f.write( "{}: {}\n".format( escape_make( target ), " \\\n  ".join(
+            [ escape_make( dep ) for dep in deps ] ) ) )
+        for dep in tu_summary.includes:
+            f.write( "\n{}:\n".format( escape_make( dep ) ) )
+
+
+def escape_make( fname ):
+    return fname.replace( ' ', '\\ ' )
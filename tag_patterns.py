@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Tags given to functions by USR pattern in the rules file, so that a whole
+library can be tagged in a few lines instead of one line per function:
+
+    tag glob:c:@F@str* non_reentrant          (prefix)
+    tag glob:c:@N@hal@*@F@*_isr# blocking     (glob, as in fnmatch)
+    tag re:c:@F@(f|s)?printf#.* blocking      (regular expression)
+
+Only `tag` lines starting with `glob:` or `re:` are patterns.  Every other
+USR is exact, even if it contains one of `*?[`: the USR of a function
+taking a pointer has a `*` in it.  In a glob, `*` still matches the `*` of
+a pointer parameter; write it as `[*]` to match only that.
+
+Patterns are matched against every USR of the program once it has been
+merged.  Prefix patterns are stored in a trie, and so are the glob patterns
+that start with a literal prefix, so matching a USR walks the trie once
+along its characters and only tests the globs whose prefix it has.  The
+remaining patterns are only tested against the USRs that one combined
+regular expression of all of them matches.
+"""
+
+import re
+import fnmatch
+from scrapers import AnnotationKind
+
+REGEX_PREFIX = "re:"
+GLOB_PREFIX = "glob:"
+WILDCARDS = "*?["
+
+
+def is_pattern( usr ):
+    """
+    Check whether the USR in a `tag` line is a pattern
+    """
+    return usr.startswith( REGEX_PREFIX ) or usr.startswith( GLOB_PREFIX )
+
+
+def literal_prefix( glob ):
+    """
+    The part of |glob| before its first wildcard
+    """
+    for index, char in enumerate( glob ):
+        if char in WILDCARDS:
+            return glob[ : index ]
+    return glob
+
+
+class TrieNode( object ):
+    __slots__ = [ 'children', 'tags', 'globs' ]
+
+    def __init__( self ):
+        self.children = {}
+        # Tags of the prefix patterns ending here
+        self.tags = set()
+        # ( regex, tag ) of the globs whose literal prefix ends here
+        self.globs = []
+
+
+class TagPatterns( object ):
+    """
+    The pattern `tag` lines of a rules file, compiled for matching
+    """
+    def __init__( self ):
+        self.root = TrieNode()
+        # ( regex, tag ) of the patterns without a literal prefix
+        self.floating = []
+        self.combined = None
+        self.count = 0
+
+    def add( self, pattern, tag ):
+        """
+        Give |tag| to every function whose USR matches |pattern|, a
+        `glob:` or `re:` pattern
+        """
+        self.count += 1
+
+        if pattern.startswith( REGEX_PREFIX ):
+            self.floating.append(
+                    ( re.compile( pattern[ len( REGEX_PREFIX ) : ] ), tag ) )
+            self.combined = None
+            return
+
+        pattern = pattern[ len( GLOB_PREFIX ) : ]
+        prefix = literal_prefix( pattern )
+        node = self.root
+        for char in prefix:
+            node = node.children.setdefault( char, TrieNode() )
+
+        if pattern == prefix + "*":
+            node.tags.add( tag )
+        elif prefix:
+            node.globs.append(
+                    ( re.compile( fnmatch.translate( pattern ) ), tag ) )
+        else:
+            self.floating.append(
+                    ( re.compile( fnmatch.translate( pattern ) ), tag ) )
+            self.combined = None
+
+    def nodes_along( self, usr ):
+        """
+        Yield the root of the trie, which holds the patterns with an empty
+        prefix such as `glob:*`, and every node along the characters of
+        |usr|
+        """
+        node = self.root
+        yield node
+        for char in usr:
+            node = node.children.get( char )
+            if node is None:
+                return
+            yield node
+
+    def match( self, usr ):
+        """
+        Return the tags of every pattern that matches |usr|
+        """
+        tags = set()
+
+        for node in self.nodes_along( usr ):
+            tags |= node.tags
+            for regex, tag in node.globs:
+                if tag not in tags and regex.fullmatch( usr ):
+                    tags.add( tag )
+
+        if self.floating:
+            if self.combined is None:
+                self.combined = re.compile( "|".join(
+                    [ "(?:{})".format( regex.pattern )
+                      for regex, _ in self.floating ] ) )
+            if self.combined.fullmatch( usr ):
+                for regex, tag in self.floating:
+                    if tag not in tags and regex.fullmatch( usr ):
+                        tags.add( tag )
+
+        return tags
+
+    def expand( self, usrs ):
+        """
+        Return a mapping of each USR in |usrs| that matches a pattern to
+        its tags, in the same form as the exact `tag` lines
+        """
+        result = {}
+        for usr in usrs:
+            tags = self.match( usr )
+            if tags:
+                result[ usr ] = set( [ ( AnnotationKind.DIRECT, tag )
+                                       for tag in tags ] )
+        return result
+
+    def __len__( self ):
+        return self.count
+
+    def __getstate__( self ):
+        state = dict( self.__dict__ )
+        state[ 'combined' ] = None
+        return state
+
+
+class ExternalTags( dict ):
+    """
+    The tags given by the rules file: a mapping of the USRs in exact `tag`
+    lines to their tags, plus the TagPatterns of the other `tag` lines in
+    |patterns|
+    """
+    def __init__( self, tags=(), patterns=None ):
+        dict.__init__( self, tags )
+        self.patterns = patterns if patterns is not None else TagPatterns()
+
+
+def expand_external_tags( ext_types, usrs ):
+    """
+    Return the tags of the rules file as a plain mapping of USR to tags,
+    with the patterns in |ext_types| (if any) matched against |usrs|
+    """
+    if not isinstance( ext_types, ExternalTags ) or not ext_types.patterns:
+        return ext_types
+
+    result = ext_types.patterns.expand( usrs )
+    for usr, tags in ext_types.items():
+        result[ usr ] = result.get( usr, set() ) | tags
+    return result
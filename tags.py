@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Compact representation of qualified types.  Every qualifier name is interned
+into a TagTable which assigns it a bit.  The qualified type of a function is
+then a pair of integer bitmasks: ( direct, indirect ).  Augmenting a type is
+a bitwise or, and checking a type is a bitwise and or an integer compare.
+"""
+
+from scrapers import AnnotationKind
+
+# The type of a function nobody has qualified
+NO_TYPE = ( 0, 0 )
+
+
+class TagTable( object ):
+    """
+    Interns qualifier names.  Each name is assigned its own bit.
+    """
+    def __init__( self ):
+        self.bits = {}
+        self.names = []
+
+    def bit( self, name ):
+        """
+        Return the bit for |name|, assigning a new one if needed
+        """
+        bit = self.bits.get( name )
+        if bit is None:
+            bit = 1 << len( self.names )
+            self.bits[ name ] = bit
+            self.names.append( name )
+        return bit
+
+    def mask( self, names ):
+        """
+        Return the bitmask for a collection of names
+        """
+        result = 0
+        for name in names:
+            result |= self.bit( name )
+        return result
+
+    def names_of( self, mask ):
+        """
+        Return the set of names whose bits are set in |mask|
+        """
+        result = set()
+        index = 0
+        while mask:
+            if mask & 1:
+                result.add( self.names[ index ] )
+            mask >>= 1
+            index += 1
+        return result
+
+    def intern_type( self, types ):
+        """
+        Turn a set of ( AnnotationKind, name ) tuples, as produced by the
+        scrapers, into a ( direct, indirect ) pair of masks
+        """
+        direct = 0
+        indirect = 0
+        for kind, name in types:
+            if kind == AnnotationKind.DIRECT:
+                direct |= self.bit( name )
+            else:
+                indirect |= self.bit( name )
+        return ( direct, indirect )
+
+    def encode( self, mapping ):
+        """
+        Turn a mapping of USR to a set of ( AnnotationKind, name ) tuples
+        into QualifiedTypes
+        """
+        return QualifiedTypes( self, [
+            ( usr, self.intern_type( types ) )
+            for usr, types
+            in mapping.items() ] )
+
+
+class QualifiedTypes( dict ):
+    """
+    Maps USRs to ( direct, indirect ) pairs of bitmasks.  Carries the
+    TagTable the masks were built with so they can be turned back into
+    qualifier names for the user.
+    """
+    def __init__( self, table, *args ):
+        dict.__init__( self, *args )
+        self.table = table
+
+    def direct_names( self, usr ):
+        return self.table.names_of( self.get( usr, NO_TYPE )[ 0 ] )
+
+    def indirect_names( self, usr ):
+        return self.table.names_of( self.get( usr, NO_TYPE )[ 1 ] )
@@ -7,7 +7,36 @@ import parse
 import pprint
 import ast_helpers
 import override_scraper
-from call_tree import build_call_tree
+import os
+import gc
+import contextlib
+import pickle
+import shutil
+import tempfile
+import summary
+import json
+import compile_db
+import output
+import io
+import watch
+import benchmark
+import summary_file
+import instrument
+import rules
+import query
+import pipeline
+from compile_db import CompileJob
+from summary_cache import SummaryCache
+from optparse import Values
+from call_tree import build_call_tree, CallTree
+from class_hierarchy import ClassHierarchy
+from scrapers import AnnotationKind
+from type_augmentor import augment_types, determine_indirect_type
+from rules import RuleRestrictIndirectCall, RuleRequireCall, RuleIndex
+from tags import TagTable, QualifiedTypes
+from violation import RuleViolation, OverrideViolation
+from rule_checker import check_rules, aggregate_rule_violations, PathCounter
+from tag_patterns import TagPatterns, expand_external_tags
 
 class TestCallGraph( unittest.TestCase ):
     def test_callgraph_simple( self ):
@@ -83,6 +112,41 @@ class TestCallGraph( unittest.TestCase ):
                 expectation[ key ],
             )
 
+class TestFrozenCallTree( unittest.TestCase ):
+    def setUp( self ):
+        self.call_tree = CallTree()
+        for caller, callee in [ ( 'main', 'a' ), ( 'main', 'Base::f' ),
+                                ( 'a', 'b' ), ( 'b', 'a' ), ( 'b', 'leaf' ) ]:
+            self.call_tree.add( caller, callee )
+
+    def test_same_answers_as_call_tree( self ):
+        frozen = self.call_tree.freeze()
+
+        self.assertEqual( frozen.functions(), self.call_tree.functions() )
+        self.assertEqual( frozen.size(), self.call_tree.size() )
+        for func in [ 'main', 'a', 'b', 'leaf', 'Base::f', 'unknown' ]:
+            self.assertEqual( set( frozen.calls( func ) ),
+                              set( self.call_tree.calls( func ) ) )
+
+        self.assertEqual( set( frozen.callers( 'a' ) ), set( [ 'main', 'b' ] ) )
+        self.assertEqual( list( frozen.callers( 'main' ) ), [] )
+
+    def test_calls_has_no_side_effects( self ):
+        self.call_tree.calls( 'leaf' )
+        self.assertNotIn( 'leaf', self.call_tree.functions() )
+
+    def test_augment_with_overrides( self ):
+        frozen = self.call_tree.freeze()
+        frozen.augment_with_overrides(
+                { 'Base::f': set( [ 'Derived::f', 'MoreDerived::f' ] ) } )
+
+        self.assertEqual( set( frozen.calls( 'main' ) ),
+                          set( [ 'a', 'Base::f', 'Derived::f',
+                                 'MoreDerived::f' ] ) )
+        self.assertEqual( set( frozen.callers( 'Derived::f' ) ),
+                          set( [ 'main' ] ) )
+        self.assertEqual( frozen.size(), 7 )
+
 class TestOverrides( unittest.TestCase ):
     def test_basic_inheritance_override( self ):
         overrides = get_overrides( 'test_cases/2/main.cpp' )
@@ -105,6 +169,1110 @@ class TestOverrides( unittest.TestCase ):
                               'c:@S@TrashPanda@F@Feed#I#',
                           ] ) )
         
+class TestClassHierarchy( unittest.TestCase ):
+    def setUp( self ):
+        """
+        Base <- Left, Right <- Bottom (a diamond), Bottom <- Leaf
+        """
+        self.hierarchy = ClassHierarchy( {
+            'Base::f': set( [ 'Left::f', 'Right::f' ] ),
+            'Left::f': set( [ 'Bottom::f' ] ),
+            'Right::f': set( [ 'Bottom::f' ] ),
+            'Bottom::f': set( [ 'Leaf::f' ] ),
+        } )
+
+    def test_transitive_overriders_are_memoized( self ):
+        overriders = self.hierarchy[ 'Base::f' ]
+        self.assertEqual( overriders, set( [
+            'Left::f', 'Right::f', 'Bottom::f', 'Leaf::f' ] ) )
+        self.assertEqual( self.hierarchy[ 'Right::f' ],
+                          set( [ 'Bottom::f', 'Leaf::f' ] ) )
+        self.assertIs( self.hierarchy.memo[ 'Base::f' ], overriders )
+        self.assertIn( 'Bottom::f', self.hierarchy.memo )
+        self.assertEqual( self.hierarchy.get( 'Leaf::f' ), set() )
+        self.assertEqual( sorted( self.hierarchy.keys() ), [
+            'Base::f', 'Bottom::f', 'Left::f', 'Right::f' ] )
+
+    def test_bulk_expansion_matches_call_tree( self ):
+        call_tree = CallTree()
+        for caller, callee in [ ( 'main', 'Base::f' ), ( 'main', 'g' ),
+                                ( 'g', 'Right::f' ), ( 'g', 'Leaf::f' ) ]:
+            call_tree.add( caller, callee )
+
+        frozen = call_tree.freeze()
+        frozen.augment_with_overrides( self.hierarchy )
+        call_tree.augment_with_overrides( self.hierarchy.closure() )
+
+        for func in [ 'main', 'g', 'Leaf::f' ]:
+            self.assertEqual( set( frozen.calls( func ) ),
+                              set( call_tree.calls( func ) ) )
+        self.assertEqual( frozen.size(), call_tree.size() )
+        self.assertEqual( set( frozen.callers( 'Bottom::f' ) ),
+                          set( [ 'main', 'g' ] ) )
+
+class TestTypeAugmentor( unittest.TestCase ):
+    def test_matches_per_function_search( self ):
+        """
+        The condensed propagation must give every function the same type
+        as a fresh search from that function, including on recursive and
+        mutually recursive call chains
+        """
+        call_tree = CallTree()
+        for caller, callee in [ ( 'main', 'a' ), ( 'a', 'b' ), ( 'b', 'a' ),
+                                ( 'b', 'c' ), ( 'c', 'c' ), ( 'c', 'ptr' ),
+                                ( 'd', 'e' ), ( 'e', 'f' ), ( 'f', 'd' ),
+                                ( 'main', 'd' ) ]:
+            call_tree.add( caller, callee )
+
+        table = TagTable()
+        funptr_types = table.encode( {
+            'ptr': set( [ ( AnnotationKind.INDIRECT, 'io' ) ] ) } )
+        function_types = table.encode( {
+            'main': set( [ ( AnnotationKind.DIRECT, 'main' ) ] ),
+            'a': set( [ ( AnnotationKind.DIRECT, 'a' ) ] ),
+            'b': set( [ ( AnnotationKind.DIRECT, 'b' ) ] ),
+            'c': set( [ ( AnnotationKind.DIRECT, 'c' ) ] ),
+            'd': set( [ ( AnnotationKind.DIRECT, 'shared' ) ] ),
+            'e': set( [ ( AnnotationKind.DIRECT, 'shared' ) ] ),
+            'f': set(),
+        } )
+
+        expected = dict( [
+            ( func, ( direct, indirect | determine_indirect_type(
+                func, call_tree, funptr_types, function_types ) ) )
+            for func, ( direct, indirect ) in function_types.items() ] )
+
+        types = augment_types( call_tree, funptr_types, function_types )
+        self.assertEqual( types, expected )
+        self.assertIn( 'c', types.indirect_names( 'c' ) )
+        self.assertNotIn( 'a', types.indirect_names( 'a' ) )
+        self.assertIn( 'shared', types.indirect_names( 'd' ) )
+        self.assertEqual( types.indirect_names( 'main' ),
+                          set( [ 'a', 'b', 'c', 'io', 'shared' ] ) )
+
+class TestRestrictIndirectCall( unittest.TestCase ):
+    def setUp( self ):
+        """
+        foo reaches printf directly and along three longer paths
+        """
+        self.call_tree = CallTree()
+        for caller, callee in [ ( 'foo', 'call_printf' ),
+                                ( 'foo', 'printf' ),
+                                ( 'foo', 'do_something' ),
+                                ( 'do_something', 'call_printf' ),
+                                ( 'do_something', 'printf' ),
+                                ( 'do_something', 'foo' ),
+                                ( 'call_printf', 'printf' ) ]:
+            self.call_tree.add( caller, callee )
+
+        self.func_tags = TagTable().encode( {
+            'foo': set( [ ( AnnotationKind.DIRECT, 'preemptive' ) ] ),
+            'call_printf': set(),
+            'do_something': set(),
+            'printf': set( [ ( AnnotationKind.DIRECT, 'non_reentrant' ) ] ),
+        } )
+        self.rule = RuleRestrictIndirectCall( 'preemptive', 'non_reentrant' )
+
+    def get_paths( self, max_paths ):
+        return [ violation.call_path
+                 for violation
+                 in self.rule.check( self.call_tree, self.func_tags,
+                                     set( self.func_tags.keys() ),
+                                     max_paths ) ]
+
+    def test_shortest_witness( self ):
+        self.assertEqual( self.get_paths( 1 ), [ [ 'foo', 'printf' ] ] )
+
+    def test_more_witnesses( self ):
+        paths = self.get_paths( 2 )
+
+        self.assertEqual( len( paths ), 2 )
+        self.assertEqual( paths[ 0 ], [ 'foo', 'printf' ] )
+        self.assertIn( paths[ 1 ], [ [ 'foo', 'call_printf', 'printf' ],
+                                     [ 'foo', 'do_something', 'printf' ] ] )
+
+    def test_every_path( self ):
+        self.assertEqual( sorted( self.get_paths( 0 ) ), [
+            [ 'foo', 'call_printf', 'printf' ],
+            [ 'foo', 'do_something', 'call_printf', 'printf' ],
+            [ 'foo', 'do_something', 'printf' ],
+            [ 'foo', 'printf' ],
+        ] )
+
+    def test_reverse_reachability( self ):
+        """
+        Only functions that can reach printf are searched, on both kinds
+        of call tree
+        """
+        self.call_tree.add( 'idle', 'sleep' )
+        self.call_tree.add( 'foo', 'idle' )
+        expected = set( [ 'foo', 'do_something', 'call_printf', 'printf' ] )
+
+        for call_tree in [ self.call_tree, self.call_tree.freeze() ]:
+            self.assertEqual( call_tree.reaching( [ 'printf' ] ), expected )
+            live = self.rule.prepare( call_tree, self.func_tags,
+                                      set( self.func_tags.keys() ) )
+            self.assertEqual( live, expected )
+            self.assertEqual( list( self.rule.paths_from(
+                'idle', call_tree, self.func_tags, set(), 1, live ) ), [] )
+            self.assertEqual( sorted( self.rule.paths_from(
+                'foo', call_tree, self.func_tags, set(), 0, live ) ),
+                sorted( self.get_paths( 0 ) ) )
+
+    def test_rule_index_shares_callee_work( self ):
+        """
+        foo is a caller for both rules, which share their callee tag, so
+        the paths from foo are searched once and reported twice
+        """
+        self.func_tags = TagTable().encode( {
+            'foo': set( [ ( AnnotationKind.DIRECT, 'preemptive' ),
+                          ( AnnotationKind.DIRECT, 'interrupt' ) ] ),
+            'call_printf': set(),
+            'do_something': set(),
+            'printf': set( [ ( AnnotationKind.DIRECT, 'non_reentrant' ) ] ),
+        } )
+        rules = [ self.rule,
+                  RuleRestrictIndirectCall( 'interrupt', 'non_reentrant' ),
+                  RuleRequireCall( 'interrupt', 'non_reentrant' ) ]
+
+        searches = []
+        paths_from = RuleRestrictIndirectCall.paths_from
+        def counting_paths_from( rule, caller, *args ):
+            searches.append( caller )
+            return paths_from( rule, caller, *args )
+
+        index = RuleIndex( rules, self.func_tags )
+        self.assertEqual( index.callers, [ [ 'foo' ], [ 'foo' ], [ 'foo' ] ] )
+
+        RuleRestrictIndirectCall.paths_from = counting_paths_from
+        try:
+            violations = [ [ violation.call_path for violation in index.check(
+                position, self.call_tree, self.func_tags,
+                set( self.func_tags.keys() ), 1 ) ]
+                for position in range( len( rules ) ) ]
+        finally:
+            RuleRestrictIndirectCall.paths_from = paths_from
+
+        self.assertEqual( searches, [ 'foo' ] )
+        self.assertEqual( violations[ 0 ], [ [ 'foo', 'printf' ] ] )
+        self.assertEqual( violations[ 1 ], [ [ 'foo', 'printf' ] ] )
+        self.assertEqual( sorted( violations[ 2 ] ), [
+            [ 'foo', 'call_printf' ], [ 'foo', 'do_something' ] ] )
+        self.assertEqual( index.paths, {} )
+
+class TestSummaries( unittest.TestCase ):
+    def test_detached_summaries_merge_like_serial( self ):
+        """
+        Summaries built in worker processes must merge into the same
+        program model as summaries built in this process
+        """
+        files = [ 'test_cases/3/main.cpp', 'test_cases/3/Panda.cpp',
+                  'test_cases/3/RedPanda.cpp' ]
+
+        serial = summary.merge_summaries(
+                [ summary.scrape_translation_unit( job, get_options() )
+                  for job in compile_db.jobs_from_files(
+                      files, get_options() ) ], {} )
+        detached = summary.merge_summaries(
+                [ pickle.loads( pickle.dumps(
+                    summary.scrape_translation_unit_detached(
+                        ( job, get_options() ) ) ) )
+                  for job in compile_db.jobs_from_files(
+                      files, get_options() ) ], {} )
+
+        self.assertEqual( dict( serial[ 0 ].tree ), dict( detached[ 0 ].tree ) )
+        self.assertEqual( dict( serial[ 1 ] ), dict( detached[ 1 ] ) )
+        self.assertEqual( serial[ 3 ], detached[ 3 ] )
+        self.assertEqual(
+                dict( [ ( usr, ast_helpers.get_human_name( cursor ) )
+                        for usr, cursor in serial[ 2 ].items() ] ),
+                dict( [ ( usr, ast_helpers.get_human_name( record ) )
+                        for usr, record in detached[ 2 ].items() ] ) )
+
+    def test_shared_headers_scraped_once( self ):
+        """
+        With a HeaderRegistry, a header shared by two translation units is
+        only scraped by the first but the merged model does not change
+        """
+        files = [ 'test_cases/3/RedPanda.cpp', 'test_cases/3/TrashPanda.cpp' ]
+        jobs = compile_db.jobs_from_files( files, get_options() )
+
+        plain = [ summary.scrape_translation_unit( job, get_options() )
+                  for job in jobs ]
+        registry = summary.HeaderRegistry()
+        deduped = [ summary.scrape_translation_unit(
+                        job, get_options(), registry )
+                    for job in jobs ]
+
+        panda_h = os.path.abspath( 'test_cases/3/Panda.h' )
+        self.assertIn( panda_h, [ header.fname for header
+                                  in deduped[ 0 ].headers.values() ] )
+        self.assertNotIn( panda_h, [ header.fname for header
+                                     in deduped[ 1 ].headers.values() ] )
+        self.assertLess( deduped[ 1 ].cursors_visited,
+                         plain[ 1 ].cursors_visited )
+
+        plain = summary.merge_summaries( plain, {} )
+        deduped = summary.merge_summaries( deduped, {} )
+        self.assertEqual( dict( plain[ 0 ].tree ), dict( deduped[ 0 ].tree ) )
+        self.assertEqual( dict( plain[ 1 ] ), dict( deduped[ 1 ] ) )
+        self.assertEqual( set( plain[ 2 ] ), set( deduped[ 2 ] ) )
+        self.assertEqual( plain[ 3 ], deduped[ 3 ] )
+        self.assertEqual( plain[ 4 ], deduped[ 4 ] )
+
+class TestNestedHeaders( unittest.TestCase ):
+    """
+    b.h only tags ANNOT functions blocking when STRICT is defined, so the
+    declarations of a.h depend on a macro it never names itself
+    """
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        sources = {
+            'b.h': "#ifdef STRICT\n"
+                   "#define ANNOT __attribute__((annotate("
+                   "\"funqual::blocking\")))\n"
+                   "#else\n"
+                   "#define ANNOT\n"
+                   "#endif\n",
+            'a.h': '#include "b.h"\nvoid f() ANNOT;\n',
+            'one.cpp': '#include "a.h"\n'
+                       'void g() __attribute__((annotate('
+                       '"funqual::nonblocking"))) { f(); }\n',
+            'two.cpp': '#define STRICT\n#include "a.h"\n',
+            'rules.qtag': "rule restrict_indirect_call nonblocking "
+                          "blocking\n",
+        }
+        for name, text in sources.items():
+            with open( self.path( name ), 'w' ) as f:
+                f.write( text )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def path( self, name ):
+        return os.path.join( self.tmpdir, name )
+
+    def count_violations( self, files, **kwargs ):
+        options = get_options( **kwargs )
+        with contextlib.redirect_stdout( io.StringIO() ):
+            _, _, violations = parse.get_violations(
+                    [ self.path( name ) for name in files ],
+                    self.path( 'rules.qtag' ), options )
+            return len( list( violations ) )
+
+    def test_macros_of_nested_headers( self ):
+        for files in [ [ 'one.cpp', 'two.cpp' ], [ 'two.cpp', 'one.cpp' ] ]:
+            self.assertEqual( self.count_violations( files ), 1 )
+
+    def test_cache_follows_nested_headers( self ):
+        cache_dir = self.path( 'cache' )
+        files = [ 'one.cpp', 'two.cpp' ]
+        self.assertEqual(
+                self.count_violations( files, cache_dir=cache_dir ), 1 )
+
+        with open( self.path( 'b.h' ), 'w' ) as f:
+            f.write( "#define ANNOT\n" )
+        self.assertEqual(
+                self.count_violations( files, cache_dir=cache_dir ), 0 )
+        self.assertEqual(
+                self.count_violations( files, cache_dir=cache_dir ), 0 )
+
+class TestProgramAccumulator( unittest.TestCase ):
+    def part( self, fname, records, funcptr_types=None, **kwargs ):
+        call_tree = CallTree()
+        call_tree.add( fname, 'c:@F@helper#' )
+        cursors = dict( [
+            ( usr, ast_helpers.LocationRecord(
+                usr, ast_helpers.SourceLocation( fname, 1, 1 ), None ) )
+            for usr in records ] )
+        return summary.TranslationUnitSummary(
+                fname, call_tree, {}, cursors, {}, funcptr_types or {},
+                [ fname ], **kwargs )
+
+    def test_first_record_wins( self ):
+        header = self.part( 'helper.h', [ 'c:@F@helper#' ] )
+        units = [
+            self.part( 'a.cpp', [ 'c:@F@helper#' ] ),
+            self.part( 'b.cpp', [], header_keys=[ 'h' ],
+                       headers={ 'h': header } ),
+            self.part( 'c.cpp', [], header_keys=[ 'h' ] ),
+        ]
+
+        accumulator = summary.ProgramAccumulator()
+        for unit in units:
+            accumulator.add( unit )
+        self.assertEqual( len( accumulator ), 3 )
+        call_tree, _, cursors, _, _, assignments = summary.merge_summaries(
+                accumulator, {} )
+
+        # helper.h is merged once, right before b.cpp, its first user
+        self.assertEqual( cursors[ 'c:@F@helper#' ].location.file, 'a.cpp' )
+        self.assertEqual( assignments,
+                          [ 'a.cpp', 'helper.h', 'b.cpp', 'c.cpp' ] )
+        self.assertEqual( sorted( call_tree.functions() ),
+                          [ 'a.cpp', 'b.cpp', 'c.cpp', 'helper.h' ] )
+        self.assertEqual( len( accumulator ), 0 )
+
+    def test_function_pointer_conflicts( self ):
+        accumulator = summary.ProgramAccumulator()
+        accumulator.add( self.part( 'a.cpp', [], { 'c:@fp': set( [ 1 ] ) } ) )
+        with self.assertRaises( Exception ):
+            accumulator.add( self.part( 'b.cpp', [],
+                                        { 'c:@fp': set( [ 2 ] ) } ) )
+
+class TestSummaryCache( unittest.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        shutil.copytree( 'test_cases/1', os.path.join( self.tmpdir, 'src' ) )
+        self.fname = os.path.join( self.tmpdir, 'src', 'main.cpp' )
+        self.header = os.path.join( self.tmpdir, 'src', 'alt.h' )
+        self.args = ast_helpers.get_clang_args( get_options() )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def test_cache_hit_and_header_invalidation( self ):
+        cache_dir = os.path.join( self.tmpdir, 'cache' )
+
+        cache = SummaryCache( cache_dir )
+        self.assertIsNone( cache.get( self.fname, self.args ) )
+        cache.put( self.fname, self.args,
+                   summary.scrape_translation_unit(
+                       CompileJob( self.fname, self.args ),
+                       get_options() ) )
+
+        cache = SummaryCache( cache_dir )
+        cached = cache.get( self.fname, self.args )
+        self.assertEqual( cached.call_tree.calls( 'c:@F@main#' ),
+                          set( [ 'c:@F@do_stuff#' ] ) )
+        self.assertEqual( ( cache.hits, cache.misses ), ( 1, 0 ) )
+
+        with open( self.header, 'a' ) as f:
+            f.write( "int stop_hunting();\n" )
+
+        cache = SummaryCache( cache_dir )
+        self.assertIsNone( cache.get( self.fname, self.args ) )
+        self.assertIsNone( cache.get( self.fname, self.args + [ '-DX' ] ) )
+        self.assertEqual( ( cache.hits, cache.misses ), ( 0, 2 ) )
+
+class TestTagPatterns( unittest.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rules_file = os.path.join( self.tmpdir, 'rules.qtag' )
+        with open( self.rules_file, 'w' ) as f:
+            f.write( "tag c:@F@printf non_reentrant\n"
+                     "tag c:@F@puts#*1C# non_reentrant\n"
+                     "tag glob:c:@F@str* non_reentrant\n"
+                     "tag glob:c:@N@hal@*@F@*_isr# blocking\n"
+                     "tag re:c:@F@(malloc|free)#.* non_reentrant\n"
+                     "rule restrict_indirect_call preemptive non_reentrant\n" )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def test_patterns_match_program_usrs( self ):
+        ext_types, _ = rules.parse_rules_file( self.rules_file )
+        self.assertEqual( sorted( ext_types.keys() ),
+                          [ 'c:@F@printf', 'c:@F@puts#*1C#' ] )
+
+        # A pointer parameter's `*` is not a wildcard in an exact USR
+        tagged = expand_external_tags( ext_types, [
+            'c:@F@printf', 'c:@F@puts#*1C#', 'c:@F@puts#I#1C#',
+            'c:@F@strcpy#*C#*1C#', 'c:@F@malloc#l#',
+            'c:@N@hal@S@Uart@F@rx_isr#', 'c:@N@hal@F@init#',
+            'c:@F@open#' ] )
+
+        self.assertEqual( dict( [ ( usr, set( [ tag for _, tag in tags ] ) )
+                                  for usr, tags in tagged.items() ] ), {
+            'c:@F@printf': set( [ 'non_reentrant' ] ),
+            'c:@F@puts#*1C#': set( [ 'non_reentrant' ] ),
+            'c:@F@strcpy#*C#*1C#': set( [ 'non_reentrant' ] ),
+            'c:@F@malloc#l#': set( [ 'non_reentrant' ] ),
+            'c:@N@hal@S@Uart@F@rx_isr#': set( [ 'blocking' ] ),
+        } )
+
+    def test_function_pointers_are_not_matched( self ):
+        fname = os.path.join( self.tmpdir, 'hal.cpp' )
+        with open( fname, 'w' ) as f:
+            f.write( "namespace hal { void (*handler)(); void wait() {} }\n"
+                     "void run() __attribute__((annotate("
+                     "\"funqual::nonblocking\"))) {\n"
+                     "    hal::wait(); hal::handler();\n"
+                     "}\n" )
+        with open( self.rules_file, 'w' ) as f:
+            f.write( "tag glob:c:@N@hal@* blocking\n"
+                     "rule restrict_indirect_call nonblocking blocking\n" )
+
+        with contextlib.redirect_stdout( io.StringIO() ):
+            _, types, violations = parse.get_violations(
+                    [ fname ], self.rules_file, get_options() )
+            self.assertEqual( [ violation.call_path[ -1 ]
+                                for violation in violations ],
+                              [ 'c:@N@hal@F@wait#' ] )
+        self.assertEqual( types.direct_names( 'c:@N@hal@handler' ), set() )
+
+    def test_catch_all_pattern( self ):
+        patterns = TagPatterns()
+        patterns.add( 'glob:*', 'everything' )
+        self.assertEqual( patterns.match( 'c:@F@main#' ),
+                          set( [ 'everything' ] ) )
+        self.assertEqual( patterns.match( '' ), set( [ 'everything' ] ) )
+
+    def test_compiled_rules_are_cached( self ):
+        cache_dir = os.path.join( self.tmpdir, 'cache' )
+        ext_types, type_rules = rules.load_rules_file( self.rules_file,
+                                                       cache_dir )
+        self.assertEqual( len( os.listdir(
+            os.path.join( cache_dir, 'rules' ) ) ), 1 )
+
+        cached_types, cached_rules = rules.load_rules_file( self.rules_file,
+                                                            cache_dir )
+        self.assertEqual( cached_types.patterns.match( 'c:@F@strlen#' ),
+                          set( [ 'non_reentrant' ] ) )
+        self.assertEqual( [ str( rule ) for rule in cached_rules ],
+                          [ str( rule ) for rule in type_rules ] )
+
+class TestCompileDatabase( unittest.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        src = os.path.abspath( 'test_cases/1' )
+        entries = [
+            { 'directory': src,
+              'arguments': [ 'clang++', '-c', '-std=c++14', '-DFOO',
+                             '-o', 'main.o', 'main.cpp' ],
+              'file': 'main.cpp' },
+            { 'directory': src,
+              'command': 'clang++ -c -std=c++14 -DFOO -o main.o main.cpp',
+              'file': 'main.cpp' },
+            { 'directory': src,
+              'command': 'clang++ -c -std=c++14 -o alt.o alt.cpp',
+              'file': os.path.join( src, 'alt.cpp' ) },
+        ]
+        with open( os.path.join( self.tmpdir,
+                                 'compile_commands.json' ), 'w' ) as f:
+            json.dump( entries, f )
+        self.src = src
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def test_entries_are_deduplicated( self ):
+        jobs = compile_db.load_compile_commands( self.tmpdir )
+
+        self.assertEqual(
+                [ ( job.fname, job.args ) for job in jobs ],
+                [ ( os.path.join( self.src, 'main.cpp' ),
+                    [ '-working-directory', self.src,
+                      '-std=c++14', '-DFOO' ] ),
+                  ( os.path.join( self.src, 'alt.cpp' ),
+                    [ '-working-directory', self.src, '-std=c++14' ] ) ] )
+
+    def test_entries_are_filtered( self ):
+        jobs = compile_db.load_compile_commands(
+                self.tmpdir, patterns=[ '*/alt.*' ] )
+        self.assertEqual( [ job.fname for job in jobs ],
+                          [ os.path.join( self.src, 'alt.cpp' ) ] )
+
+        jobs = compile_db.load_compile_commands(
+                self.tmpdir, files=[ 'test_cases/1/main.cpp' ] )
+        self.assertEqual( [ job.fname for job in jobs ],
+                          [ os.path.join( self.src, 'main.cpp' ) ] )
+
+    def test_parse_with_entry_arguments( self ):
+        jobs = compile_db.load_compile_commands( self.tmpdir )
+        main_summary = summary.scrape_translation_unit(
+                jobs[ 0 ], get_options() )
+
+        self.assertEqual( main_summary.call_tree.calls( 'c:@F@main#' ),
+                          set( [ 'c:@F@do_stuff#' ] ) )
+
+class TestTraversal( unittest.TestCase ):
+    def test_call_tree_scraped_in_the_same_pass( self ):
+        job = compile_db.jobs_from_files(
+                [ 'test_cases/1/alt.cpp' ], get_options() )[ 0 ]
+        tu_summary = summary.scrape_translation_unit( job, get_options() )
+
+        self.assertEqual(
+                dict( tu_summary.call_tree.tree ),
+                dict( build_call_tree( ast_helpers.get_translation_unit(
+                    job.fname, get_options() ) ).tree ) )
+        self.assertEqual(
+                tu_summary.call_tree.calls( 'c:@F@save_the_pandas#' ),
+                set( [ 'c:alt.cpp@F@increase_environment#',
+                       'c:alt.cpp@F@stop_deforestation#',
+                       'c:alt.cpp@F@stop_hunting#I#' ] ) )
+        self.assertGreater( tu_summary.cursors_dispatched, 0 )
+        self.assertLess( tu_summary.cursors_dispatched,
+                         tu_summary.cursors_visited )
+
+    def test_function_pointer_assignments( self ):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, tmpdir )
+        fname = os.path.join( tmpdir, 'assign.cpp' )
+        with open( fname, 'w' ) as f:
+            f.write( "\n".join( [
+                "int f(int);",
+                "typedef int (*handler_t)(int);",
+                "handler_t make();",
+                "void h() {",
+                "  int (*a)(int) = f;",
+                "  handler_t b = make();",
+                "  handler_t c;",
+                "  int x = 1;",
+                "  c = &f;",
+                "  c == f;",
+                "  x = x + 2;",
+                "  c = make();",
+                "}" ] ) )
+
+        job = compile_db.jobs_from_files( [ fname ], get_options() )[ 0 ]
+        tu_summary = summary.scrape_translation_unit( job, get_options() )
+
+        self.assertEqual(
+                [ ( lvalue.split( '@' )[ -1 ], rvalue, record.location.line )
+                  for lvalue, rvalue, record in tu_summary.assignments ],
+                [ ( 'a', 'c:@F@f#I#', 5 ), ( 'c', 'c:@F@f#I#', 9 ) ] )
+
+class TestWatch( unittest.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        qtag = '__attribute__((annotate("funqual::{}")))'
+        self.files = {
+            'rules.qtag': "rule restrict_indirect_call calm noisy\n",
+            'pets.h': "void bark() {};\n".format( qtag.format( 'noisy' ) ),
+            'pets.cpp': '#include "pets.h"\nvoid bark() {}\n',
+            'main.cpp': '#include "pets.h"\nvoid nap() {} {{ bark(); }}\n'
+                        .format( qtag.format( 'calm' ) ),
+        }
+        for fname, source in self.files.items():
+            self.write( fname, source )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def write( self, fname, source ):
+        path = os.path.join( self.tmpdir, fname )
+        with open( path, 'w' ) as f:
+            f.write( source )
+        # Make sure the modification time changes even on coarse clocks
+        os.utime( path, ns=( len( source ), len( source ) ) )
+        return path
+
+    def test_only_dependents_are_reparsed( self ):
+        options = get_options(
+                tags_file=os.path.join( self.tmpdir, 'rules.qtag' ) )
+        files = [ os.path.join( self.tmpdir, fname )
+                  for fname in [ 'pets.cpp', 'main.cpp' ] ]
+        watcher = watch.Watcher(
+                compile_db.jobs_from_files( files, options ), options )
+
+        watcher.load_rules()
+        self.assertEqual( watcher.update( set() ), 2 )
+        new, resolved = watcher.check()
+        self.assertEqual( ( len( new ), len( resolved ) ), ( 1, 0 ) )
+        pets_tu = watcher.units[ 0 ].tu
+
+        main_cpp = self.write( 'main.cpp', self.files[ 'main.cpp' ].replace(
+            "bark();", "" ) )
+
+        changed = watcher.changed_files()
+        self.assertEqual( changed, set( [ main_cpp ] ) )
+        self.assertEqual( watcher.update( changed ), 1 )
+        self.assertIs( watcher.units[ 0 ].tu, pets_tu )
+
+        new, resolved = watcher.check()
+        self.assertEqual( ( len( new ), len( resolved ) ), ( 0, 1 ) )
+        self.assertTrue( resolved[ 0 ].startswith( "Rule violation" ) )
+
+        self.write( 'pets.h', "void bark();\n" )
+        self.assertEqual( watcher.update( watcher.changed_files() ), 2 )
+
+    def test_shared_header_is_stated_once( self ):
+        options = get_options(
+                tags_file=os.path.join( self.tmpdir, 'rules.qtag' ) )
+        files = [ os.path.join( self.tmpdir, fname )
+                  for fname in [ 'pets.cpp', 'main.cpp' ] ]
+        watcher = watch.Watcher(
+                compile_db.jobs_from_files( files, options ), options )
+        watcher.load_rules()
+        watcher.update( set() )
+
+        stated = []
+        modification_time = watch.modification_time
+        def counting( fname ):
+            stated.append( fname )
+            return modification_time( fname )
+
+        watch.modification_time = counting
+        try:
+            self.assertEqual( watcher.changed_files(), set() )
+        finally:
+            watch.modification_time = modification_time
+
+        self.assertEqual( sorted( stated ), sorted(
+            files + [ os.path.join( self.tmpdir, 'pets.h' ) ] ) )
+
+class TestLocationRecords( unittest.TestCase ):
+    def test_translation_units_are_freed( self ):
+        """
+        Summaries only hold LocationRecords so no translation unit outlives
+        its scrape
+        """
+        def live_translation_units():
+            gc.collect()
+            return len( [ obj for obj in gc.get_objects()
+                          if isinstance( obj, TranslationUnit ) ] )
+
+        before = live_translation_units()
+        summaries = [
+            summary.scrape_translation_unit(
+                job, get_options(), summary.HeaderRegistry() )
+            for job in compile_db.jobs_from_files(
+                [ 'test_cases/3/main.cpp', 'test_cases/3/Panda.cpp' ],
+                get_options() ) ]
+        self.assertEqual( live_translation_units(), before )
+
+        # Panda::Feed is named after main.cpp, the first translation unit
+        # that declares it
+        cursors = summary.merge_summaries( summaries, {} )[ 2 ]
+        self.assertTrue( all( [
+            isinstance( record, ast_helpers.LocationRecord )
+            for record in cursors.values() ] ) )
+        self.assertEqual(
+                ast_helpers.get_human_name( cursors[ 'c:@S@Panda@F@Feed#I#' ] ),
+                "test_cases/3/main.cpp::Panda::Feed(int) (10,18)" )
+
+class TestSummaryFiles( unittest.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def run_command( self, command, argv ):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout( stdout ):
+            command( argv )
+        return stdout.getvalue()
+
+    def test_link_matches_a_whole_program_run( self ):
+        files = [ 'test_cases/3/main.cpp', 'test_cases/3/Panda.cpp',
+                  'test_cases/3/RedPanda.cpp' ]
+        tags = 'test_cases/3/rules.qtag'
+
+        objects = []
+        for fname in files:
+            objects.append( os.path.join( self.tmpdir, os.path.basename(
+                fname ).replace( '.cpp', '.fq' ) ) )
+            self.run_command( parse.compile_main,
+                              [ fname, '-o', objects[ -1 ], '--deps' ] )
+
+        with open( objects[ 1 ] + '.d' ) as f:
+            self.assertTrue( f.readline().startswith(
+                objects[ 1 ] + ': test_cases/3/Panda.cpp' ) )
+
+        linked = self.run_command( parse.link_main,
+                                   [ '-t', tags, '--format', 'jsonl' ]
+                                   + objects )
+
+        options = get_options( tags_file=tags )
+        with contextlib.redirect_stdout( io.StringIO() ):
+            cursors, types, violations = parse.get_violations(
+                    files, tags, options )
+            expected = [ violation.to_dict( cursors, types )
+                         for violation in violations ]
+        self.assertTrue( expected )
+
+        self.assertEqual(
+                sorted( [ json.loads( line )
+                          for line in linked.splitlines() ],
+                        key=lambda v: json.dumps( v, sort_keys=True ) ),
+                sorted( expected,
+                        key=lambda v: json.dumps( v, sort_keys=True ) ) )
+
+    def test_rejects_colliding_outputs( self ):
+        cwd = os.getcwd()
+        files = [ os.path.join( cwd, 'test_cases/1/main.cpp' ),
+                  os.path.join( cwd, 'test_cases/2/main.cpp' ) ]
+        os.chdir( self.tmpdir )
+        try:
+            with contextlib.redirect_stderr( io.StringIO() ):
+                with self.assertRaises( SystemExit ):
+                    self.run_command( parse.compile_main, files )
+            self.assertEqual( os.listdir( self.tmpdir ), [] )
+        finally:
+            os.chdir( cwd )
+
+    def test_rejects_other_files( self ):
+        fname = os.path.join( self.tmpdir, 'rules.fq' )
+        shutil.copy( 'test_cases/3/rules.qtag', fname )
+        with self.assertRaises( ValueError ):
+            summary_file.read_summary( fname )
+
+class TestOutputFormats( unittest.TestCase ):
+    def setUp( self ):
+        table = TagTable()
+        self.types = QualifiedTypes( table, {
+            'c:@F@nap#': ( table.bit( 'calm' ), table.bit( 'noisy' ) ),
+            'c:@F@bark#': ( table.bit( 'noisy' ), 0 ),
+        } )
+        self.cursors = {
+            'c:@F@nap#': ast_helpers.LocationRecord(
+                'nap()', ast_helpers.SourceLocation( 'main.cpp', 2, 6 ),
+                'main.cpp' ),
+            'c:@F@bark#': ast_helpers.LocationRecord(
+                'bark()', ast_helpers.SourceLocation( '/src/pets.h', 1, 6 ),
+                'main.cpp' ),
+        }
+        self.violations = [
+            RuleViolation( RuleRestrictIndirectCall( 'calm', 'noisy' ),
+                           [ 'c:@F@nap#', 'c:@F@bark#' ] ),
+            OverrideViolation( 'c:@F@bark#', 'c:@F@nap#' ),
+        ]
+
+    def write( self, writer_class ):
+        stream = io.StringIO()
+        writer = writer_class( stream )
+        writer.begin()
+        for violation in self.violations:
+            writer.write( violation, self.cursors, self.types )
+        writer.end()
+        return stream.getvalue()
+
+    def test_jsonl( self ):
+        lines = self.write( output.JsonLinesWriter ).splitlines()
+        self.assertEqual( len( lines ), 2 )
+
+        rule = json.loads( lines[ 0 ] )
+        self.assertEqual( rule[ 'rule_id' ],
+                          'restrict_indirect_call(calm, noisy)' )
+        self.assertEqual( [ func[ 'usr' ] for func in rule[ 'path' ] ],
+                          [ 'c:@F@nap#', 'c:@F@bark#' ] )
+        self.assertEqual( rule[ 'path' ][ 1 ][ 'name' ],
+                          'main.cpp::bark() (1,6)' )
+        self.assertEqual( rule[ 'path' ][ 0 ][ 'indirect' ], [ 'noisy' ] )
+
+        override = json.loads( lines[ 1 ] )
+        self.assertEqual( override[ 'kind' ], 'override' )
+        self.assertEqual( override[ 'location' ],
+                          { 'file': 'main.cpp', 'line': 2, 'column': 6 } )
+
+    def test_sarif( self ):
+        log = json.loads( self.write( output.SarifWriter ) )
+        results = log[ 'runs' ][ 0 ][ 'results' ]
+
+        self.assertEqual( [ result[ 'ruleId' ] for result in results ],
+                          [ 'restrict_indirect_call(calm, noisy)',
+                            'override' ] )
+        flow = results[ 0 ][ 'codeFlows' ][ 0 ][ 'threadFlows' ][ 0 ]
+        self.assertEqual(
+                [ step[ 'location' ][ 'physicalLocation' ]
+                      [ 'artifactLocation' ][ 'uri' ]
+                  for step in flow[ 'locations' ] ],
+                [ 'main.cpp', 'file:///src/pets.h' ] )
+
+    def test_names_rendered_once( self ):
+        rendered = []
+        class CountingRecord( ast_helpers.LocationRecord ):
+            def human_name( self ):
+                rendered.append( self.displayname )
+                return super().human_name()
+
+        self.cursors = dict(
+                [ ( usr, CountingRecord( record.displayname,
+                                         record.location,
+                                         record.parent_name ) )
+                  for usr, record in self.cursors.items() ] )
+        self.violations = self.violations * 3
+
+        text = self.write( output.TextWriter )
+        self.assertEqual( text.count( 'main.cpp::bark() (1,6)' ), 9 )
+        self.assertEqual( sorted( rendered ), [ 'bark()', 'nap()' ] )
+
+    def test_aggregate_rule_violations( self ):
+        call_tree = CallTree()
+        for caller, callee in [ ( 'nap', 'a' ), ( 'nap', 'c' ),
+                                ( 'a', 'b' ), ( 'a', 'bark' ), ( 'a', 'howl' ),
+                                ( 'b', 'bark' ), ( 'c', 'bark' ),
+                                ( 'a', 'd' ), ( 'd', 'a' ) ]:
+            call_tree.add( caller, callee )
+
+        table = TagTable()
+        types = QualifiedTypes( table, {
+            'nap': ( table.bit( 'calm' ), 0 ),
+            'bark': ( table.bit( 'noisy' ), 0 ),
+            'howl': ( table.bit( 'noisy' ), 0 ),
+        } )
+        rule = RuleRestrictIndirectCall( 'calm', 'noisy' )
+        require = RuleRequireCall( 'calm', 'calm' )
+
+        violations = list( aggregate_rule_violations(
+                check_rules( call_tree, types, [ rule, require ],
+                             set( types.keys() ) ),
+                PathCounter( call_tree, types, set( types.keys() ) ),
+                first_hops=True ) )
+
+        # a and d call each other, which only counts as one step
+        aggregated = dict( [ ( violation.call_path[ -1 ], violation )
+                             for violation in violations
+                             if violation.rule is rule ] )
+        self.assertEqual( aggregated[ 'bark' ].path_count, 3 )
+        self.assertEqual( len( aggregated[ 'bark' ].call_path ), 3 )
+        self.assertEqual( aggregated[ 'bark' ].first_hops, set( [ 'a', 'c' ] ) )
+        self.assertEqual( aggregated[ 'howl' ].path_count, 1 )
+        self.assertEqual( aggregated[ 'howl' ].first_hops, set( [ 'a' ] ) )
+        self.assertEqual( len( [ violation for violation in violations
+                                 if violation.rule is require ] ), 2 )
+
+    def test_aggregated_text( self ):
+        rule = RuleRestrictIndirectCall( 'calm', 'noisy' )
+        call_tree = CallTree()
+        call_tree.add( 'c:@F@nap#', 'c:@F@bark#' )
+        aggregated, = aggregate_rule_violations(
+                [ RuleViolation( rule, [ 'c:@F@nap#', 'c:@F@bark#' ] ) ],
+                PathCounter( call_tree, self.types, set() ) )
+
+        text = aggregated.render_string( self.cursors, self.types )
+        self.assertIn( "\t1 path(s) from main.cpp::nap() (2,6)", text )
+        self.assertFalse( text.endswith( "\n" ) )
+        self.assertEqual(
+                aggregated.to_dict( self.cursors, self.types )[ 'path_count' ],
+                1 )
+
+class TestQuery( unittest.TestCase ):
+    def setUp( self ):
+        call_tree = CallTree()
+        for caller, callee in [ ( 'c:@F@isr#', 'c:@S@Log@F@write#' ),
+                                ( 'c:@S@Log@F@write#', 'c:@F@fmt#' ),
+                                ( 'c:@F@fmt#', 'c:@F@malloc' ),
+                                ( 'c:@F@idle#', 'c:@F@malloc' ) ]:
+            call_tree.add( caller, callee )
+
+        table = TagTable()
+        func_types = QualifiedTypes( table, {
+            'c:@F@isr#': ( table.bit( 'preemptive' ),
+                           table.bit( 'non_reentrant' ) ),
+            'c:@F@malloc': ( table.bit( 'non_reentrant' ), 0 ),
+        } )
+        cursors = {
+            'c:@S@Log@F@write#': ast_helpers.LocationRecord(
+                'write()', ast_helpers.SourceLocation( 'log.h', 3, 10 ),
+                'main.cpp::Log' ),
+        }
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join( self.tmpdir, 'program.fqa' )
+        query.write_analysis( self.path, call_tree.freeze(), func_types,
+                              cursors, ClassHierarchy( {} ) )
+        self.analysis = query.read_analysis( self.path )
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def test_queries( self ):
+        analysis = self.analysis
+        self.assertEqual( analysis.resolve( 'Log::write' ),
+                          [ 'c:@S@Log@F@write#' ] )
+        self.assertEqual( analysis.callers( 'c:@F@malloc' ),
+                          [ 'c:@F@fmt#', 'c:@F@idle#' ] )
+        self.assertEqual( analysis.tags( 'c:@F@isr#' ),
+                          ( [ 'preemptive' ], [ 'non_reentrant' ] ) )
+        self.assertEqual( analysis.reaching( 'c:@F@malloc', 'preemptive' ),
+                          [ 'c:@F@isr#' ] )
+
+        self.assertEqual(
+                query.run_query( analysis, 'why',
+                                 [ 'c:@F@isr#', 'tag:non_reentrant' ] ),
+                [ 'c:@F@isr#', '  -calls: main.cpp::Log::write() (3,10)',
+                  '  -calls: c:@F@fmt#', '  -calls: c:@F@malloc' ] )
+
+        with self.assertRaises( query.QueryError ):
+            query.run_query( analysis, 'callers', [ 'Missing::write' ] )
+
+    def test_rejects_other_files( self ):
+        with open( self.path, 'r+b' ) as f:
+            f.write( b'NOTFUNQ' )
+        with self.assertRaises( ValueError ):
+            query.read_analysis( self.path )
+
+class TestEarlyChecker( unittest.TestCase ):
+    def unit( self, fname, calls, tags ):
+        call_tree = CallTree()
+        for caller, callee in calls:
+            call_tree.add( caller, callee )
+        cursors = dict( [
+            ( usr, ast_helpers.LocationRecord(
+                usr, ast_helpers.SourceLocation( fname, 1, 1 ), None ) )
+            for call in calls for usr in call ] )
+        func_types = dict( [
+            ( usr, set( [ ( AnnotationKind.DIRECT, tag ) ] ) )
+            for usr, tag in tags ] )
+        return summary.TranslationUnitSummary(
+                fname, call_tree, {}, cursors, func_types, {}, [] )
+
+    def test_reports_restrict_violations_once_certain( self ):
+        rule = RuleRestrictIndirectCall( 'preemptive', 'non_reentrant' )
+        checker = pipeline.EarlyChecker(
+                [ rule, RuleRequireCall( 'preemptive', 'preemptive' ) ],
+                { 'malloc': set( [ ( AnnotationKind.DIRECT,
+                                     'non_reentrant' ) ] ) } )
+
+        checker.add_summary( self.unit(
+            'isr.cpp', [ ( 'isr', 'helper' ) ], [ ( 'isr', 'preemptive' ) ] ) )
+        self.assertEqual( checker.take(), [] )
+
+        checker.add_summary( self.unit(
+            'helper.cpp', [ ( 'helper', 'log' ), ( 'log', 'malloc' ) ], [] ) )
+        found = checker.take()
+        self.assertEqual( [ ( str( violation.rule ), violation.call_path )
+                            for violation in found ],
+                          [ ( str( rule ),
+                              [ 'isr', 'helper', 'log', 'malloc' ] ) ] )
+
+        final = [ RuleViolation( rule, [ 'isr', 'malloc' ] ),
+                  RuleViolation( rule, [ 'isr', 'helper', 'log', 'malloc' ] ),
+                  RuleViolation( rule, [ 'isr', 'helper', 'free' ] ) ]
+        self.assertEqual( list( checker.remaining( final, 2 ) ),
+                          final[ 1 : ] )
+        self.assertEqual( list( checker.remaining( final, 0 ) ),
+                          [ final[ 0 ], final[ 2 ] ] )
+
+    def test_early_violations_leave_types_out( self ):
+        rule = RuleRestrictIndirectCall( 'preemptive', 'non_reentrant' )
+        described = RuleViolation( rule, [ 'isr', 'malloc' ] ).to_dict(
+                {}, None )
+        for function in described[ 'path' ]:
+            self.assertNotIn( 'direct', function )
+            self.assertNotIn( 'indirect', function )
+
+class TestBenchmark( unittest.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def test_generated_project_runs_every_phase( self ):
+        shape = dict( benchmark.PRESETS[ 'small' ], functions=40,
+                      translation_units=2, hierarchies=2 )
+        files, tags_file = benchmark.generate_project( self.tmpdir, shape )
+        self.assertEqual( len( files ), 2 )
+
+        with open( os.devnull, 'w' ) as devnull:
+            with contextlib.redirect_stdout( devnull ):
+                timings, counts = benchmark.run_phases( files, tags_file )
+
+        self.assertEqual( sorted( timings ), sorted( benchmark.PHASES ) )
+        self.assertEqual( counts[ 'translation_units' ], 2 )
+        self.assertGreaterEqual( counts[ 'calls' ],
+                                 39 * shape[ 'fan_out' ] )
+        self.assertEqual( counts[ 'assignment_violations' ] > 0,
+                          bool( shape[ 'funptr_assignments' ] ) )
+
+    def test_compare_uses_threshold_and_noise_floor( self ):
+        def results( parse_time, rss ):
+            phases = dict( [ ( phase, 0.0 )
+                             for phase in benchmark.PHASES ] )
+            phases[ 'parse' ] = parse_time
+            return { 'cases': { 'small': {
+                'phases': phases, 'total': parse_time,
+                'peak_rss_kb': rss } } }
+
+        base = results( 1.0, 1000 )
+        self.assertEqual( benchmark.compare(
+            base, results( 1.05, 1050 ), 0.10 ), [] )
+        self.assertEqual( benchmark.compare(
+            results( 0.001, 1000 ), results( 0.002, 1000 ), 0.10 ), [] )
+        self.assertEqual(
+                benchmark.compare( base, results( 1.5, 2000 ), 0.10 ),
+                [ ( 'small', 'parse', 1.0, 1.5 ),
+                  ( 'small', 'total', 1.0, 1.5 ),
+                  ( 'small', 'peak_rss_kb', 1000, 2000 ) ] )
+
+class TestInstrument( unittest.TestCase ):
+    def setUp( self ):
+        instrument.reset()
+
+    def tearDown( self ):
+        instrument.reset()
+
+    def test_spans_nest_and_export( self ):
+        with instrument.span( 'outer' ):
+            with instrument.span( 'inner', file='a.cpp' ) as args:
+                args[ 'extra' ] = 1
+            items = list( instrument.timed( 'lazy', iter( [ 1, 2, 3 ] ) ) )
+        instrument.count( 'edges', 2 )
+        instrument.count( 'edges' )
+
+        self.assertEqual( items, [ 1, 2, 3 ] )
+        spans = dict( [ ( span.name, span )
+                        for span in instrument.recorder.spans ] )
+        self.assertEqual( spans[ 'outer' ].depth, 0 )
+        self.assertEqual( spans[ 'inner' ].depth, 1 )
+        self.assertEqual( spans[ 'inner' ].args,
+                          { 'file': 'a.cpp', 'extra': 1 } )
+        self.assertEqual( spans[ 'lazy' ].args, { 'items': 3 } )
+
+        trace = json.loads( json.dumps(
+                instrument.recorder.to_chrome_trace() ) )
+        phases = [ event[ 'ph' ] for event in trace[ 'traceEvents' ] ]
+        self.assertEqual( phases, [ 'X', 'X', 'X', 'C' ] )
+        self.assertEqual( trace[ 'traceEvents' ][ -1 ][ 'args' ],
+                          { 'edges': 3 } )
+
+        metrics = instrument.recorder.to_json()
+        self.assertEqual( metrics[ 'counters' ], { 'edges': 3 } )
+        self.assertEqual( sorted( metrics[ 'totals' ] ),
+                          [ 'inner', 'lazy', 'outer' ] )
+
+    def test_run_records_every_translation_unit( self ):
+        options = get_options( jobs=2 )
+        files = [ 'test_cases/3/Panda.cpp', 'test_cases/3/RedPanda.cpp' ]
+
+        with open( os.devnull, 'w' ) as devnull:
+            with contextlib.redirect_stdout( devnull ):
+                model = parse.scrape_all_files(
+                        parse.get_compile_jobs( files, options ), {},
+                        options )
+
+        for name in [ 'parse', 'scrape' ]:
+            self.assertEqual( sorted( [
+                span.args[ 'file' ] for span in instrument.recorder.spans
+                if span.name == name ] ), files )
+        counters = instrument.recorder.counters
+        self.assertEqual( counters[ 'edges' ], model[ 0 ].size() )
+        self.assertGreater( counters[ 'cursors_visited' ], 0 )
+
+
+def get_options( **kwargs ):
+    """
+    Build the options object that parse.parse_args would have produced
+    """
+    options = Values( {
+        'tags_file': None,
+        'language': 'c++',
+        'standard': 'c++17',
+        'include_path': None,
+        'clang_flags': None,
+        'verbose': False,
+        'jobs': 1,
+        'cache_dir': None,
+        'compile_db': None,
+        'file_filters': None,
+        'show_time': False,
+        'max_paths': 1,
+        'aggregate': False,
+        'first_hops': False,
+        'early': False,
+        'watch': False,
+        'format': 'text',
+        'trace_file': None,
+        'metrics_file': None,
+        'analysis_file': None,
+    } )
+    options._update_loose( kwargs )
+    return options
+
 def get_overrides( *sourcefiles ):
     """
     Open the given source file, parse it and determine the overrides map
@@ -9,7 +9,7 @@ to include implicit type information.  The following rules apply:
 """
 
 import sys
-from scrapers import AnnotationKind
+from tags import NO_TYPE, QualifiedTypes
 
 
 def determine_indirect_type( function, call_tree,
@@ -17,10 +17,11 @@ def determine_indirect_type( function, call_tree,
     """
     For the given function, determine its indirect type by recursively
     walking the call tree and colleting function types that are indirectly
-    called by this function
+    called by this function.  Types are ( direct, indirect ) bitmask pairs;
+    the indirect bitmask is returned.
     """
     visited = set( [ function ] )
-    qualifiers = set()
+    qualifiers = 0
 
     for child in call_tree.calls( function ):
         qualifiers |= _rec_determine_indirect_type(
@@ -35,33 +36,131 @@ def _rec_determine_indirect_type( function, call_tree, funptr_types,
     Recurse the call tree starting at |function| and collecting the types
     of everything visited.  Do not recurse on |visited|.  
     """
-    types = []
-    types += funptr_types.get( function, [] )
-    types += function_types.get( function, [] )
+    qualifiers = ( own_qualifiers( function, funptr_types ) |
+                   own_qualifiers( function, function_types ) )
 
     for child in call_tree.calls( function ):
         if child not in visited:
             visited.add( child )
-            types += _rec_determine_indirect_type(
+            qualifiers |= _rec_determine_indirect_type(
                     child, call_tree, funptr_types, function_types,
                     visited )
 
-    return set( [ ( AnnotationKind.INDIRECT, qual ) for ( _, qual ) in types ] )
+    return qualifiers
+
+
+def own_qualifiers( function, types ):
+    """
+    Every qualifier of |function|, direct or indirect, as one bitmask
+    """
+    direct, indirect = types.get( function, NO_TYPE )
+    return direct | indirect
+
+
+def condense( call_tree, roots ):
+    """
+    Find the strongly connected components of the call tree reachable from
+    |roots| using an iterative version of Tarjan's algorithm.  Components
+    are yielded in reverse topological order: every component is yielded
+    after all the components it calls into.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+
+    for root in roots:
+        if root in index:
+            continue
+
+        index[ root ] = lowlink[ root ] = len( index )
+        stack.append( root )
+        on_stack.add( root )
+        work = [ ( root, iter( call_tree.calls( root ) ) ) ]
+
+        while work:
+            node, children = work[ -1 ]
+
+            for child in children:
+                if child not in index:
+                    index[ child ] = lowlink[ child ] = len( index )
+                    stack.append( child )
+                    on_stack.add( child )
+                    work.append( ( child, iter( call_tree.calls( child ) ) ) )
+                    break
+                elif child in on_stack:
+                    lowlink[ node ] = min( lowlink[ node ], index[ child ] )
+            else:
+                work.pop()
+                if work:
+                    parent = work[ -1 ][ 0 ]
+                    lowlink[ parent ] = min( lowlink[ parent ],
+                                             lowlink[ node ] )
+
+                if lowlink[ node ] == index[ node ]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard( member )
+                        component.append( member )
+                        if member == node:
+                            break
+                    yield component
 
 
 def augment_types( call_tree, funptr_types, function_types ):
     """
     Given a call tree, the types of all function pointers, and the types of all
     functions (augmented with overrides), determine the indirect types of
-    all functions and return a mapping of function to its complete type
-    """
-    types = {}
+    all functions and return a mapping of function to its complete type.
 
-    for function in function_types.keys():
-        indirect_types = determine_indirect_type(
-                function, call_tree, funptr_types, function_types )
-        direct_types = function_types[ function ]
-        types[ function ] = indirect_types | direct_types
+    Rather than walking the call tree once per function, the call tree is
+    condensed into its strongly connected components and the qualifiers
+    reachable from each component are computed once, in reverse topological
+    order, and shared by every function that calls into it.  The result is
+    the same as calling determine_indirect_type for every function.
+    """
+    types = QualifiedTypes( function_types.table )
+    component_of = {}
+    reachable = []
+
+    for component in condense( call_tree, function_types.keys() ):
+        members = set( component )
+        component_id = len( reachable )
+
+        # Qualifiers of everything called from outside this component
+        below = 0
+        for member in component:
+            component_of[ member ] = component_id
+            for child in call_tree.calls( member ):
+                if child not in members:
+                    below |= reachable[ component_of[ child ] ]
+
+        # Qualifiers carried by any member, and by more than one member
+        own = {}
+        seen = 0
+        shared = 0
+        for member in component:
+            own[ member ] = ( own_qualifiers( member, funptr_types ) |
+                              own_qualifiers( member, function_types ) )
+            shared |= seen & own[ member ]
+            seen |= own[ member ]
+
+        reachable.append( below | seen )
+
+        for member in component:
+            if member not in function_types:
+                continue
+
+            # A function only counts its own qualifiers when it calls itself
+            # directly, but it does see the other members of its component
+            if member in call_tree.calls( member ):
+                qualifiers = below | seen
+            else:
+                qualifiers = below | shared | ( seen & ~own[ member ] )
+
+            direct, indirect = function_types[ member ]
+            types[ member ] = ( direct, indirect | qualifiers )
 
     return types
 
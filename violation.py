@@ -5,7 +5,102 @@ to read them.
 """
 
 from ast_helpers import get_human_name
-from scrapers import AnnotationKind
+
+
+def describe_location( location ):
+    """
+    Turn a SourceLocation into a dictionary that can be serialized
+    """
+    return {
+        'file': location.file,
+        'line': location.line,
+        'column': location.column,
+    }
+
+
+def describe_function( usr, func_cursors, fun_types ):
+    """
+    Describe the function (or function pointer) |usr| for machine readable
+    output: its USR, human readable name, location and qualified type.
+    The qualified type is left out if |fun_types| is None, when it is not
+    known yet.
+    """
+    description = {
+        'usr': usr,
+        'name': usr,
+        'location': None,
+    }
+
+    if fun_types is not None:
+        description[ 'direct' ] = sorted( fun_types.direct_names( usr ) )
+        description[ 'indirect' ] = sorted( fun_types.indirect_names( usr ) )
+
+    if usr in func_cursors:
+        description[ 'name' ] = get_human_name( func_cursors[ usr ] )
+        description[ 'location' ] = describe_location(
+                func_cursors[ usr ].location )
+
+    return description
+
+
+class NameCache( object ):
+    """
+    Renders the functions that appear in violations.  The same functions
+    show up in many violations (and many times along their call paths), so
+    each function is rendered once, keyed by its USR, and reused from then
+    on.  The records in |func_cursors| were taken while scraping, so no
+    cursor is needed here.
+
+    The descriptions returned by describe() are shared and must not be
+    modified.
+    """
+    def __init__( self, func_cursors, fun_types ):
+        self.func_cursors = func_cursors
+        self.fun_types = fun_types
+        self.names = {}
+        self.descriptions = {}
+
+    def name( self, usr ):
+        """
+        Human readable name of the function |usr|
+        """
+        name = self.names.get( usr )
+        if name is None:
+            name = self.names[ usr ] = get_human_name(
+                    self.func_cursors[ usr ] )
+        return name
+
+    def names_of( self, usrs ):
+        """
+        Human readable names of all the functions in |usrs|, in order
+        """
+        names = self.names
+        missing = [ usr for usr in usrs if usr not in names ]
+        for usr in missing:
+            self.name( usr )
+        return [ names[ usr ] for usr in usrs ]
+
+    def describe( self, usr ):
+        """
+        describe_function( usr ), rendered once per function
+        """
+        description = self.descriptions.get( usr )
+        if description is None:
+            description = self.descriptions[ usr ] = describe_function(
+                    usr, self.func_cursors, self.fun_types )
+        return description
+
+    def describe_all( self, usrs ):
+        return [ self.describe( usr ) for usr in usrs ]
+
+    def matches( self, func_cursors, fun_types ):
+        """
+        Check whether this cache renders functions from |func_cursors|
+        and |fun_types|
+        """
+        return ( self.func_cursors is func_cursors and
+                 self.fun_types is fun_types )
+
 
 class BaseViolation( object ):
     """
@@ -13,13 +108,22 @@ class BaseViolation( object ):
     A violation is a problem with the user's program that must be reported
     to the user.
     """
-    def render_string( self, func_cursors, fun_types ):
+    def render_string( self, func_cursors, fun_types, names=None ):
         """
         Return a human readable string that explains to the user what the
-        violation is, means, and where to look.
+        violation is, means, and where to look.  Pass a NameCache in
+        |names| when rendering many violations.
         """
         raise NotImplementedError( "BaseViolation.render_string" )
 
+    def to_dict( self, func_cursors, fun_types, names=None ):
+        """
+        Return a dictionary describing the violation that can be serialized
+        for other programs.  It always has a `kind`, a `rule_id`, a
+        `message` and the `location` to report the violation at.
+        """
+        raise NotImplementedError( "BaseViolation.to_dict" )
+
 
 class AssignmentViolation( BaseViolation ):
     def __init__( self, lvalue, rvalue, cursor ):
@@ -27,10 +131,7 @@ class AssignmentViolation( BaseViolation ):
         self.rvalue = rvalue
         self.cursor = cursor
 
-    def render_string( self, func_cursors, fun_types ):
-        ltype = fun_types.get( self.lvalue, set() )
-        rtype = fun_types.get( self.rvalue, set() )
-
+    def render_string( self, func_cursors, fun_types, names=None ):
         return """Assignment violation:
     {} = {} at ({}, {})
  - lvalue has type
@@ -43,10 +144,26 @@ Direct type must match.
 Lvalue indirect type must be subset of rvalue indirect type""".format(
             self.lvalue, self.rvalue,
             self.cursor.location.line, self.cursor.location.column,
-            set( [ x[1] for x in ltype if x[0] == AnnotationKind.DIRECT ] ),
-            set( [ x[1] for x in ltype if x[0] == AnnotationKind.INDIRECT ] ),
-            set( [ x[1] for x in rtype if x[0] == AnnotationKind.DIRECT ] ),
-            set( [ x[1] for x in rtype if x[0] == AnnotationKind.INDIRECT ] ) )
+            fun_types.direct_names( self.lvalue ),
+            fun_types.indirect_names( self.lvalue ),
+            fun_types.direct_names( self.rvalue ),
+            fun_types.indirect_names( self.rvalue ) )
+
+    def to_dict( self, func_cursors, fun_types, names=None ):
+        names = names or NameCache( func_cursors, fun_types )
+        lvalue = names.describe( self.lvalue )
+        rvalue = names.describe( self.rvalue )
+
+        return {
+            'kind': 'assignment',
+            'rule_id': 'assignment',
+            'message': ( "Assigning {} to {} does not preserve its "
+                         "qualified type".format( rvalue[ 'name' ],
+                                                  lvalue[ 'name' ] ) ),
+            'location': describe_location( self.cursor.location ),
+            'lvalue': lvalue,
+            'rvalue': rvalue,
+        }
 
 
 class RuleViolation( BaseViolation ):
@@ -54,32 +171,96 @@ class RuleViolation( BaseViolation ):
         self.rule = rule
         self.call_path = call_path
 
-    def render_string( self, func_cursors, fun_types ):
+    def render_string( self, func_cursors, fun_types, names=None ):
+        names = names or NameCache( func_cursors, fun_types )
         ret = "Rule violation: {0}\n".format( str( self.rule.error_string() ) )
 
-        pretty_path = [ get_human_name( func_cursors[ func_usr ] )
-                        for func_usr
-                        in self.call_path ]
-
-        pretty_path = "\n\t-calls: ".join( pretty_path )
+        pretty_path = "\n\t-calls: ".join( names.names_of( self.call_path ) )
         ret += "\tPath:   " + pretty_path
 
         if self.rule.message:
             ret += "\tRule-specific message: {0}\n".format( self.rule.message )
         return ret
 
+    def to_dict( self, func_cursors, fun_types, names=None ):
+        names = names or NameCache( func_cursors, fun_types )
+        path = names.describe_all( self.call_path )
+
+        return {
+            'kind': 'rule',
+            'rule_id': str( self.rule ),
+            'message': self.rule.error_string(),
+            'rule_message': self.rule.message,
+            'location': path[ 0 ][ 'location' ],
+            'path': path,
+        }
+
+
+class AggregatedRuleViolation( BaseViolation ):
+    """
+    Every path from one root caller to one offending callee of a
+    restrict_indirect_call rule, summarized as their number and the
+    shortest of them (see rule_checker.aggregate_rule_violations).
+    |first_hops|, if given, is the set of the functions the root calls
+    first on those paths.
+    """
+    def __init__( self, rule, call_path, path_count, first_hops=None ):
+        self.rule = rule
+        self.call_path = call_path
+        self.path_count = path_count
+        self.first_hops = first_hops
+
+    def render_string( self, func_cursors, fun_types, names=None ):
+        names = names or NameCache( func_cursors, fun_types )
+        ret = "Rule violation: {0}\n".format( str( self.rule.error_string() ) )
+        ret += ( "\t{0} path(s) from {1} to {2}, "
+                 "the shortest being:\n" ).format(
+                self.path_count,
+                names.name( self.call_path[ 0 ] ),
+                names.name( self.call_path[ -1 ] ) )
+
+        pretty_path = "\n\t-calls: ".join( names.names_of( self.call_path ) )
+        ret += "\tPath:   " + pretty_path
+
+        if self.first_hops is not None:
+            ret += "\n\tFirst hops: {0}".format( ", ".join(
+                    sorted( names.names_of( list( self.first_hops ) ) ) ) )
+
+        if self.rule.message:
+            ret += "\n\tRule-specific message: {0}".format( self.rule.message )
+        return ret
+
+    def to_dict( self, func_cursors, fun_types, names=None ):
+        names = names or NameCache( func_cursors, fun_types )
+        path = names.describe_all( self.call_path )
+
+        details = {
+            'kind': 'rule',
+            'rule_id': str( self.rule ),
+            'message': "{0} ({1} path(s))".format( self.rule.error_string(),
+                                                 self.path_count ),
+            'rule_message': self.rule.message,
+            'location': path[ 0 ][ 'location' ],
+            'path': path,
+            'path_count': self.path_count,
+        }
+
+        if self.first_hops is not None:
+            details[ 'first_hops' ] = names.describe_all(
+                    sorted( self.first_hops ) )
+
+        return details
+
 
 class OverrideViolation( BaseViolation ):
     def __init__( self, overridden_method, overrider_method ):
         self.overridden_method = overridden_method
         self.overrider_method = overrider_method
 
-    def render_string( self, func_cursors, fun_types ):
-        overridden_name = get_human_name( func_cursors[ self.overridden_method ] )
-        overrider_name = get_human_name( func_cursors[ self.overrider_method ] )
-
-        overridden_type = fun_types.get( self.overridden_method, set() )
-        overrider_type = fun_types.get( self.overrider_method, set() )
+    def render_string( self, func_cursors, fun_types, names=None ):
+        names = names or NameCache( func_cursors, fun_types )
+        overridden_name = names.name( self.overridden_method )
+        overrider_name = names.name( self.overrider_method )
 
         return """Override Violation:
 \t{} overrides {} but their direct types don't match.
@@ -87,6 +268,22 @@ class OverrideViolation( BaseViolation ):
 \t - {} has type {}
 """.format( overrider_name, overridden_name,
             overrider_name, 
-            set( [ x[1] for x in overrider_type if x[0] == AnnotationKind.DIRECT ] ),
+            fun_types.direct_names( self.overrider_method ),
             overridden_name,
-            set( [ x[1] for x in overridden_type if x[0] == AnnotationKind.DIRECT ] ) )
+            fun_types.direct_names( self.overridden_method ) )
+
+    def to_dict( self, func_cursors, fun_types, names=None ):
+        names = names or NameCache( func_cursors, fun_types )
+        overrider = names.describe( self.overrider_method )
+        overridden = names.describe( self.overridden_method )
+
+        return {
+            'kind': 'override',
+            'rule_id': 'override',
+            'message': ( "{} overrides {} but their direct types don't "
+                         "match".format( overrider[ 'name' ],
+                                         overridden[ 'name' ] ) ),
+            'location': overrider[ 'location' ],
+            'overrider': overrider,
+            'overridden': overridden,
+        }
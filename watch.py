@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Watch mode.  funqual stays resident, keeping every translation unit and its
+summary in memory.  The files every translation unit depends on are polled
+for changes.  Only the translation units that depend on a changed file are
+reparsed, which lets clang reuse their precompiled preamble, and then the
+whole program is merged and checked again.  Only violations that appeared
+or went away since the previous check are printed.
+"""
+
+import os
+import time
+import clang.cindex
+import rules
+import parse
+import summary
+import ast_helpers
+import instrument
+from violation import NameCache
+
+# Seconds to wait between two scans of the watched files
+POLL_INTERVAL = 0.25
+
+
+def modification_time( fname ):
+    """
+    Return the modification time of |fname|, or None if it does not exist
+    """
+    try:
+        return os.stat( fname ).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ResidentUnit( object ):
+    """
+    A translation unit kept in memory along with its summary and
+    the files it depends on
+    """
+    def __init__( self, job ):
+        self.job = job
+        self.tu = None
+        self.summary = None
+        self.depends = set( [ os.path.abspath( job.fname ) ] )
+
+    def depends_on( self, fnames ):
+        return not self.depends.isdisjoint( fnames )
+
+
+class Watcher( object ):
+    def __init__( self, jobs, options ):
+        self.jobs = jobs
+        self.options = options
+        self.index = clang.cindex.Index.create()
+        self.registry = summary.HeaderRegistry()
+        self.headers = {}
+        self.units = [ ResidentUnit( job ) for job in jobs ]
+        self.violations = {}
+
+        # The modification time of every file some unit depends on, each
+        # file once however many units include it
+        self.mtimes = {}
+
+        self.tags_mtime = None
+        self.ext_types = None
+        self.type_rules = None
+
+    def load_rules( self ):
+        """
+        (Re)read the rules file if it changed.  Returns True if it did.
+        """
+        mtime = None
+        if self.options.tags_file:
+            mtime = modification_time( self.options.tags_file )
+        if self.ext_types is not None and mtime == self.tags_mtime:
+            return False
+
+        self.tags_mtime = mtime
+        self.ext_types, self.type_rules = rules.load_rules_file(
+                self.options.tags_file, self.options.cache_dir )
+        return True
+
+    def scrape( self, unit ):
+        """
+        Parse |unit| (or reparse it if it is already resident) and scrape
+        it again.  The previous summary is kept if clang fails.
+        """
+        job = unit.job
+        if unit.tu is None:
+            unit.tu = ast_helpers.get_translation_unit(
+                    job.fname, self.options, job.args,
+                    index=self.index, editing=True )
+            if unit.tu is None:
+                return
+        elif not ast_helpers.reparse_translation_unit(
+                job.fname, unit.tu, self.options, job.args ):
+            unit.tu = None
+            return
+
+        unit.summary = summary.summarize_translation_unit(
+                job, unit.tu, self.registry )
+        self.headers.update( unit.summary.headers )
+
+        unit.depends = set(
+                [ os.path.abspath( job.fname ) ] + unit.summary.includes )
+
+    def changed_files( self ):
+        """
+        Return the set of watched files whose modification time changed,
+        and remember their new modification times
+        """
+        changed = set()
+        for fname, mtime in self.mtimes.items():
+            current = modification_time( fname )
+            if current != mtime:
+                self.mtimes[ fname ] = current
+                changed.add( fname )
+        return changed
+
+    def watch_depends( self, stale ):
+        """
+        Watch the files the units depend on now.  The files the |stale|
+        units were just parsed from are stat'ed again, the others keep
+        the time they were last seen with.
+        """
+        depends = set()
+        for unit in self.units:
+            depends.update( unit.depends )
+
+        fresh = set()
+        for unit in stale:
+            fresh.update( unit.depends )
+
+        self.mtimes = dict( [
+            ( fname, self.mtimes[ fname ] if fname in self.mtimes
+                     and fname not in fresh
+                     else modification_time( fname ) )
+            for fname in depends ] )
+
+    def update( self, changed ):
+        """
+        Reparse every translation unit that depends on a file in |changed|
+        (or that never parsed successfully).  Returns how many were
+        reparsed.
+        """
+        self.registry.forget( changed )
+
+        stale = [ unit for unit in self.units
+                  if unit.summary is None or unit.depends_on( changed ) ]
+        for unit in stale:
+            self.scrape( unit )
+        self.watch_depends( stale )
+
+        # Forget header summaries no translation unit depends on any more
+        used = set()
+        for unit in self.units:
+            if unit.summary is not None:
+                used.update( unit.summary.header_keys )
+        self.headers = dict( [ ( key, header )
+                               for key, header in self.headers.items()
+                               if key in used ] )
+        self.registry.seen = set( self.headers )
+
+        return len( stale )
+
+    def check( self ):
+        """
+        Merge and check the whole program.  Returns the rendered violations
+        that are new and those that were resolved since the last check.
+        """
+        model = parse.build_program_model(
+                [ unit.summary for unit in self.units
+                  if unit.summary is not None ],
+                self.ext_types, self.options, self.headers )
+        cursors, types, violations = parse.check_program_model(
+                model, self.type_rules, self.options )
+
+        names = NameCache( cursors, types )
+        current = {}
+        for violation in violations:
+            rendered = violation.render_string( cursors, types, names )
+            current[ rendered ] = violation
+
+        new = [ rendered for rendered in current
+                if rendered not in self.violations ]
+        resolved = [ rendered for rendered in self.violations
+                     if rendered not in current ]
+        self.violations = current
+
+        return new, resolved
+
+    def report( self, new, resolved, reparsed, elapsed ):
+        for rendered in resolved:
+            print( "[resolved] " + rendered )
+            print()
+        for rendered in new:
+            print( "[new] " + rendered )
+            print()
+
+        print( "Rechecked {} translation units in {:0.3f} seconds: "
+               "{} violations, {} new, {} resolved".format(
+                   reparsed, elapsed, len( self.violations ),
+                   len( new ), len( resolved ) ), flush=True )
+
+    def poll( self ):
+        """
+        Scan the watched files once.  If anything changed, bring the
+        affected translation units up to date, check the program again
+        and report the difference.  Returns True if anything changed.
+        """
+        instrument.reset()
+        start = time.time()
+        rules_changed = self.load_rules()
+        changed = self.changed_files()
+        if not rules_changed and not changed:
+            return False
+
+        reparsed = self.update( changed )
+        new, resolved = self.check()
+        self.report( new, resolved, reparsed, time.time() - start )
+        return True
+
+    def run( self ):
+        """
+        Check everything once, then wait for changes forever
+        """
+        start = time.time()
+        self.load_rules()
+        reparsed = self.update( set() )
+        new, resolved = self.check()
+        self.report( new, resolved, reparsed, time.time() - start )
+
+        while True:
+            time.sleep( POLL_INTERVAL )
+            self.poll()